@@ -5,7 +5,6 @@ import time
 from datetime import datetime, timedelta, date
 from threading import Thread
 
-import cv2
 from flask import Flask, render_template, send_from_directory, request, Response, redirect, stream_with_context
 from flask_basicauth import BasicAuth
 
@@ -14,8 +13,7 @@ from flask_login import login_required, current_user
 from sqlalchemy.exc import IntegrityError
 
 from endpoints.mail_set_form import UserModForm
-from endpoints.queries_utils import get_next_closedays_set, cleanup_range_closedays, \
-    get_accuracy_mismatch_based
+from endpoints.queries_utils import cleanup_range_closedays, get_accuracy_mismatch_based
 from endpoints.closedays_form import CloseDaysForm
 from db.db_closedays import CloseDayRecord
 from utils.periodic_tasks import setup_periodic_tasks
@@ -23,16 +21,30 @@ from net_io.messages_websoc import MSGManagerThreadBody
 from endpoints.unauth_check import is_unauthorized
 from net_io.mail_management import MailManager, setup_mail_manager
 from utils.frames_dict import FramesDict
+from utils.counts_engine import CountsEngine
+from utils.ingest_spool import IngestSpool, WriteBehindThreadBody
 from endpoints.login import login_setup
 from utils.status import GlobalStatus
-from net_io.mucounts import MUCounts
+from net_io.mucounts_decoder import decode_mucounts, MUCountsFormatError
 from endpoints.queries_ep import add_queries_ep
+from endpoints.events_api import add_events_api_ep
+from endpoints.analytics import add_analytics_ep
+from endpoints.export_ep import add_export_ep
 from net_io.updates_websoc import UpdateManagerThreadBody
 from endpoints.reset_form_utils import ResetForm
 from utils.status_manager import StatusManagerThreadBody
+from utils.status_journal import StatusJournal
 
 import configs.config as conf
 from net_io.videostream_websoc import VideoGatherThreadBody
+from net_io.ws_service import WSNetService
+from utils.collage import CollageCompositor
+from utils.change_feed import CountsChangeFeed
+from utils.query_cache import QueryCache, KIND_CLOSEDAYS
+from utils.close_time_alert import CloseTimeAlert
+from utils.building_calendar import BuildingCalendar
+from utils.export_jobs import ExportManager
+from utils.shared_state import make_shared_state, LEAD_NET, LEAD_SCHEDULER
 from db.db_base import Session
 
 from db.db_init import create_all_tables
@@ -47,29 +59,65 @@ app.config['BASIC_AUTH_USERNAME'] = conf.auth_server[0]
 app.config['BASIC_AUTH_PASSWORD'] = conf.auth_server[1]
 basic_auth = BasicAuth(app)
 
-# Setup Message Broadcast Thread
-msg_man: MSGManagerThreadBody = MSGManagerThreadBody(conf.ssl_cert, conf.ssl_key)
+# State shared among Collector processes (workers/replicas): MUs liveness, frames, fan-out and leaderships
+shared_state = make_shared_state(app)
+
+# Single asyncio service running all WebSocket servers (video-gather, counts-updates, messages)
+net_service = WSNetService(conf.ssl_cert, conf.ssl_key)
+
+# Setup Message Broadcast server
+msg_man: MSGManagerThreadBody = MSGManagerThreadBody(net_service, shared_state)
 
 # Frames collector for all Monitoring Units
 fr_dict = FramesDict()
+collage = CollageCompositor(fr_dict)
+gatherer = VideoGatherThreadBody(f_dict=fr_dict, net_service=net_service, shared_state=shared_state)
+shared_state.follow_frames(lambda frame: fr_dict.add_frame(frame.device_id, frame))
 
-db_users, User = login_setup(app)
+db_users, User, auth_cache, user_dir = login_setup(app, shared_state)
 
-mail_manager: MailManager = setup_mail_manager(app, User, conf.email_alert_recipients)
+mail_manager: MailManager = setup_mail_manager(app, user_dir, shared_state, conf.email_alert_recipients)
 
 app.config['ALL_UNITS'] = conf.ALL_UNITS
 app.config['NOW_TIMERANGE'] = conf.NOW_TIMERANGE
 
-status_manager: StatusManagerThreadBody = StatusManagerThreadBody(app, fr_dict, mail_manager, msg_man)
+# MUs status events (mu_status records) are written in background batches
+status_journal = StatusJournal(app)
+status_manager: StatusManagerThreadBody = StatusManagerThreadBody(app, fr_dict, mail_manager, msg_man, shared_state,
+                                                                  status_journal)
+
+# Write-behind stage for Counts updates (replay records left in spool by a previous run)
+ingest_spool = IngestSpool()
+write_behind = WriteBehindThreadBody(app, ingest_spool)
+
+counts_engine = CountsEngine(app, ingest_spool)
+
+# Results of DB queries served by the web tier (invalidated by Counts commits and close-days changes)
+query_cache = QueryCache(app, shared_state)
+
+update_manager: UpdateManagerThreadBody = add_queries_ep(app, status_manager, counts_engine, net_service, query_cache)
+add_events_api_ep(app)
+add_analytics_ep(app)
+
+# Background exports of Counts/MU-status records
+export_manager = ExportManager(app)
+add_export_ep(app, export_manager)
+
+# Counts committed by other Collector processes are applied to `counts_engine` and pushed to the dashboards
+change_feed = CountsChangeFeed(app, shared_state, counts_engine, update_manager)
+ingest_spool.commit_hooks.append(change_feed.emit)
+change_feed.change_hooks.append(query_cache.invalidate_counts)
 
-update_manager: UpdateManagerThreadBody = add_queries_ep(app, status_manager)
+# Opening hours of the building (closing time-ranges)
+calendar = BuildingCalendar(app, shared_state)
 
-glob_stat = GlobalStatus(update_manager, status_manager)
+# Anomalous activity detector for closing time-ranges (armed by the scheduler leader, fed by Counts updates)
+close_alert = CloseTimeAlert(app, mail_manager, counts_engine, shared_state)
 
-scheduler = setup_periodic_tasks(app, mail_manager)
+glob_stat = GlobalStatus(update_manager, status_manager, counts_engine, ingest_spool, change_feed, close_alert)
 
-refresh_triggers = set()
-refresh_triggers.add('/')
+scheduler = setup_periodic_tasks(app, mail_manager, counts_engine, shared_state, query_cache, close_alert,
+                                 calendar)
 
 app.config['VIDEO_SRCS'] = fr_dict
 
@@ -88,17 +136,6 @@ app.config['ACCURACY'] = get_accuracy_mismatch_based(conf.ACCURACY_DAYS, session
 session.close()
 
 
-@app.before_request
-def refresh_broadcasted_counts():
-    # Refresh "broadcast counts" (UpdateManager.init_update)
-    if request.path in refresh_triggers:
-        # app.logger.info(f"UPDATE by: '{request.path}'")
-        try:
-            glob_stat.broadcast_counts()
-        except Exception as e:
-            with app.app_context():
-                app.logger.error(str(e))
-
 
 @app.route('/')
 @login_required
@@ -130,19 +167,11 @@ def update_status():
     if is_unauthorized('UPDATE_ENABLE', app):
         return 'unautorized to send update', 401
     try:
-        status_j = json.loads(request.data)
-    except Exception as e:
+        mu_update = decode_mucounts(request.data)
+    except MUCountsFormatError as e:
         # with app.app_context():
         app.logger.error(str(e) + '\n' + str(request.data))
-        return 'Fail to parse JSON', 400
-
-    mu_update = None
-    try:
-        mu_update = MUCounts(status_j)
-    except Exception as e:
-        # with app.app_context():
-        app.logger.error(str(e))
-        return 'MUCounts(status_j)' + str(e), 400
+        return f'Malformed MUCounts: {str(e)}', 400
 
     try:
         glob_stat.update_count(mu_update)
@@ -154,7 +183,38 @@ def update_status():
     return 'ACK', 200
 
 
-refresh_triggers.add('/reset_form')
+@app.route('/update/batch', methods=['POST'])
+@login_required
+def update_batch():
+    """
+    Endpoint exploited from MUs to send many Counts Estimations updates at once (e.g. backlog after a reconnection).
+    Body: JSON lines, one MUCounts for each line, each with a per-MU increasing `seq` number.
+    Already received sequence numbers are ignored, so a batch can be safely re-sent
+    :return: JSON {accepted, duplicates, high_water: {device_id: last_seq}}
+    """
+    if is_unauthorized('UPDATE_ENABLE', app):
+        return 'unautorized to send update', 401
+
+    updates = []
+    lines = [ln for ln in request.data.splitlines() if ln.strip()]
+    if len(lines) > conf.UPDATE_BATCH_MAX_LINES:
+        return f'Too many updates in batch (max {conf.UPDATE_BATCH_MAX_LINES})', 413
+    for i, line in enumerate(lines):
+        try:
+            updates.append(decode_mucounts(line, require_seq=True))
+        except MUCountsFormatError as e:
+            app.logger.error(f'Batch update line {i}: {str(e)}')
+            return f'Line {i}: {str(e)}', 400
+    if len(updates) == 0:
+        return 'Empty batch', 400
+
+    try:
+        result = glob_stat.update_count_batch(updates)
+    except Exception as e:
+        app.logger.error(str(e))
+        return 'glob_stat.update_count_batch(updates)' + str(e), 500
+
+    return json.dumps(result), 200
 
 
 @app.route('/reset_form', methods=['GET', 'POST'])
@@ -189,14 +249,13 @@ def reset_form_fn():
     return render_template('reset.html', form=form, msg=msg)
 
 
-def closedays_to_display(session):
+def closedays_to_display():
     """
     Utility function to retrieve closing days to view on GUI
-    :param session:
     :return:
     """
-    day_from = datetime.today() - timedelta(days=conf.CLOSE_DAYS_DISPLAY_RANGE[0])
-    close_days = get_next_closedays_set(day_from, conf.CLOSE_DAYS_DISPLAY_RANGE[1], session)
+    day_from = date.today() - timedelta(days=conf.CLOSE_DAYS_DISPLAY_RANGE[0])
+    close_days = query_cache.closedays(day_from, conf.CLOSE_DAYS_DISPLAY_RANGE[1])
     close_days = list(close_days)
     close_days.sort()
     return close_days
@@ -217,7 +276,7 @@ def closedays_form_fn():
     session = Session()
     close_days = []
     try:
-        close_days = closedays_to_display(session)
+        close_days = closedays_to_display()
     except Exception as e:
         session.close()
         msg = str(e)
@@ -246,7 +305,9 @@ def closedays_form_fn():
                 else:
                     msg = f'[!] Should be: "{date.today()}" < "{form.date1.label.text}" <= "{form.date2.label.text}" '
 
-            close_days = closedays_to_display(session)
+            query_cache.invalidate(KIND_CLOSEDAYS, everywhere=True)
+            calendar.close_days_changed(form.date1.data, max(form.date1.data, form.date2.data))
+            close_days = closedays_to_display()
         except IntegrityError:
             session.rollback()
             session.close()
@@ -296,6 +357,9 @@ def emails_manage_fn():
                     # session.add(user)
                     msg += f' Reset Password'
                 session.commit()
+                user_dir.changed()
+                if len(form.password.data) > 8:
+                    auth_cache.invalidate_user(username)
             else:
                 msg = f'User "{username}" NOT valid'
         except Exception as e:
@@ -315,17 +379,6 @@ def emails_manage_fn():
     return render_template('user_management.html', form=form, msg=msg, usr_email_ls=usr_email_ls)
 
 
-def stream_frame(img):
-    """
-    Utility function used to format byte string to be sent to Client's GUI
-    :param img:
-    :return:
-    """
-    res, buf = cv2.imencode('.jpg', img)
-    frame = buf.tobytes()
-    return (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-
-
 @app.route('/videogate/local/<id>', methods=['GET'])
 @login_required
 def stream_video_local(id):
@@ -338,38 +391,35 @@ def stream_video_local(id):
         return 'unauthorized', 401
     if id == 'all':
         def gen():
-            img = fr_dict.get_all_frames(2)
-            while img is not None:
+            seq = 0
+            composite = collage.get_composite()
+            while composite is not None:
                 t_send = time.time()
-                yield stream_frame(img)
-                img = fr_dict.get_all_frames(2)
-                if (time.time() - t_send) < (1 / 10):
-                    time.sleep(1 / 10)
-                    # print('.', end='')
-
-    elif not (id in fr_dict.get_streamers()):
+                if composite[0] != seq:
+                    seq, part = composite
+                    yield part
+                if (time.time() - t_send) < collage.period:
+                    time.sleep(collage.period)
+                composite = collage.get_composite()
+
+    elif fr_dict.get_broadcaster(id) is None:
         return 'Camera Offline', 404
         # return send_from_directory(os.path.join(app.root_path, 'static'),
         #                            'offline.gif', mimetype='image/gif')
     else:
+        broadcaster = fr_dict.get_broadcaster(id)
+
         def gen():
-            try:
-                img = fr_dict.get_frame(id)
-                while img is not None:
-                    yield stream_frame(img)
-                    img_prev = img
-                    img = fr_dict.get_frame_no_duplicate(id, img_prev)
-                    n_try = int(10 * conf.MU_IS_ALIVE_T / 2)
-                    while img is None:
-                        time.sleep(1 / 10)
-                        n_try -= 1
-                        if n_try < 0:
-                            raise Exception('Is the same frame for too long')
-                        img = fr_dict.get_frame_no_duplicate(id, img_prev)
-            except Exception as e:
-                with app.app_context():
-                    app.logger.error(str(e))
-            return None
+            seq = 0
+            while True:
+                # Shared, already formatted frame: wait for the next one
+                next_frame = broadcaster.wait_next(seq, conf.MU_IS_ALIVE_T / 2)
+                if next_frame is None:
+                    with app.app_context():
+                        app.logger.error(f'No more frames of {id}')
+                    return None
+                seq, part = next_frame
+                yield part
 
     try:
         return Response(stream_with_context(gen()),
@@ -402,6 +452,33 @@ def on_off_email(on_off):
     return render_template('enable_disable_email.html', is_enable=email_enabled)
 
 
+@app.route('/service_stats', methods=['GET'])
+@login_required
+def service_stats_ep():
+    """
+    Internal counters of Collector services
+    :return: JSON
+    """
+    if is_unauthorized('QRY_DEV_ENABLE', app):
+        return redirect('/unauthorized')
+    stats = {
+        'updates_broadcast': update_manager.get_stats(),
+        'ingest_spool': ingest_spool.get_stats(),
+        'counts_engine': counts_engine.get_stats(),
+        'change_feed': change_feed.get_stats(),
+        'frames': fr_dict.get_stats(),
+        'query_cache': query_cache.get_stats(),
+        'close_alert': close_alert.get_stats(),
+        'calendar': calendar.get_stats(),
+        'auth_cache': auth_cache.get_stats(),
+        'user_directory': user_dir.get_stats(),
+        'mail': mail_manager.dispatcher.get_stats(),
+        'liveness': status_manager.liveness.get_stats(),
+        'status_journal': status_journal.get_stats(),
+    }
+    return json.dumps(stats), 200
+
+
 @app.route('/accuracy', methods=['GET'])
 @login_required
 def accuracy_ep():
@@ -409,24 +486,52 @@ def accuracy_ep():
     return accuracy, 200
 
 
+def start_leader_services():
+    """
+    Start services that must run in a single Collector process: periodic tasks (reports, alerts)
+    :return:
+    """
+    if scheduler.running:
+        # Leadership acquired again, after a loss
+        scheduler.resume()
+        return
+    scheduler.start()
+
+    boot_time = datetime.now().replace(microsecond=0)
+    mail_manager.broadcast_alert_email(f'GIO-Counter: START', f'Server reboot @ {str(boot_time)}')
+
+
+def stop_leader_services():
+    """
+    Stop periodic tasks, when the leadership is lost (another process can take it over)
+    :return:
+    """
+    if scheduler.running:
+        scheduler.pause()
+
+
 @app.before_first_request
 def init_setup():
     """
-    Setup and start Collectors threads
+    Setup and start Collectors threads.
+    WebSocket servers run in one process per host, periodic tasks in one process overall (shared-state leaderships)
     :return:
     """
-    gatherer = VideoGatherThreadBody(f_dict=fr_dict, cert_file=conf.ssl_cert, key_file=conf.ssl_key)
-    th_gather = Thread(target=gatherer)
-    th_gather.start()
+    shared_state.on_leadership(LEAD_NET, net_service.start, on_lost=net_service.stop)
+    shared_state.on_leadership(LEAD_SCHEDULER, start_leader_services, on_lost=stop_leader_services)
+    shared_state.start()
 
     th_status_manager = Thread(target=status_manager)
     th_status_manager.start()
 
-    th_msg_man = Thread(target=msg_man)
-    th_msg_man.start()
+    th_write_behind = Thread(target=write_behind)
+    th_write_behind.start()
 
-    boot_time = datetime.now().replace(microsecond=0)
-    mail_manager.broadcast_alert_email(f'GIO-Counter: START', f'Server reboot @ {str(boot_time)}')
+    th_mail_dispatcher = Thread(target=mail_manager.dispatcher)
+    th_mail_dispatcher.start()
+
+    th_status_journal = Thread(target=status_journal)
+    th_status_journal.start()
 
     with app.app_context():
         app.logger.setLevel(logging.INFO)
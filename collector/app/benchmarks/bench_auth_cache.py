@@ -0,0 +1,87 @@
+"""
+Benchmark: authenticated MU requests per second, with HTTP Basic auth (password hash verified on each request),
+with the credentials cache, and with HMAC-signed requests.
+Run from collector/app:  python benchmarks/bench_auth_cache.py
+"""
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from flask_login import login_required
+
+import utils.auth_cache
+from endpoints.login import login_setup
+from utils.auth_cache import SIGNATURE_HEADER, sign_request
+
+USERNAME, PASSWORD, KEY = 'mu_bench', 'mu_bench_password', 'mu_bench_key'
+
+
+def make_app(db_path):
+    app = Flask(__name__)
+    db, User, auth_cache, _ = login_setup(app)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+
+    @app.route('/update', methods=['POST'])
+    @login_required
+    def update():
+        return 'ok', 200
+
+    with app.app_context():
+        db.create_all()
+        user = User(username=USERNAME, email='mu_bench@localhost')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+    return app, auth_cache
+
+
+def make_body(seq):
+    return json.dumps({'device_id': USERNAME, 'seq': seq, 'entrances': [[1, int(time.time())]], 'exits': []}).encode()
+
+
+def run(client, headers_fn, seconds=3.0):
+    """
+    :param headers_fn: function(body) that return the request headers
+    :return: Requests per second
+    """
+    n, t_start = 0, time.perf_counter()
+    while time.perf_counter() - t_start < seconds:
+        # Distinct bodies: identical signed requests would be rejected as replays
+        body = make_body(n)
+        r = client.post('/update', data=body, headers=headers_fn(body))
+        assert r.status_code == 200, r.status_code
+        n += 1
+    return n / (time.perf_counter() - t_start)
+
+
+def main():
+    basic = {'Authorization': 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()}
+    utils.auth_cache.MU_AUTH_KEYS[USERNAME] = KEY
+
+    def signed(body):
+        ts = int(time.time())
+        return {SIGNATURE_HEADER: f'{USERNAME}:{ts}:{sign_request(KEY, ts, "POST", "/update", body)}'}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app, auth_cache = make_app(os.path.join(tmp, 'users.db'))
+        client = app.test_client()
+        max_entries = auth_cache.max_entries
+        auth_cache.max_entries = 0
+        no_cache = run(client, lambda body: basic)
+        auth_cache.max_entries = max_entries
+        cached = run(client, lambda body: basic)
+        hmac_signed = run(client, signed)
+    print(f'{"mode":>14} {"req/s":>10} {"speedup":>8}')
+    for name, rps in (('basic', no_cache), ('basic+cache', cached), ('hmac-signed', hmac_signed)):
+        print(f'{name:>14} {rps:>10.1f} {rps / no_cache:>7.2f}x')
+    print(f'cache stats: {auth_cache.get_stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark: MU update decoding, current path (json + MUCounts + per-timestamp aggregation) vs fast decoder.
+Run from collector/app:  python benchmarks/bench_mucounts_decoder.py
+"""
+import json
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from net_io.mucounts import MUCounts
+from net_io.mucounts_decoder import decode_mucounts, orjson
+
+
+def make_payload(n_evts, t_span=60):
+    """
+    :param n_evts: Number of Entrances + Exits estimations
+    :param t_span: seconds covered by the update
+    :return: bytes of a MU update JSON message
+    """
+    t0 = int(time.time())
+    evts = [[random.randint(1, 3), t0 + random.randrange(t_span)] for _ in range(n_evts)]
+    half = n_evts // 2
+    return json.dumps({'device_id': 'gate_bench', 'entrances': evts[:half], 'exits': evts[half:]}).encode()
+
+
+def current_path(data):
+    return MUCounts(json.loads(data)).get_records()
+
+
+def fast_path(data):
+    return decode_mucounts(data).get_records()
+
+
+def main():
+    print(f'JSON backend: {"orjson" if orjson is not None else "json (stdlib)"}')
+    print(f'{"events":>8} {"bytes":>8} {"current us":>12} {"fast us":>10} {"speedup":>8}')
+    for n_evts in (2, 10, 100, 1000, 10000):
+        data = make_payload(n_evts)
+        assert sorted(current_path(data)) == sorted(fast_path(data))
+        number = max(10, 200000 // (n_evts + 10))
+        t_cur = min(timeit.repeat(lambda: current_path(data), number=number, repeat=5)) / number
+        t_fast = min(timeit.repeat(lambda: fast_path(data), number=number, repeat=5)) / number
+        print(f'{n_evts:>8} {len(data):>8} {t_cur * 1e6:>12.1f} {t_fast * 1e6:>10.1f} {t_cur / t_fast:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -75,7 +75,6 @@ H_DAILY_REPORT = 0
 H_NIGHT_REPORT = 0
 
 WEEK_CLOSE_DAYS = []  # 0='mon' --- 6='sun'
-INST_ALERT_REFRESH_RATE = 1
 INST_ALERT_RENEW_RANGE_H = 1
 INST_ALERT_TRIGGER_P_NUM = 1
 
@@ -84,3 +83,97 @@ MU_IS_ALIVE_T = 10
 ACCURACY_DAYS = 90
 
 video_token = secrets_conf.video_token
+
+COUNTS_CHECK_INTERVAL_MIN = 60
+
+INGEST_SPOOL_DIR = './ingest_spool'
+INGEST_FLUSH_ROWS = 500
+INGEST_FLUSH_INTERVAL_S = 1
+INGEST_SPOOL_FSYNC = True
+
+PEOPLE_COUNTS_PARTITIONED = False
+PEOPLE_COUNTS_PARTITION_DAYS_AHEAD = 7
+
+# Debug-stream "all cameras" mosaic: number of columns, (width, height) of each tile, max composite rate
+COLLAGE_N_COL = 2
+COLLAGE_CELL_SIZE = (480, 360)
+COLLAGE_FPS = 10
+
+# Debug-frames store: last frames kept for each MU, max total size (bytes) of stored frames
+FRAMES_RING_SIZE = 8
+FRAMES_MAX_BYTES = 64 * 2 ** 20
+
+# Counts broadcasts to dashboards: requests within this window (seconds) are coalesced in a single send
+UPDATES_COALESCE_WINDOW_S = 0.2
+
+# State shared among Collector processes: 'inprocess' (single process) | 'postgres' (N gunicorn workers/replicas)
+SHARED_STATE_BACKEND = 'inprocess'
+# Period (seconds) of shared liveness/frames sync and leadership attempts ('postgres' backend)
+SHARED_STATE_SYNC_S = 0.5
+
+# Max size of a Counts change-feed notification (Postgres NOTIFY payload < 8000 bytes): bigger batches make the other
+# Collector processes reload their totals from the DB
+CHANGE_FEED_MAX_PAYLOAD = 7000
+
+# Max number of MU updates (JSON lines) accepted in a single /update/batch request
+UPDATE_BATCH_MAX_LINES = 10000
+
+# Cache of web-tier DB queries results (Counts time-ranges, close days): max age (seconds) and max number of results
+QUERY_CACHE_TTL_S = 60
+QUERY_CACHE_MAX_ENTRIES = 512
+
+# Building opening-hours calendar: number of days of precomputed closing time-ranges
+CALENDAR_HORIZON_DAYS = 60
+
+# Events API (/api/events/...): default and max page size, rows fetched for each round trip of server-side cursors
+EVENTS_PAGE_SIZE = 500
+EVENTS_MAX_PAGE_SIZE = 10000
+EVENTS_YIELD_PER = 1000
+
+# Background exports: result files dir, worker threads, hours before results removal, Parquet row-group size,
+# period (seconds) of progress updates
+EXPORT_DIR = 'exports'
+EXPORT_WORKERS = 2
+EXPORT_KEEP_H = 24
+EXPORT_BATCH_ROWS = 10000
+EXPORT_PROGRESS_S = 1
+
+# Occupancy analytics (/analytics/occupancy): default bucket size (seconds), max number of buckets of a request
+ANALYTICS_DEFAULT_BUCKET_S = 300
+ANALYTICS_MAX_BUCKETS = 20000
+
+# MUs HTTP Basic credentials cache: max age (seconds) of a verification, max number of cached verifications
+AUTH_CACHE_TTL_S = 300
+AUTH_CACHE_MAX_ENTRIES = 1024
+
+# HMAC-signed MU requests (header X-MU-Signature): {username: secret key}, max clock skew (seconds) of signatures
+MU_AUTH_KEYS = secrets_conf.MU_AUTH_KEYS
+AUTH_SIGNATURE_MAX_SKEW_S = 60
+
+# Login sessions: min period (seconds) between renewals of the session expiry (each one re-issues the cookie)
+SESSION_REFRESH_S = 60
+
+# Mail dispatcher: max queued mails, coalescing window (seconds) of alert digests, idle seconds before closing the
+# SMTP connection, send retries and their backoff (seconds, doubled at each retry up to the max)
+MAIL_QUEUE_SIZE = 1000
+MAIL_DIGEST_WINDOW_S = 30
+MAIL_SMTP_IDLE_S = 60
+MAIL_MAX_RETRIES = 5
+MAIL_BACKOFF_S = 5
+MAIL_BACKOFF_MAX_S = 300
+
+# MUs status events journal: max queued events, max records for each insert batch, max seconds before queued events
+# are written; max seconds between a MU disconnection and its reconnection to count a flap
+STATUS_JOURNAL_QUEUE_SIZE = 10000
+STATUS_JOURNAL_BATCH_ROWS = 200
+STATUS_JOURNAL_FLUSH_S = 1
+MU_FLAP_WINDOW_S = 300
+
+# Failed DB writes (other than DB outages) of an ingestion spool segment, before it is moved to quarantine
+INGEST_SEGMENT_MAX_FAILURES = 5
+
+# MU status journal: failed writes of a batch (DB reachable) before its records are written one by one
+STATUS_JOURNAL_MAX_FAILURES = 3
+
+# Interval (hours) of the job that creates the Counts daily partitions ahead (see PEOPLE_COUNTS_PARTITION_DAYS_AHEAD)
+PEOPLE_COUNTS_PARTITION_CHECK_H = 6
@@ -42,3 +42,6 @@ ALL_UNITS = {os.getenv(''),
              }
 
 video_token = os.getenv('')
+
+# Secret keys of MUs sending HMAC-signed requests, e.g. {os.getenv(...): os.getenv(...)}
+MU_AUTH_KEYS = {}
@@ -0,0 +1,43 @@
+from sqlalchemy.dialects.postgresql import insert
+
+from db.people_count import PeopleCounts
+from db.people_count_rollups import ROLLUP_TABLES
+
+
+def rollup_deltas(rows, bucket_size):
+    """
+    Aggregate Counts records by (gate, time bucket)
+    :param rows: List of (timestamp, gate_id, p_in, p_out) tuples
+    :param bucket_size: bucket length in seconds
+    :return: List of {'gate_id', 'bucket', 'in', 'out'} dicts, sorted by key
+    """
+    deltas = {}
+    for t, gate_id, p_in, p_out in rows:
+        t = int(t)
+        key = (gate_id, t - t % bucket_size)
+        d = deltas.setdefault(key, [0, 0])
+        d[0] += p_in
+        d[1] += p_out
+    return [{'gate_id': k[0], 'bucket': k[1], 'in': d[0], 'out': d[1]} for k, d in sorted(deltas.items())]
+
+
+def write_count_rows(session, rows):
+    """
+    Bulk insert of Counts records (a single multi-row INSERT statement), and incremental update of the
+    minute/hour/day rollup tables. The caller is in charge of the commit
+    :param session: Already initialised DB-session
+    :param rows: List of (timestamp, gate_id, p_in, p_out) tuples
+    :return:
+    """
+    if len(rows) == 0:
+        return
+    values = [{'timestamp': int(t), 'gate_id': gate_id, 'in': p_in, 'out': p_out} for t, gate_id, p_in, p_out in rows]
+    session.execute(PeopleCounts.__table__.insert(), values)
+
+    for rollup in ROLLUP_TABLES:
+        table = rollup.__table__
+        stmt = insert(table).values(rollup_deltas(rows, rollup.bucket_size))
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.gate_id, table.c.bucket],
+                                          set_={'in': table.c['in'] + stmt.excluded['in'],
+                                                'out': table.c['out'] + stmt.excluded['out']})
+        session.execute(stmt)
@@ -1,14 +1,33 @@
 from db.db_closedays import CloseDayRecord
+from db.ingest_batch import IngestBatchRecord
 from db.db_mismatch import MismatchRecord
+from db.export_job import ExportJobRecord
 from db.monitorunitstatus import MonitorUnitStatusRecord
+from db.mu_sequence import MUSequenceRecord
 from db.people_count import PeopleCounts
+from db.people_count_rollups import PeopleCountsMinute, PeopleCountsHour, PeopleCountsDay
+from db.schema_version import SchemaVersionRecord
+from db.shared_state import SharedUnitRecord, SharedFrameSlot, SharedSetMember, SharedClaim
+from db.migrations import run_migrations
 from db.db_base import Base, engine
 
 CloseDayRecord
+IngestBatchRecord
 MismatchRecord
+ExportJobRecord
 PeopleCounts
+PeopleCountsMinute
+PeopleCountsHour
+PeopleCountsDay
 MonitorUnitStatusRecord
+MUSequenceRecord
+SchemaVersionRecord
+SharedUnitRecord
+SharedFrameSlot
+SharedSetMember
+SharedClaim
 
 
 def create_all_tables():
     Base.metadata.create_all(engine)
+    run_migrations()
@@ -0,0 +1,44 @@
+from db.db_base import Base
+from sqlalchemy import Column, String, BigInteger, Float
+
+
+class ExportJobRecord(Base):
+    """
+    Background export job (visible to all Collector processes, the result file is on the `owner` host)
+    """
+    __tablename__ = 'export_jobs'
+    job_id = Column('job_id', String(32), primary_key=True)
+    owner = Column('owner', String(64))
+    table = Column('table', String(32))
+    fmt = Column('fmt', String(16))
+    device = Column('device', String(32))
+    ts_from = Column('ts_from', BigInteger)
+    ts_to = Column('ts_to', BigInteger)
+    state = Column('state', String(16))
+    rows = Column('rows', BigInteger)
+    total_rows = Column('total_rows', BigInteger)
+    n_bytes = Column('n_bytes', BigInteger)
+    path = Column('path', String(256))
+    error = Column('error', String(256))
+    t_created = Column('t_created', Float)
+    t_done = Column('t_done', Float)
+
+    def __init__(self, job_id, owner, table, fmt, device, ts_from, ts_to, t_created):
+        self.job_id = job_id
+        self.owner = owner
+        self.table = table
+        self.fmt = fmt
+        self.device = device
+        self.ts_from = ts_from
+        self.ts_to = ts_to
+        self.state = 'queued'
+        self.rows = 0
+        self.total_rows = None
+        self.n_bytes = 0
+        self.t_created = t_created
+
+    def to_dict(self):
+        return {'job_id': self.job_id, 'table': self.table, 'format': self.fmt, 'device': self.device,
+                'from': self.ts_from, 'to': self.ts_to, 'state': self.state, 'rows': self.rows,
+                'total_rows': self.total_rows, 'bytes': self.n_bytes, 'error': self.error,
+                't_created': self.t_created, 't_done': self.t_done}
@@ -0,0 +1,15 @@
+from db.db_base import Base
+from sqlalchemy import Column, Integer, String, Numeric
+
+
+class IngestBatchRecord(Base):
+    __tablename__ = 'ingest_batches'
+    id = Column(Integer, primary_key=True)
+    segment = Column('segment', String(64), unique=True)
+    timestamp = Column('timestamp', Numeric)
+    n_rows = Column('n_rows', Integer)
+
+    def __init__(self, segment, timestamp, n_rows):
+        self.segment = segment
+        self.timestamp = timestamp
+        self.n_rows = n_rows
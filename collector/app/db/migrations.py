@@ -0,0 +1,124 @@
+import time
+from datetime import date
+
+from sqlalchemy import text
+
+from db.db_base import engine
+from db.partitions import TABLE, DEFAULT_PARTITION, ensure_partitions, is_partitioned
+from db.people_count_rollups import ROLLUP_TABLES
+from db.schema_version import SchemaVersionRecord
+
+from configs.config import PEOPLE_COUNTS_PARTITIONED, PEOPLE_COUNTS_PARTITION_DAYS_AHEAD
+
+# Arbitrary key of the advisory lock that serialize migrations among Collector processes
+MIGRATIONS_LOCK_ID = 4711
+
+
+def _column_type(conn, table, column):
+    return conn.execute(text("SELECT data_type FROM information_schema.columns "
+                             "WHERE table_name = :table AND column_name = :column"),
+                        {'table': table, 'column': column}).scalar()
+
+
+def people_counts_bigint_timestamp(conn):
+    """
+    `people_counts.timestamp`: Numeric -> BigInteger (epoch seconds)
+    """
+    if _column_type(conn, TABLE, 'timestamp') != 'bigint':
+        conn.execute(text(f'ALTER TABLE "{TABLE}" ALTER COLUMN "timestamp" TYPE BIGINT USING "timestamp"::bigint'))
+
+
+def people_counts_indexes(conn):
+    """
+    Indexes for time-range queries, for all/single gate
+    """
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_people_counts_timestamp ON "{TABLE}" ("timestamp")'))
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_people_counts_gate_timestamp ON "{TABLE}" (gate_id, "timestamp")'))
+
+
+def people_counts_partitioning(conn):
+    """
+    Convert `people_counts` into a table range-partitioned by day on `timestamp`.
+    Existing records are copied into the new daily partitions (a default partition keeps out-of-range records)
+    """
+    if is_partitioned(conn):
+        return
+    old_table = f'{TABLE}_unpartitioned'
+    conn.execute(text(f'ALTER TABLE "{TABLE}" RENAME TO "{old_table}"'))
+    conn.execute(text(f'ALTER INDEX IF EXISTS ix_people_counts_timestamp RENAME TO ix_{old_table}_timestamp'))
+    conn.execute(text(f'ALTER INDEX IF EXISTS ix_people_counts_gate_timestamp RENAME TO ix_{old_table}_gate_timestamp'))
+    conn.execute(text(f'ALTER TABLE "{old_table}" RENAME CONSTRAINT {TABLE}_pkey TO {old_table}_pkey'))
+
+    conn.execute(text(f'CREATE TABLE "{TABLE}" ('
+                      f'id INTEGER NOT NULL DEFAULT nextval(\'{TABLE}_id_seq\'), '
+                      f'gate_id VARCHAR(32), '
+                      f'"timestamp" BIGINT NOT NULL, '
+                      f'"in" INTEGER, '
+                      f'"out" INTEGER, '
+                      f'PRIMARY KEY (id, "timestamp")'
+                      f') PARTITION BY RANGE ("timestamp")'))
+    conn.execute(text(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT'))
+    people_counts_indexes(conn)
+
+    t_min = conn.execute(text(f'SELECT min("timestamp") FROM "{old_table}"')).scalar()
+    from_day = date.today() if t_min is None else min(date.fromtimestamp(int(t_min)), date.today())
+    ensure_partitions(conn, from_day, (date.today() - from_day).days + PEOPLE_COUNTS_PARTITION_DAYS_AHEAD)
+
+    conn.execute(text(f'INSERT INTO "{TABLE}" (id, gate_id, "timestamp", "in", "out") '
+                      f'SELECT id, gate_id, "timestamp", "in", "out" FROM "{old_table}" '
+                      f'WHERE "timestamp" IS NOT NULL'))
+    conn.execute(text(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY "{TABLE}".id'))
+    conn.execute(text(f'DROP TABLE "{old_table}"'))
+
+
+def people_counts_rollups_backfill(conn):
+    """
+    Fill minute/hour/day rollup tables with already stored Counts records
+    """
+    for rollup in ROLLUP_TABLES:
+        size = rollup.bucket_size
+        conn.execute(text(f'INSERT INTO "{rollup.__tablename__}" (gate_id, bucket, "in", "out") '
+                          f'SELECT coalesce(gate_id, \'\'), "timestamp" - "timestamp" % {size}, '
+                          f'coalesce(sum("in"), 0), coalesce(sum("out"), 0) '
+                          f'FROM "{TABLE}" WHERE "timestamp" IS NOT NULL GROUP BY 1, 2 '
+                          f'ON CONFLICT (gate_id, bucket) DO UPDATE SET "in" = excluded."in", "out" = excluded."out"'))
+
+
+# Ordered list of all schema migrations: (version, name, function, enabled)
+MIGRATIONS = [
+    (1, 'people_counts_bigint_timestamp', people_counts_bigint_timestamp, True),
+    (2, 'people_counts_indexes', people_counts_indexes, True),
+    (3, 'people_counts_partitioning', people_counts_partitioning, PEOPLE_COUNTS_PARTITIONED),
+    (4, 'people_counts_rollups_backfill', people_counts_rollups_backfill, True),
+]
+
+
+def run_migrations():
+    """
+    Apply, in order, all enabled migrations not yet recorded in `schema_version` table.
+    Each migration runs in its own transaction, together with its version record.
+    :return: List of applied migrations names
+    """
+    applied = []
+    with engine.connect() as lock_conn:
+        lock_conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATIONS_LOCK_ID})
+        try:
+            for version, name, migration, enabled in MIGRATIONS:
+                if not enabled:
+                    continue
+                with engine.begin() as conn:
+                    done = conn.execute(SchemaVersionRecord.__table__.select().where(
+                        SchemaVersionRecord.version == version)).first()
+                    if done:
+                        continue
+                    migration(conn)
+                    conn.execute(SchemaVersionRecord.__table__.insert(),
+                                 {'version': version, 'name': name, 'timestamp': time.time()})
+                applied.append(name)
+
+            if PEOPLE_COUNTS_PARTITIONED:
+                with engine.begin() as conn:
+                    ensure_partitions(conn, date.today(), PEOPLE_COUNTS_PARTITION_DAYS_AHEAD)
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATIONS_LOCK_ID})
+    return applied
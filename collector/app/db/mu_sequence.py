@@ -0,0 +1,17 @@
+from db.db_base import Base
+from sqlalchemy import Column, String, BigInteger, Numeric
+
+
+class MUSequenceRecord(Base):
+    """
+    High-water mark of the batched updates sequence numbers, for each MU
+    """
+    __tablename__ = 'mu_sequences'
+    device_id = Column('device_id', String(32), primary_key=True)
+    last_seq = Column('last_seq', BigInteger)
+    timestamp = Column('timestamp', Numeric)
+
+    def __init__(self, device_id, last_seq, timestamp):
+        self.device_id = device_id
+        self.last_seq = last_seq
+        self.timestamp = timestamp
@@ -0,0 +1,104 @@
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import text
+
+from db.people_count import PeopleCounts
+
+TABLE = PeopleCounts.__tablename__
+PARTITION_PREFIX = f'{TABLE}_p'
+DEFAULT_PARTITION = f'{TABLE}_pdefault'
+
+
+def day_range(day: date):
+    """
+    :param day:
+    :return: epoch Tuple (local_midnight, next_local_midnight) of the given day
+    """
+    t_start = int(datetime.combine(day, time()).timestamp())
+    t_end = int(datetime.combine(day + timedelta(days=1), time()).timestamp())
+    return t_start, t_end
+
+
+def partition_name(day: date):
+    return f'{PARTITION_PREFIX}{day.strftime("%Y%m%d")}'
+
+
+def is_partitioned(conn):
+    """
+    :param conn: DB connection or session
+    :return: True if `people_counts` is a range-partitioned table
+    """
+    res = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = :name"), {'name': TABLE}).first()
+    return res is not None and res[0] == 'p'
+
+
+def list_partitions(conn):
+    """
+    :param conn: DB connection or session
+    :return: sorted List of (day, partition_name) of all daily partitions
+    """
+    res = conn.execute(text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                            "WHERE i.inhparent = CAST(:parent AS regclass)"), {'parent': TABLE}).all()
+    parts = []
+    for row in res:
+        name = row[0]
+        if name == DEFAULT_PARTITION or not name.startswith(PARTITION_PREFIX):
+            continue
+        day = datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m%d').date()
+        parts.append((day, name))
+    parts.sort()
+    return parts
+
+
+def create_day_partition(conn, day: date):
+    """
+    Create and attach the partition for a given day. Records of that day already stored in the default partition
+    are moved to the new partition; the default partition is locked until commit, so that no record of that day can
+    be inserted there before the partition is attached
+    :param conn: DB connection or session
+    :param day:
+    :return:
+    """
+    name = partition_name(day)
+    t_start, t_end = day_range(day)
+    conn.execute(text(f'LOCK TABLE "{DEFAULT_PARTITION}" IN ACCESS EXCLUSIVE MODE'))
+    conn.execute(text(f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS)'))
+    conn.execute(text(f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" '
+                      f'WHERE "timestamp" >= :t_start AND "timestamp" < :t_end RETURNING *) '
+                      f'INSERT INTO "{name}" SELECT * FROM moved'), {'t_start': t_start, 't_end': t_end})
+    conn.execute(text(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM ({t_start}) TO ({t_end})'))
+
+
+def ensure_partitions(conn, from_day: date, n_days: int):
+    """
+    Create all missing daily partitions from `from_day` to `from_day + n_days`
+    :param conn: DB connection or session
+    :param from_day:
+    :param n_days:
+    :return: Number of created partitions
+    """
+    existing = {day for day, _ in list_partitions(conn)}
+    n_created = 0
+    for i in range(n_days + 1):
+        day = from_day + timedelta(days=i)
+        if day not in existing:
+            create_day_partition(conn, day)
+            n_created += 1
+    return n_created
+
+
+def drop_partitions_before(conn, from_dt: datetime):
+    """
+    Drop all daily partitions entirely older than `from_dt`
+    :param conn: DB connection or session
+    :param from_dt:
+    :return: Number of records dropped
+    """
+    n_dropped = 0
+    for day, name in list_partitions(conn):
+        _, t_end = day_range(day)
+        if t_end > int(from_dt.timestamp()):
+            break
+        n_dropped += conn.execute(text(f'SELECT count(*) FROM "{name}"')).scalar()
+        conn.execute(text(f'DROP TABLE "{name}"'))
+    return n_dropped
@@ -1,13 +1,17 @@
 from db.db_base import Base
-from sqlalchemy import Column, Integer, String, Numeric
+from sqlalchemy import Column, Integer, String, BigInteger, Index
 
 
 # {unique_ID, gate_id, timestamp, in#, out#, diff}
 class PeopleCounts(Base):
     __tablename__ = 'people_counts'
+    __table_args__ = (
+        Index('ix_people_counts_timestamp', 'timestamp'),
+        Index('ix_people_counts_gate_timestamp', 'gate_id', 'timestamp'),
+    )
     id = Column(Integer, primary_key=True)
     gate_id = Column('gate_id', String(32))
-    timestamp = Column('timestamp', Numeric)
+    timestamp = Column('timestamp', BigInteger)
     entered = Column('in', Integer)
     exited = Column('out', Integer)
 
@@ -0,0 +1,31 @@
+from db.db_base import Base
+from sqlalchemy import Column, Integer, String, BigInteger
+
+
+class RollupColumns:
+    """
+    Columns shared by all Counts rollup tables: sum of Entrances/Exits of a gate in a time bucket
+    """
+    gate_id = Column('gate_id', String(32), primary_key=True)
+    bucket = Column('bucket', BigInteger, primary_key=True)
+    entered = Column('in', Integer)
+    exited = Column('out', Integer)
+
+
+class PeopleCountsMinute(RollupColumns, Base):
+    __tablename__ = 'people_counts_minute'
+    bucket_size = 60
+
+
+class PeopleCountsHour(RollupColumns, Base):
+    __tablename__ = 'people_counts_hour'
+    bucket_size = 60 * 60
+
+
+class PeopleCountsDay(RollupColumns, Base):
+    __tablename__ = 'people_counts_day'
+    bucket_size = 24 * 60 * 60
+
+
+# From the coarsest to the finest granularity
+ROLLUP_TABLES = [PeopleCountsDay, PeopleCountsHour, PeopleCountsMinute]
@@ -0,0 +1,14 @@
+from db.db_base import Base
+from sqlalchemy import Column, Integer, String, Numeric
+
+
+class SchemaVersionRecord(Base):
+    __tablename__ = 'schema_version'
+    version = Column('version', Integer, primary_key=True, autoincrement=False)
+    name = Column('name', String(64))
+    timestamp = Column('timestamp', Numeric)
+
+    def __init__(self, version, name, timestamp):
+        self.version = version
+        self.name = name
+        self.timestamp = timestamp
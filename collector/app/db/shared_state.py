@@ -0,0 +1,61 @@
+from db.db_base import Base
+from sqlalchemy import Column, String, Float, BigInteger, SmallInteger, LargeBinary, Index
+
+
+class SharedUnitRecord(Base):
+    """
+    Last time each MU was seen by any Collector process
+    """
+    __tablename__ = 'shared_mu_liveness'
+    device_id = Column('device_id', String(32), primary_key=True)
+    t_seen = Column('t_seen', Float)
+
+    def __init__(self, device_id, t_seen):
+        self.device_id = device_id
+        self.t_seen = t_seen
+
+
+class SharedFrameSlot(Base):
+    """
+    Last debug-frame of each MU, written by the Collector process that receives its stream
+    """
+    __tablename__ = 'shared_frame_slots'
+    device_id = Column('device_id', String(32), primary_key=True)
+    owner = Column('owner', String(64))
+    seq = Column('seq', BigInteger)
+    codec = Column('codec', SmallInteger)
+    t_update = Column('t_update', Float)
+    data = Column('data', LargeBinary)
+
+    __table_args__ = (Index('ix_shared_frame_slots_t_update', 't_update'),)
+
+
+class SharedSetMember(Base):
+    """
+    Members of named sets shared among Collector processes (e.g. no-disturb users)
+    """
+    __tablename__ = 'shared_sets'
+    name = Column('name', String(32), primary_key=True)
+    member = Column('member', String(64), primary_key=True)
+
+    def __init__(self, name, member):
+        self.name = name
+        self.member = member
+
+
+class SharedClaim(Base):
+    """
+    Members of expiring named sets shared among Collector processes, each one claimed by a single process (e.g.
+    accepted request signatures)
+    """
+    __tablename__ = 'shared_claims'
+    name = Column('name', String(32), primary_key=True)
+    member = Column('member', String(160), primary_key=True)
+    t_expire = Column('t_expire', Float)
+
+    __table_args__ = (Index('ix_shared_claims_t_expire', 't_expire'),)
+
+    def __init__(self, name, member, t_expire):
+        self.name = name
+        self.member = member
+        self.t_expire = t_expire
@@ -0,0 +1,161 @@
+import json
+from datetime import datetime
+
+import numpy as np
+from flask import Flask, request
+from flask_login import login_required
+from sqlalchemy import select, and_
+
+from db.db_base import Session
+from db.people_count import PeopleCounts
+from endpoints.unauth_check import is_unauthorized
+from endpoints.events_api import parse_time_arg
+from endpoints.queries_utils import get_now_timerange
+
+from configs.config import RESET_RECORD_NAME, ANALYTICS_DEFAULT_BUCKET_S, ANALYTICS_MAX_BUCKETS
+
+
+def counts_windows(t_start: int, t_end: int):
+    """
+    Boundaries of the daily Counts time-ranges (see `NOW_TIMERANGE`) that cover [t_start, t_end): the people count
+    restarts from 0 at each of them
+    :param t_start:
+    :param t_end:
+    :return: Sorted int64 array of boundaries, the first one <= t_start and the last one >= t_end
+    """
+    dt_1, _ = get_now_timerange(datetime.fromtimestamp(t_start))
+    bounds = [int(dt_1.timestamp())]
+    while bounds[-1] < t_end:
+        _, dt_2 = get_now_timerange(datetime.fromtimestamp(bounds[-1] + 1))
+        bounds.append(int(dt_2.timestamp()))
+    return np.asarray(bounds, dtype=np.int64)
+
+
+def load_counts_arrays(t_start: int, t_end: int, session):
+    """
+    Load Counts records in [t_start, t_end) with a single query
+    :return: (gate_ids, timestamps, entered, exited) arrays, sorted by timestamp
+    """
+    sel = select(PeopleCounts.gate_id, PeopleCounts.timestamp, PeopleCounts.entered, PeopleCounts.exited) \
+        .where(and_(PeopleCounts.timestamp >= t_start, PeopleCounts.timestamp < t_end)) \
+        .order_by(PeopleCounts.timestamp)
+    rows = session.execute(sel).fetchall()
+    if len(rows) == 0:
+        return np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), \
+            np.empty(0, dtype=np.int64)
+    gates, ts, p_in, p_out = zip(*rows)
+    return np.asarray(gates, dtype=object), np.asarray(ts, dtype=np.int64), \
+        np.asarray(p_in, dtype=np.int64), np.asarray(p_out, dtype=np.int64)
+
+
+def occupancy_analytics(gates, ts, p_in, p_out, bounds, t_start: int, t_end: int, bucket_s: int):
+    """
+    Occupancy curve, per-gate flows and peaks, computed on Counts arrays (sorted by timestamp) without Python loops
+    on records.
+    Occupancy is the running sum of (Entrances - Exits), reset records included, restarting at each Counts
+    time-range boundary; records before `t_start` (inside its time-range) give the initial occupancy.
+    :param gates: Gate's ID of each record
+    :param ts: Timestamps
+    :param p_in: Entrances
+    :param p_out: Exits
+    :param bounds: Counts time-ranges boundaries (`counts_windows()`)
+    :param t_start: Range start (aligned to `bucket_s`)
+    :param t_end: Range end
+    :param bucket_s: Bucket size (seconds)
+    :return: JSON-serializable dict
+    """
+    n_buckets = int(-(-(t_end - t_start) // bucket_s))
+    bucket_ends = t_start + bucket_s * np.arange(1, n_buckets + 1, dtype=np.int64)
+
+    # Running occupancy after each record, restarted at each time-range boundary
+    net = p_in - p_out
+    csum = np.cumsum(net)
+    rec_win = np.searchsorted(bounds, ts, side='right') - 1
+    win_first = np.searchsorted(ts, bounds[:-1], side='left')
+    win_base = np.concatenate(([0], csum))[win_first]
+    occ = csum - win_base[rec_win] if len(ts) > 0 else csum
+
+    # Occupancy at the end of each bucket: last record before it, if in the same time-range
+    last = np.searchsorted(ts, bucket_ends, side='left') - 1
+    end_win = np.searchsorted(bounds, bucket_ends - 1, side='right') - 1
+    valid = last >= 0
+    valid[valid] &= rec_win[last[valid]] == end_win[valid]
+    curve = np.where(valid, occ[np.maximum(last, 0)] if len(ts) > 0 else 0, 0)
+
+    in_range = ts >= t_start
+    is_reset = gates == RESET_RECORD_NAME
+    flow = in_range & ~is_reset
+    bucket = (ts[flow] - t_start) // bucket_s
+
+    # Per-gate Entrances/Exits for each bucket
+    gate_ids, gate_idx = np.unique(gates[flow], return_inverse=True)
+    n_gates = len(gate_ids)
+    flat = gate_idx * n_buckets + bucket
+    in_g = np.bincount(flat, weights=p_in[flow], minlength=n_gates * n_buckets).astype(np.int64)
+    out_g = np.bincount(flat, weights=p_out[flow], minlength=n_gates * n_buckets).astype(np.int64)
+    in_g = in_g.reshape(n_gates, n_buckets)
+    out_g = out_g.reshape(n_gates, n_buckets)
+
+    per_gate = {}
+    for i, gate_id in enumerate(gate_ids):
+        per_gate[gate_id] = {'in': in_g[i].tolist(), 'out': out_g[i].tolist(),
+                             'tot_in': int(in_g[i].sum()), 'tot_out': int(out_g[i].sum()),
+                             'peak_in_per_min': round(float(in_g[i].max()) * 60 / bucket_s, 2),
+                             'peak_out_per_min': round(float(out_g[i].max()) * 60 / bucket_s, 2)}
+
+    # Peaks: overall, and for each time-range
+    peaks = []
+    occ_r, ts_r, win_r = occ[in_range], ts[in_range], rec_win[in_range]
+    if len(occ_r) > 0:
+        starts = np.flatnonzero(np.concatenate(([True], win_r[1:] != win_r[:-1])))
+        win_max = np.maximum.reduceat(occ_r, starts)
+        for k, i in enumerate(starts):
+            j = i + int(np.argmax(occ_r[i:starts[k + 1]] if k + 1 < len(starts) else occ_r[i:]))
+            peaks.append({'window_start': int(bounds[win_r[i]]), 'peak': int(win_max[k]), 't': int(ts_r[j])})
+    i_max = int(np.argmax(occ_r)) if len(occ_r) > 0 else None
+
+    return {
+        'from': t_start, 'to': t_end, 'bucket_s': bucket_s,
+        'occupancy': curve.astype(np.int64).tolist(),
+        'in': in_g.sum(axis=0).tolist(), 'out': out_g.sum(axis=0).tolist(),
+        'gates': per_gate,
+        'resets': int(np.count_nonzero(is_reset & in_range)),
+        'peak': None if i_max is None else {'peak': int(occ_r[i_max]), 't': int(ts_r[i_max])},
+        'window_peaks': peaks,
+    }
+
+
+def add_analytics_ep(app: Flask):
+    """
+    Define and add the analytics endpoint:
+    GET /analytics/occupancy, with args `from`, `to` (timestamp or ISO datetime) and `bucket` (seconds)
+    :param app: Target FlaskApp
+    :return:
+    """
+    @app.route('/analytics/occupancy', methods=['GET'])
+    @login_required
+    def analytics_occupancy_ep():
+        """
+        Occupancy over time, per-gate flows and peaks, for charting
+        :return: JSON
+        """
+        if is_unauthorized('QRY_CNT_ENABLE', app):
+            return 'unauthorized', 401
+        try:
+            t_start, t_end = parse_time_arg(request.args['from']), parse_time_arg(request.args['to'])
+            bucket_s = int(request.args.get('bucket', ANALYTICS_DEFAULT_BUCKET_S))
+            assert 0 < bucket_s and t_start < t_end, 'empty time-range or bucket'
+            t_start -= t_start % bucket_s
+            assert (t_end - t_start) / bucket_s <= ANALYTICS_MAX_BUCKETS, \
+                f'too many buckets (max {ANALYTICS_MAX_BUCKETS})'
+        except (KeyError, ValueError, OverflowError, AssertionError) as e:
+            return f'Bad request: {str(e)}', 400
+
+        bounds = counts_windows(t_start, t_end)
+        session = Session()
+        try:
+            arrays = load_counts_arrays(int(bounds[0]), t_end, session)
+        finally:
+            session.close()
+        res = occupancy_analytics(*arrays, bounds, t_start, t_end, bucket_s)
+        return json.dumps(res, separators=(',', ':')), 200, {'Content-Type': 'application/json'}
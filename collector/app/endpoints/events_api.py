@@ -0,0 +1,205 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from flask import Flask, request, Response, stream_with_context
+from flask_login import login_required
+
+from db.db_base import Session
+from endpoints.unauth_check import is_unauthorized
+from endpoints.queries_utils import count_events_query, mu_events_query
+
+from configs.config import EVENTS_PAGE_SIZE, EVENTS_MAX_PAGE_SIZE, EVENTS_YIELD_PER
+
+COUNT_EVENTS_COLS = ('gate_id', 'timestamp', 'in', 'out')
+MU_EVENTS_COLS = ('id', 'gate_id', 'timestamp', 'code', 'msg')
+
+
+class EventsKind:
+    """
+    Keyset-paginated events source: query builder, columns, and cursor <-> last row conversion
+    """
+    def __init__(self, query_fn, cols, cursor_fn, parse_cursor_fn):
+        self.query_fn = query_fn
+        self.cols = cols
+        self.cursor_fn = cursor_fn
+        self.parse_cursor_fn = parse_cursor_fn
+
+
+def _parse_count_cursor(cursor: str):
+    ts, gate_id = cursor.split(':', 1)
+    return int(ts), gate_id
+
+
+def _parse_mu_cursor(cursor: str):
+    ts, row_id = cursor.split(':', 1)
+    return Decimal(ts), int(row_id)
+
+
+COUNT_EVENTS = EventsKind(count_events_query, COUNT_EVENTS_COLS,
+                          lambda r: f'{r.timestamp}:{r.gate_id}', _parse_count_cursor)
+MU_EVENTS = EventsKind(mu_events_query, MU_EVENTS_COLS,
+                       lambda r: f'{r.timestamp}:{r.id}', _parse_mu_cursor)
+
+# First field of the last CSV row, followed by the cursor of the next page (empty if there are no more rows)
+CSV_NEXT_MARK = '#next'
+
+
+def parse_time_arg(value: str):
+    """
+    :param value: POSIX timestamp or ISO datetime
+    :return: timestamp (int)
+    """
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp())
+
+
+def iter_events(kind: EventsKind, device: str, ts_1: int, ts_2: int, after=None, limit=None):
+    """
+    Stream events rows with a server-side cursor (the DB-session is kept open until the generator is exhausted)
+    :param kind: COUNT_EVENTS | MU_EVENTS
+    :param device: Device's ID / all_device string
+    :param ts_1: Timestamp from
+    :param ts_2: Timestamp to
+    :param after: Cursor of the last row of the previous page, or None
+    :param limit: Max number of rows (None: all rows)
+    :return: Generator of rows
+    """
+    session = Session()
+    try:
+        after = None if not after else kind.parse_cursor_fn(after)
+        qry = kind.query_fn(device, ts_1, ts_2, session, after)
+        if limit is not None:
+            qry = qry.limit(limit)
+        for row in qry.yield_per(EVENTS_YIELD_PER):
+            yield row
+    finally:
+        session.close()
+
+
+def get_events_page(kind: EventsKind, device: str, ts_1: int, ts_2: int, after=None, limit=EVENTS_PAGE_SIZE):
+    """
+    :return: (rows, cursor of the next page or None)
+    """
+    rows = list(iter_events(kind, device, ts_1, ts_2, after, limit + 1))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, kind.cursor_fn(rows[-1])
+    return rows, None
+
+
+def _json_value(v):
+    if isinstance(v, (int, str)) or v is None:
+        return v
+    return float(v)
+
+
+def gen_json(kind: EventsKind, rows, limit):
+    """
+    JSON chunks: {"events": [{col: value}, ...], "next": cursor or null}. The cursor is known only at the end of
+    the stream, it's null if there are no more rows.
+    :param kind:
+    :param rows: Rows iterator, with one more row than `limit` if a next page exists
+    :param limit: Page size (None: all rows)
+    """
+    yield '{"events": ['
+    last, n, cursor = None, 0, None
+    try:
+        for row in rows:
+            if n == limit:
+                cursor = kind.cursor_fn(last)
+                break
+            if n > 0:
+                yield ','
+            yield json.dumps({c: _json_value(v) for c, v in zip(kind.cols, row)})
+            last, n = row, n + 1
+    finally:
+        rows.close()
+    yield '], "next": ' + json.dumps(cursor) + '}'
+
+
+def gen_csv(kind: EventsKind, rows, limit):
+    """
+    CSV chunks (header included), ended by the trailer row `CSV_NEXT_MARK`,<cursor>: the cursor is known only at
+    the end of the stream, it's empty if there are no more rows (a stream without trailer is truncated).
+    :param kind:
+    :param rows: Rows iterator, with one more row than `limit` if a next page exists
+    :param limit: Page size (None: all rows)
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(kind.cols)
+    last, n, cursor = None, 0, None
+    try:
+        for row in rows:
+            if n == limit:
+                cursor = kind.cursor_fn(last)
+                break
+            writer.writerow(row)
+            if n % EVENTS_YIELD_PER == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            last, n = row, n + 1
+    finally:
+        rows.close()
+    writer.writerow((CSV_NEXT_MARK, cursor or ''))
+    yield buf.getvalue()
+
+
+def add_events_api_ep(app: Flask):
+    """
+    Define and add the streaming Events API endpoints:
+    GET /api/events/counts and /api/events/mu, with args `from`, `to` (timestamp or ISO datetime), `device`,
+    `after` (cursor), `limit` (page size, 0 = whole time-range) and `format` (json | csv). The cursor of the next
+    page is the `next` field of JSON responses, the trailer row of CSV ones
+    :param app: Target FlaskApp
+    :return:
+    """
+    def events_response(kind: EventsKind, name):
+        args = request.args
+        try:
+            ts_1, ts_2 = parse_time_arg(args['from']), parse_time_arg(args['to'])
+            limit = int(args.get('limit', EVENTS_PAGE_SIZE))
+            assert 0 <= limit <= EVENTS_MAX_PAGE_SIZE, f'limit must be in [0, {EVENTS_MAX_PAGE_SIZE}]'
+            fmt = args.get('format', 'json')
+            assert fmt in ('json', 'csv'), 'format must be json or csv'
+            after = args.get('after')
+            if after:
+                kind.parse_cursor_fn(after)
+        except (KeyError, ValueError, OverflowError, InvalidOperation, AssertionError) as e:
+            return f'Bad request: {str(e)}', 400
+        limit = None if limit == 0 else limit
+        device = args.get('device', '')
+
+        rows = iter_events(kind, device, ts_1, ts_2, after, None if limit is None else limit + 1)
+        if fmt == 'csv':
+            return Response(stream_with_context(gen_csv(kind, rows, limit)), mimetype='text/csv',
+                            headers={'Content-Disposition': f'attachment; filename={name}_{ts_1}_{ts_2}.csv'})
+        return Response(stream_with_context(gen_json(kind, rows, limit)), mimetype='application/json')
+
+    @app.route('/api/events/counts', methods=['GET'])
+    @login_required
+    def api_count_events():
+        """
+        Stream Entrances/Exits Events
+        :return:
+        """
+        if is_unauthorized('QRY_EVT_ENABLE', app):
+            return 'unauthorized', 401
+        return events_response(COUNT_EVENTS, 'counts_events')
+
+    @app.route('/api/events/mu', methods=['GET'])
+    @login_required
+    def api_mu_events():
+        """
+        Stream MonitorUnits Connections/Disconnections Events
+        :return:
+        """
+        if is_unauthorized('QRY_DEV_ENABLE', app):
+            return 'unauthorized', 401
+        return events_response(MU_EVENTS, 'mu_events')
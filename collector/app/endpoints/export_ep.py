@@ -0,0 +1,109 @@
+import json
+
+from flask import Flask, request, Response, stream_with_context, send_file
+from flask_login import login_required
+
+from endpoints.unauth_check import is_unauthorized
+from endpoints.events_api import parse_time_arg
+from utils.export_jobs import ExportManager, EXPORT_TABLES, EXPORT_FORMATS, stream_csv
+
+# Authorization area of each exportable table
+EXPORT_AREAS = {'people_counts': 'QRY_EVT_ENABLE', 'mu_status': 'QRY_DEV_ENABLE'}
+
+
+def add_export_ep(app: Flask, export_manager: ExportManager):
+    """
+    Define and add Export endpoints:
+    GET /export/<table> stream the CSV export (`gzip=1` to compress it on the fly);
+    POST /export/jobs start a background export (args `table`, `format`), whose progress is given by
+    GET /export/jobs/<job_id>, and result by GET /export/jobs/<job_id>/download.
+    All of them take the `from`, `to` (timestamp or ISO datetime) and `device` args.
+    :param app: Target FlaskApp
+    :param export_manager: Background export jobs manager
+    :return:
+    """
+    def parse_range():
+        return parse_time_arg(request.values['from']), parse_time_arg(request.values['to'])
+
+    @app.route('/export/<table>', methods=['GET'])
+    @login_required
+    def export_stream_ep(table):
+        """
+        Stream records of `table` (people_counts | mu_status) as CSV, by Postgres COPY
+        :param table:
+        :return:
+        """
+        if table not in EXPORT_TABLES:
+            return f'Unknown table {table}', 404
+        if is_unauthorized(EXPORT_AREAS[table], app):
+            return 'unauthorized', 401
+        try:
+            ts_1, ts_2 = parse_range()
+        except (KeyError, ValueError, OverflowError) as e:
+            return f'Bad request: {str(e)}', 400
+        gzip = request.args.get('gzip') == '1'
+        name = f'{table}_{ts_1}_{ts_2}.csv' + ('.gz' if gzip else '')
+        gen = stream_csv(table, request.args.get('device', ''), ts_1, ts_2, gzip)
+        return Response(stream_with_context(gen), mimetype='application/gzip' if gzip else 'text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={name}'})
+
+    @app.route('/export/jobs', methods=['POST'])
+    @login_required
+    def export_job_submit_ep():
+        """
+        Start a background export job
+        :return: JSON job state (202)
+        """
+        table = request.values.get('table')
+        if table not in EXPORT_TABLES:
+            return f'Bad request: table must be one of {sorted(EXPORT_TABLES)}', 400
+        if is_unauthorized(EXPORT_AREAS[table], app):
+            return 'unauthorized', 401
+        fmt = request.values.get('format', 'csv.gz')
+        err = export_manager.check_format(fmt)
+        if err is not None:
+            return f'Bad request: {err}', 400
+        try:
+            ts_1, ts_2 = parse_range()
+        except (KeyError, ValueError, OverflowError) as e:
+            return f'Bad request: {str(e)}', 400
+        job = export_manager.submit(table, fmt, request.values.get('device', ''), ts_1, ts_2)
+        return json.dumps(job), 202
+
+    def get_authorized_job(job_id):
+        job = export_manager.get_job(job_id)
+        if job is None:
+            return None, ('Unknown export job', 404)
+        if is_unauthorized(EXPORT_AREAS[job.table], app):
+            return None, ('unauthorized', 401)
+        return job, None
+
+    @app.route('/export/jobs/<job_id>', methods=['GET'])
+    @login_required
+    def export_job_state_ep(job_id):
+        """
+        :param job_id:
+        :return: JSON job state and progress
+        """
+        job, err = get_authorized_job(job_id)
+        if err is not None:
+            return err
+        return json.dumps(job.to_dict()), 200
+
+    @app.route('/export/jobs/<job_id>/download', methods=['GET'])
+    @login_required
+    def export_job_download_ep(job_id):
+        """
+        :param job_id:
+        :return: Result file of a completed export job
+        """
+        job, err = get_authorized_job(job_id)
+        if err is not None:
+            return err
+        if job.state != 'done':
+            return f'Export job is {job.state}', 409
+        try:
+            return send_file(job.path, as_attachment=True,
+                             download_name=f'{job.table}_{job.ts_from}_{job.ts_to}.{EXPORT_FORMATS[job.fmt]}')
+        except FileNotFoundError:
+            return f'Export result is stored on host {job.owner.split(":")[0]}', 404
@@ -1,4 +1,5 @@
 import datetime
+import time
 
 import flask
 from flask import Flask, redirect, url_for, render_template, request, abort
@@ -10,39 +11,52 @@ from flask_wtf import FlaskForm
 from werkzeug.security import generate_password_hash, check_password_hash
 from wtforms import StringField, PasswordField, BooleanField
 from wtforms.validators import InputRequired, Length
-from configs.config import app_secret_key, SQLALCHEMY_DATABASE_URI
 
+from utils.auth_cache import AuthCache, SIGNATURE_HEADER, verify_signature
+from utils.user_directory import UserDirectory
 
-def login_setup(app: Flask):
+from configs.config import app_secret_key, SQLALCHEMY_DATABASE_URI, SESSION_REFRESH_S
+
+
+def login_setup(app: Flask, shared_state=None):
     """
     Attach and setup all configurations of Login System
     :param app:
-    :return: db and User class, used to store and represent the Users logged to the app
+    :param shared_state: Shared state of Collector processes (optional), used to invalidate cached credentials and
+    reload User directories
+    :return: db and User class, used to store and represent the Users logged to the app, the AuthCache of MUs
+    credentials and the UserDirectory
     """
     app: Flask
 
     @app.before_request
     def before_request():
         """
-        Reset the current Session timeout and check User logged in
+        Reset the current Session timeout (at most once every `SESSION_REFRESH_S` seconds, as it re-issues the
+        session cookie) and check User logged in
         :return:
         """
         r = request
         if not current_user.is_authenticated and not request.endpoint == 'login':
             redirect('/login')
-        else:
-            flask.session.permanent = True
-            app.permanent_session_lifetime = datetime.timedelta(minutes=30)
-            flask.session.modified = True
+        elif flask.session:
+            now = int(time.time())
+            if not flask.session.permanent or now - flask.session.get('_refreshed', 0) >= SESSION_REFRESH_S:
+                flask.session.permanent = True
+                flask.session['_refreshed'] = now
 
     # Set the configs for User DB
     app.config['SECRET_KEY'] = app_secret_key
     app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
+    app.permanent_session_lifetime = datetime.timedelta(minutes=30)
+    # Session cookie re-issued only when its expiry is renewed (see before_request)
+    app.config['SESSION_REFRESH_EACH_REQUEST'] = False
     bootstrap = Bootstrap(app)
     db = SQLAlchemy(app)
     login_manager = LoginManager()
     login_manager.init_app(app)
     login_manager.login_view = 'login'
+    auth_cache = AuthCache(app_secret_key, shared_state)
 
     class User(UserMixin, db.Model):
         """
@@ -64,18 +78,33 @@ def login_setup(app: Flask):
         def set_password(self, password):
             self.password = generate_password_hash(password)
 
+    user_dir = UserDirectory(app, User, shared_state)
+
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return user_dir.get(int(user_id))
 
     @login_manager.request_loader
     def load_user_from_header(param):
+        signature = request.headers.get(SIGNATURE_HEADER)
+        if signature:
+            username = verify_signature(signature, request.method, request.full_path.rstrip("?"),
+                                        request.get_data(), seen=auth_cache.signatures)
+            user = user_dir.get_by_username(username) if username else None
+            if not user:
+                abort(401)
+            return user
         auth = request.authorization
         if not auth:
             return None
-        user = User.query.filter_by(username=auth.username).first()
-        if not user or not check_password_hash(user.password, auth.password):
+        user = user_dir.get_by_username(auth.username)
+        if not user:
+            abort(401)
+        if auth_cache.get(auth.username, auth.password, user.password) == user.id:
+            return user
+        if not check_password_hash(user.password, auth.password):
             abort(401)
+        auth_cache.put(auth.username, auth.password, user.id, user.password)
         return user
 
     class LoginForm(FlaskForm):
@@ -123,5 +152,5 @@ def login_setup(app: Flask):
         redir_str = '/'
         return redirect(redir_str)
 
-    return db, User
+    return db, User, auth_cache, user_dir
 
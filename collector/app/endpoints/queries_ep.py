@@ -1,39 +1,42 @@
 import json
 from datetime import datetime, timedelta
-from threading import Thread
 
-from flask import Flask, redirect, render_template
+from flask import Flask, redirect, render_template, request
 from flask_login import login_required
+from utils.counts_engine import CountsEngine
 from utils.status_manager import StatusManagerThreadBody
 from endpoints.unauth_check import is_unauthorized
-from endpoints.queries_utils import FullFreeForm, estimate_people_num_form, estimate_people_evts_form, estimate_people_now, \
-    gen_evt_strings, DeviceStatusForm, query_device_evts
+from utils.query_cache import QueryCache
+from endpoints.queries_utils import FullFreeForm, gen_evt_strings, DeviceStatusForm
+from endpoints.events_api import get_events_page, COUNT_EVENTS, MU_EVENTS
 from net_io.updates_websoc import UpdateManagerThreadBody
+from net_io.ws_service import WSNetService
 
-from configs.config import app_secret_key, ssl_key, ssl_cert, ALL_STR
-from db.db_base import Session
+from configs.config import app_secret_key, ALL_STR
 
 # Base.metadata.create_all(engine)
 
 ALL_ID = ALL_STR
 
 
-def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
+def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody, counts_engine: CountsEngine,
+                   net_service: WSNetService, query_cache: QueryCache):
     """
     Define and add all DB-Interactions endpoints
     :param app: Target FlaskApp
     :param status_manager: Current object that contain all peripheral devices status
+    :param counts_engine: In-memory running totals of current daily Counts
+    :param net_service: Network service running the Counts-updates WebSocket server
+    :param query_cache: Cache of time-range queries results
     :return:
     """
     app.config['SECRET_KEY'] = app_secret_key
 
-    s = Session()
-    counters = estimate_people_now(ALL_ID, s)
-    s.close()
+    counters = counts_engine.get_counts(ALL_ID)
     update_0 = json.dumps(counters)
 
     # Setup Update manager object
-    update_manager = UpdateManagerThreadBody(update_0, ssl_cert, ssl_key)
+    update_manager = UpdateManagerThreadBody(update_0, net_service)
 
     @app.route('/qry_form_num', methods=['GET', 'POST'])
     @login_required
@@ -49,17 +52,14 @@ def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
         p_counts = []
 
         if form.validate_on_submit():
-            session = Session()
-
             try:
-                p_counts = estimate_people_num_form(form, session)
+                p_counts = query_cache.people_num(form.device.data, form.time1.data, form.time2.data,
+                                                  form.per_gate.data)
                 msg = f'People Counts Estimated:'
             except Exception as e:
                 # TODO: Manage Failures
                 # return str(e), 400
                 msg = str(e)
-            finally:
-                session.close()
 
         if not form.validate_on_submit():
             form.time1.data = datetime.now() - timedelta(hours=1)
@@ -80,26 +80,27 @@ def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
         form = FullFreeForm()
         msg = ''
         evt_ls = []
+        next_page = None
 
         if form.validate_on_submit():
-            session = Session()
             try:
-                evt_ls = estimate_people_evts_form(form, session)
+                # Pages of the Events API: `after` is the cursor of the last shown event
+                evt_ls, next_page = get_events_page(COUNT_EVENTS, form.device.data,
+                                                    int(form.time1.data.timestamp()), int(form.time2.data.timestamp()),
+                                                    request.form.get('after'))
                 evt_ls = gen_evt_strings(evt_ls)
                 msg = f'Events detected'
             except Exception as e:
                 # TODO: Manage Failures
                 # return str(e), 400
                 msg = str(e)
-            finally:
-                session.close()
 
         if not form.validate_on_submit():
             form.time1.data = datetime.now() - timedelta(hours=1)
             form.time2.data = datetime.now() + timedelta(hours=1)
 
-        return render_template('queries_evts.html',
-                               form=form, msg=msg, evt_ls=evt_ls, dev_ls=status_manager.get_online_devices())
+        return render_template('queries_evts.html', form=form, msg=msg, evt_ls=evt_ls, next_page=next_page,
+                               dev_ls=status_manager.get_online_devices())
 
     @app.route('/qry_form_dev_evt', methods=['GET', 'POST'])
     @login_required
@@ -113,11 +114,14 @@ def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
         form = DeviceStatusForm()
         msg = ''
         evt_ls = []
+        next_page = None
 
         if form.validate_on_submit():
-            session = Session()
             try:
-                evt_ls = query_device_evts(form, session)
+                rows, next_page = get_events_page(MU_EVENTS, form.device.data,
+                                                  int(form.time1.data.timestamp()), int(form.time2.data.timestamp()),
+                                                  request.form.get('after'))
+                evt_ls = [(r.gate_id, datetime.fromtimestamp(int(r.timestamp)), r.msg) for r in rows]
                 if len(evt_ls) > 0:
                     msg = f'Events Devices-Status detected'
                 else:
@@ -126,15 +130,13 @@ def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
                 # TODO: Manage Failures
                 # return str(e), 400
                 msg = str(e)
-            finally:
-                session.close()
 
         if not form.validate_on_submit():
             form.time1.data = datetime.now() - timedelta(hours=1)
             form.time2.data = datetime.now() + timedelta(hours=1)
 
-        return render_template('queries_evts_dev.html',
-                               form=form, msg=msg, evt_ls=evt_ls, dev_ls=status_manager.get_online_devices())
+        return render_template('queries_evts_dev.html', form=form, msg=msg, evt_ls=evt_ls, next_page=next_page,
+                               dev_ls=status_manager.get_online_devices())
 
     @app.route('/qry_num_now/<id_gate>', methods=['GET'])
     @login_required
@@ -144,11 +146,7 @@ def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
         :param id_gate: Gate's ID
         :return: Json containing Counts Estimations {'tot': x, 'in': y, 'out': z}
         """
-        session = Session()
-
-        counters = estimate_people_now(id_gate, session)
-
-        session.close()
+        counters = counts_engine.get_counts(id_gate)
 
         json_string = json.dumps(counters)
 
@@ -166,13 +164,4 @@ def add_queries_ep(app: Flask, status_manager: StatusManagerThreadBody):
         update_manager.broadcast_update(upd_dict)
         return 'DONE!', 200
 
-    @app.before_first_request
-    def init_setup():
-        """
-        Create and put in Run-State the UpdateManager Thread
-        :return:
-        """
-        th_update_manager = Thread(target=update_manager)
-        th_update_manager.start()
-
     return update_manager
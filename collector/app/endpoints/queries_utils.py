@@ -3,12 +3,16 @@ from wtforms import StringField, BooleanField
 from wtforms.fields import DateTimeField
 from wtforms.validators import InputRequired, Length
 from datetime import datetime, timedelta, date
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, tuple_
 
 from db.people_count import PeopleCounts
 from db.monitorunitstatus import MonitorUnitStatusRecord
 from db.db_closedays import CloseDayRecord
 from db.db_mismatch import MismatchRecord
+from db.ingest_batch import IngestBatchRecord
+from db.partitions import is_partitioned, drop_partitions_before
+from db.people_count_rollups import ROLLUP_TABLES
+from endpoints.rollups_planner import query_planned_counts
 
 from configs.config import NOW_TIMERANGE, ALL_STR
 
@@ -36,71 +40,12 @@ class DeviceStatusForm(FlaskForm):
     time2 = DateTimeField('Time End', validators=[InputRequired()], format='%Y-%m-%dT%H:%M', default=datetime.now())
 
 
-def estimate_people_num_form(form: FullFreeForm, session):
+def get_now_timerange(dt_now: datetime):
     """
-    Wrap Function that retrieve form's fields and perform a time-range query on Counts Estimations
-    :param form:
-    :param session: Already initialised DB-session
-    :return:
-    """
-    device_id = form.device.data
-    dt_1 = form.time1.data
-    dt_2 = form.time2.data
-    to_group = form.per_gate.data
-
-    return estimate_people_num(device_id, dt_1, dt_2, to_group, session)
-
-
-def estimate_people_evts_form(form: FullFreeForm, session):
+    Establish the daily Counts time-range (defined by `NOW_TIMERANGE`) that contains the given datetime
+    :param dt_now: DateTime object to be considered "Now"
+    :return: datetime Tuple: (range_start, range_end)
     """
-    Wrap Function that retrieve form's fields and perform a time-range query on Enter/Exit Events
-    :param form:
-    :param session: Already initialised DB-session
-    :return:
-    """
-    device_id = form.device.data
-    dt_1 = form.time1.data
-    dt_2 = form.time2.data
-    to_group = form.per_gate.data
-
-    return estimate_people_evts(device_id, dt_1, dt_2, to_group, session)
-
-
-def query_device_evts(form: DeviceStatusForm, session):
-    """
-    Wrap Function that retrieve form's fields and perform a time-range query on MonitorUnits Connections/Disconnections
-    :param form:
-    :param session: Already initialised DB-session
-    :return:
-    """
-    device_id = form.device.data
-    dt_1 = form.time1.data
-    dt_2 = form.time2.data
-
-    return monitor_unit_evts(device_id, dt_1, dt_2, session)
-
-
-def estimate_people_now(id_gate, session):
-    """
-    Utility Wrap Function, used to retrieve current daily Counts Estimations
-    :param id_gate: Gate's ID
-    :param session: Already initialised DB-session
-    :return:
-    """
-    dt_now = datetime.now()
-    return estimate_people_now_custom(id_gate, dt_now, session)
-
-
-def estimate_people_now_custom(id_gate, dt_now, session):
-    """
-    Wrap-Function to perform Daily Counts Estimation
-    :param id_gate: Gate's ID
-    :param dt_now: DateTime object to be considered "Now" for the current query
-    :param session: Already initialised DB-session
-    :return:
-    """
-
-    # Define Time-Range of the query
     dt_r1 = dt_now.replace(hour=NOW_TIMERANGE[0], minute=0, second=0, microsecond=0)
     dt_r2 = dt_now.replace(hour=NOW_TIMERANGE[1], minute=0, second=0, microsecond=0)
     if dt_r2 <= dt_r1 < dt_now:
@@ -117,6 +62,18 @@ def estimate_people_now_custom(id_gate, dt_now, session):
             dt_r2 = dt_r2 - timedelta(days=1)
         dt_1 = dt_r2
         dt_2 = dt_r1
+    return dt_1, dt_2
+
+
+def estimate_people_now_custom(id_gate, dt_now, session):
+    """
+    Wrap-Function to perform Daily Counts Estimation
+    :param id_gate: Gate's ID
+    :param dt_now: DateTime object to be considered "Now" for the current query
+    :param session: Already initialised DB-session
+    :return:
+    """
+    dt_1, dt_2 = get_now_timerange(dt_now)
 
     cnt_ls = estimate_people_num(id_gate, dt_1, dt_2, False, session)
 
@@ -140,21 +97,12 @@ def estimate_people_num(device: str, time1: datetime, time2: datetime, per_gate:
     :param session: Already initialised DB-session
     :return: Tuple-List containing Counts estimations (aggregated/each-gate). I.E.: [('gate_X', p_in, p_out), ('gate_Y'...]
     """
-    qry = session.query(PeopleCounts.gate_id,
-                        func.sum(PeopleCounts.entered).label("sum_in"),
-                        func.sum(PeopleCounts.exited).label("sum_out")
-                        )
-    qry = qry.filter(
-        and_(PeopleCounts.timestamp >= int(time1.timestamp()),
-             PeopleCounts.timestamp <= int(time2.timestamp()))
-    )
-
+    gate_id = None
     if not (device == DEVICE_DEFAULT) and not (device == ALL):
-        qry = qry.filter(PeopleCounts.gate_id == device)
-
-    qry = qry.group_by(PeopleCounts.gate_id)
+        gate_id = device
 
-    res = qry.all()
+    # Sums are read from minute/hour/day rollups, raw records are scanned only for the range edges
+    res = query_planned_counts(gate_id, int(time1.timestamp()), int(time2.timestamp()) + 1, session)
 
     if ((device == DEVICE_DEFAULT) or (device == ALL)) and not per_gate:
         tot_in, tot_out = 0, 0
@@ -202,6 +150,75 @@ def estimate_people_evts(device: str, time1: datetime, time2: datetime, per_gate
     return res
 
 
+def count_events_query(device: str, ts_1: int, ts_2: int, session, after=None):
+    """
+    Keyset-paginated query on Counts Events (same rows of `estimate_people_evts()`), ordered by (timestamp, gate)
+    :param device: Device's ID / all_device string
+    :param ts_1: Timestamp from
+    :param ts_2: Timestamp to
+    :param session: Already initialised DB-session
+    :param after: (timestamp, gate_id) of the last row of the previous page, or None
+    :return: Query of (gate_id, timestamp, sum_in, sum_out)
+    """
+    qry = session.query(PeopleCounts.gate_id,
+                        PeopleCounts.timestamp,
+                        func.sum(PeopleCounts.entered).label("sum_in"),
+                        func.sum(PeopleCounts.exited).label("sum_out")
+                        )
+    qry = qry.filter(and_(PeopleCounts.timestamp >= ts_1, PeopleCounts.timestamp <= ts_2))
+    if not (device == DEVICE_DEFAULT) and not (device == ALL):
+        qry = qry.filter(PeopleCounts.gate_id == device)
+    if after is not None:
+        qry = qry.filter(tuple_(PeopleCounts.timestamp, PeopleCounts.gate_id) > tuple_(*after))
+    qry = qry.group_by(PeopleCounts.timestamp, PeopleCounts.gate_id)
+    return qry.order_by(PeopleCounts.timestamp, PeopleCounts.gate_id)
+
+
+def count_records_query(device: str, ts_1: int, ts_2: int, session):
+    """
+    Query on raw Counts records (not aggregated), ordered by (timestamp, id)
+    :param device: Device's ID / all_device string
+    :param ts_1: Timestamp from
+    :param ts_2: Timestamp to
+    :param session: Already initialised DB-session
+    :return: Query of (id, gate_id, timestamp, in, out)
+    """
+    qry = session.query(PeopleCounts.id,
+                        PeopleCounts.gate_id,
+                        PeopleCounts.timestamp,
+                        PeopleCounts.entered,
+                        PeopleCounts.exited,
+                        )
+    qry = qry.filter(and_(PeopleCounts.timestamp >= ts_1, PeopleCounts.timestamp <= ts_2))
+    if not (device == DEVICE_DEFAULT) and not (device == ALL):
+        qry = qry.filter(PeopleCounts.gate_id == device)
+    return qry.order_by(PeopleCounts.timestamp, PeopleCounts.id)
+
+
+def mu_events_query(device: str, ts_1: int, ts_2: int, session, after=None):
+    """
+    Keyset-paginated query on MonitorUnit Connection/Disconnection Events, ordered by (timestamp, id)
+    :param device: Device's ID / all_device string
+    :param ts_1: Timestamp from
+    :param ts_2: Timestamp to
+    :param session: Already initialised DB-session
+    :param after: (timestamp, id) of the last row of the previous page, or None
+    :return: Query of (id, gate_id, timestamp, code, msg)
+    """
+    qry = session.query(MonitorUnitStatusRecord.id,
+                        MonitorUnitStatusRecord.gate_id,
+                        MonitorUnitStatusRecord.timestamp,
+                        MonitorUnitStatusRecord.status_code,
+                        MonitorUnitStatusRecord.msg,
+                        )
+    qry = qry.filter(and_(MonitorUnitStatusRecord.timestamp >= ts_1, MonitorUnitStatusRecord.timestamp <= ts_2))
+    if not (device == DEVICE_DEFAULT) and not (device == ALL):
+        qry = qry.filter(MonitorUnitStatusRecord.gate_id == device)
+    if after is not None:
+        qry = qry.filter(tuple_(MonitorUnitStatusRecord.timestamp, MonitorUnitStatusRecord.id) > tuple_(*after))
+    return qry.order_by(MonitorUnitStatusRecord.timestamp, MonitorUnitStatusRecord.id)
+
+
 def gen_evt_strings(evts: list):
     """
     Utility function to create a formatted string containing readable informations about Counts Events
@@ -225,37 +242,6 @@ def gen_evt_strings(evts: list):
     return res_evts
 
 
-def monitor_unit_evts(device: str, time1: datetime, time2: datetime, session):
-    """
-    Function that perform the time-range query on MonitorUnit Connection/Disconnection Events
-    :param device: Device's ID / all_device string
-    :param time1: DateTime from
-    :param time2: DateTime to
-    :param session: Already initialised DB-session
-    :return: Tuple-List containing MU's Connection/Disconnection events
-    """
-    qry = session.query(MonitorUnitStatusRecord.gate_id,
-                        MonitorUnitStatusRecord.timestamp,
-                        MonitorUnitStatusRecord.msg,
-                        )
-    qry = qry.filter(
-        and_(MonitorUnitStatusRecord.timestamp >= int(time1.timestamp()),
-             MonitorUnitStatusRecord.timestamp <= int(time2.timestamp()))
-    )
-
-    if not (device == DEVICE_DEFAULT) and not (device == ALL):
-        qry = qry.filter(MonitorUnitStatusRecord.gate_id == device)
-
-    qry = qry.order_by(MonitorUnitStatusRecord.timestamp)
-
-    _res = qry.all()
-    res = []
-    for r in _res:
-        res.append((r[0], datetime.fromtimestamp(int(r[1])), r[2]))
-
-    return res
-
-
 def get_last_mismatches(past_days: int, session):
     """
     Function that perform last `past_days` mismatch records
@@ -333,13 +319,25 @@ def cleanup_range_closedays(from_day: date, to_day: date, session):
 
 def cleanup_all_db(from_dt: datetime, session):
     """
-    Function to cleanup all records from all tables older than a given datetime
+    Function to cleanup all records from all tables older than a given datetime.
+    Counts records and their rollups are cut at the start of the (coarsest) rollup bucket containing `from_dt`, so
+    that every remaining bucket still sums exactly the remaining records
     :param from_dt:
     :param session: Already initialised DB-session
     :return: {'counts_deleted': x, 'mu_stat_deleted': y, 'mismatches_deleted': z}
     """
+    t_from = int(from_dt.timestamp())
+    t_cut = t_from - t_from % max(rollup.bucket_size for rollup in ROLLUP_TABLES)
+    counts_deleted = 0
+    if is_partitioned(session):
+        # Whole days are removed dropping their partitions, only remaining records are deleted one by one
+        counts_deleted += drop_partitions_before(session, datetime.fromtimestamp(t_cut))
     qry_counts = session.query(PeopleCounts)
-    counts_deleted = qry_counts.filter(PeopleCounts.timestamp < int(from_dt.timestamp())).delete()
+    counts_deleted += qry_counts.filter(PeopleCounts.timestamp < t_cut).delete()
+
+    for rollup in ROLLUP_TABLES:
+        qry_rollup = session.query(rollup)
+        qry_rollup.filter(rollup.bucket + rollup.bucket_size <= t_cut).delete()
 
     qry_mu_stat = session.query(MonitorUnitStatusRecord)
     mu_stat_deleted = qry_mu_stat.filter(MonitorUnitStatusRecord.timestamp < int(from_dt.timestamp())).delete()
@@ -347,6 +345,9 @@ def cleanup_all_db(from_dt: datetime, session):
     qry_mismatch = session.query(MismatchRecord)
     mismatch_deleted = qry_mismatch.filter(MismatchRecord.timestamp < int(from_dt.timestamp())).delete()
 
+    qry_batches = session.query(IngestBatchRecord)
+    qry_batches.filter(IngestBatchRecord.timestamp < int(from_dt.timestamp())).delete()
+
     session.commit()
 
     cleanup_older_closeday(from_dt.date(), session)
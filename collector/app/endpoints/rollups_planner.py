@@ -0,0 +1,66 @@
+from sqlalchemy import func, and_, select, union_all, literal
+
+from db.people_count import PeopleCounts
+from db.people_count_rollups import ROLLUP_TABLES
+
+RAW = None
+
+
+def plan_time_range(t_start: int, t_end: int, rollups=ROLLUP_TABLES):
+    """
+    Split the time-range [t_start, t_end) in segments answered by the coarsest rollup table that fits them.
+    Only the ragged edges (shorter than the finest bucket) are left to raw Counts records.
+    :param t_start: epoch seconds (included)
+    :param t_end: epoch seconds (excluded)
+    :param rollups: Rollup tables, from the coarsest to the finest
+    :return: List of (rollup_table | RAW, seg_start, seg_end)
+    """
+    if t_start >= t_end:
+        return []
+    if len(rollups) == 0:
+        return [(RAW, t_start, t_end)]
+    size = rollups[0].bucket_size
+    aligned_start = -(-t_start // size) * size
+    aligned_end = t_end // size * size
+    if aligned_start >= aligned_end:
+        return plan_time_range(t_start, t_end, rollups[1:])
+    return plan_time_range(t_start, aligned_start, rollups[1:]) + \
+        [(rollups[0], aligned_start, aligned_end)] + \
+        plan_time_range(aligned_end, t_end, rollups[1:])
+
+
+def query_planned_counts(gate_id, t_start: int, t_end: int, session):
+    """
+    Sum Entrances/Exits per gate in [t_start, t_end), reading rollup tables where possible
+    :param gate_id: Gate's ID, or None for all gates
+    :param t_start: epoch seconds (included)
+    :param t_end: epoch seconds (excluded)
+    :param session: Already initialised DB-session
+    :return: Tuple-List [('gate_X', p_in, p_out), ...]
+    """
+    selects = []
+    for source, seg_start, seg_end in plan_time_range(t_start, t_end):
+        if source is RAW:
+            t_col, g_col = PeopleCounts.timestamp, PeopleCounts.gate_id
+            sel = select(PeopleCounts.gate_id.label('gate_id'),
+                         PeopleCounts.entered.label('p_in'),
+                         PeopleCounts.exited.label('p_out'))
+        else:
+            t_col, g_col = source.bucket, source.gate_id
+            sel = select(source.gate_id.label('gate_id'),
+                         source.entered.label('p_in'),
+                         source.exited.label('p_out'))
+        sel = sel.where(and_(t_col >= seg_start, t_col < seg_end))
+        if gate_id is not None:
+            sel = sel.where(g_col == gate_id)
+        selects.append(sel)
+
+    if len(selects) == 0:
+        return []
+
+    segs = union_all(*selects).subquery() if len(selects) > 1 else selects[0].subquery()
+    qry = session.query(segs.c.gate_id,
+                        func.coalesce(func.sum(segs.c.p_in), literal(0)).label('sum_in'),
+                        func.coalesce(func.sum(segs.c.p_out), literal(0)).label('sum_out'))
+    qry = qry.group_by(segs.c.gate_id)
+    return [(r[0], int(r[1]), int(r[2])) for r in qry.all()]
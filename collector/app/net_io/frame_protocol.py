@@ -0,0 +1,110 @@
+import struct
+import time
+
+import cv2
+import numpy as np
+
+MAGIC = b'GPCF'
+VERSION = 1
+
+CODEC_JPEG = 1
+CODEC_WEBP = 2
+# codec: (cv2 extension, cv2 quality flag, mimetype)
+CODECS = {
+    CODEC_JPEG: ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+    CODEC_WEBP: ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'image/webp'),
+}
+
+# magic, version, codec, device_id length, sequence number, capture timestamp (ms)
+HEADER = struct.Struct('!4sBBHIQ')
+
+
+class FrameProtocolError(ValueError):
+    """
+    Malformed debug-frame message
+    """
+    pass
+
+
+class EncodedFrame:
+    """
+    Debug-frame sent from a MU, already encoded (JPEG/WebP) on MU side.
+    Binary message format (network byte order):
+        | magic 'GPCF' | version (u8) | codec (u8) | id_len (u16) | seq (u32) | timestamp_ms (u64) | device_id | data |
+    """
+    def __init__(self, device_id, seq, timestamp, codec, data):
+        """
+        :param device_id: MU's ID
+        :param seq: Frame sequence number (per MU)
+        :param timestamp: Capture timestamp (epoch seconds)
+        :param codec: CODEC_JPEG | CODEC_WEBP
+        :param data: Encoded image bytes
+        """
+        if codec not in CODECS:
+            raise FrameProtocolError(f'Unknown codec {codec}')
+        self.device_id = device_id
+        self.seq = seq
+        self.timestamp = timestamp
+        self.codec = codec
+        self.data = data
+
+    @property
+    def mimetype(self):
+        return CODECS[self.codec][2]
+
+    @classmethod
+    def from_image(cls, device_id, seq, img: np.ndarray, codec=CODEC_JPEG, quality=80):
+        """
+        Encode a raw frame (MU side)
+        :param device_id:
+        :param seq:
+        :param img: BGR image
+        :param codec: CODEC_JPEG | CODEC_WEBP
+        :param quality: encoder quality [0-100]
+        :return: EncodedFrame
+        """
+        ext, quality_flag, _ = CODECS[codec]
+        ok, buf = cv2.imencode(ext, img, [quality_flag, quality])
+        if not ok:
+            raise FrameProtocolError(f'Frame encoding failed ({ext})')
+        return cls(device_id, seq, time.time(), codec, buf.tobytes())
+
+    def decode(self):
+        """
+        :return: BGR image (ndarray)
+        """
+        img = cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise FrameProtocolError(f'Frame of {self.device_id} (seq {self.seq}) not decodable')
+        return img
+
+    def pack(self):
+        """
+        :return: binary message of `this` frame
+        """
+        dev = self.device_id.encode()
+        header = HEADER.pack(MAGIC, VERSION, self.codec, len(dev), self.seq % 2 ** 32, int(self.timestamp * 1000))
+        return header + dev + self.data
+
+    @classmethod
+    def unpack(cls, msg):
+        """
+        Parse a binary frame message
+        :param msg: bytes
+        :return: EncodedFrame
+        """
+        if not isinstance(msg, (bytes, bytearray)) or len(msg) < HEADER.size:
+            raise FrameProtocolError('Frame message too short')
+        magic, version, codec, id_len, seq, ts_ms = HEADER.unpack_from(msg)
+        if magic != MAGIC:
+            raise FrameProtocolError('Bad frame magic')
+        if version != VERSION:
+            raise FrameProtocolError(f'Unsupported frame protocol version {version}')
+        id_end = HEADER.size + id_len
+        if len(msg) <= id_end:
+            raise FrameProtocolError('Truncated frame message')
+        try:
+            device_id = bytes(msg[HEADER.size:id_end]).decode()
+        except UnicodeDecodeError:
+            raise FrameProtocolError('Bad frame device_id')
+        return cls(device_id, seq, ts_ms / 1000, codec, bytes(msg[id_end:]))
@@ -0,0 +1,187 @@
+import heapq
+import itertools
+import os
+import queue
+import time
+
+from flask import Flask
+from flask_mail import Mail, Message
+
+from configs.config import MAIL_QUEUE_SIZE, MAIL_DIGEST_WINDOW_S, MAIL_SMTP_IDLE_S, MAIL_MAX_RETRIES, \
+    MAIL_BACKOFF_S, MAIL_BACKOFF_MAX_S
+
+DEBUG = bool(os.getenv('DEBUG'))
+
+
+class OutgoingMail:
+    """
+    Email waiting to be sent to one or more recipients
+    """
+    __slots__ = ('dest_ls', 'subj', 'body', 'footer', 'digest', 't_send', 'attempts')
+
+    def __init__(self, dest_ls, subj, body, footer='', digest=False, t_send=0., attempts=0):
+        """
+        :param dest_ls: List of email addresses
+        :param subj:
+        :param body:
+        :param footer: Text appended to the body (once, for digests)
+        :param digest: If True, it can be merged with other mails to the same recipient (see `MAIL_DIGEST_WINDOW_S`)
+        :param t_send: Timestamp of the (postponed) send
+        :param attempts: Failed send attempts
+        """
+        self.dest_ls = dest_ls
+        self.subj = subj
+        self.body = body
+        self.footer = footer
+        self.digest = digest
+        self.t_send = t_send
+        self.attempts = attempts
+
+
+class MailDispatcherThreadBody:
+    """
+    Send emails in background, so that callers (ingestion requests, scheduler jobs) never wait for the SMTP server.
+    Mails are taken from a bounded queue (dropped when full), sent on a SMTP connection kept open while in use
+    (closed after `MAIL_SMTP_IDLE_S` idle seconds) and retried with exponential backoff.
+    Digest mails to the same recipient within `MAIL_DIGEST_WINDOW_S` seconds are merged into a single mail, postponed
+    mails wait in a time-ordered heap.
+    """
+    def __init__(self, flsk_app: Flask, mail: Mail, sender, queue_size=MAIL_QUEUE_SIZE,
+                 digest_window_s=MAIL_DIGEST_WINDOW_S):
+        """
+        :param flsk_app:
+        :param mail: Flask-Mail object
+        :param sender: Sender address
+        :param queue_size: Max number of mails waiting in queue
+        :param digest_window_s: Time window (seconds) of digest mails coalescing
+        """
+        self.app = flsk_app
+        self.mail = mail
+        self.sender = sender
+        self.digest_window_s = digest_window_s
+        self.process = True
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Heap of (timestamp, seq, OutgoingMail | recipient to flush digest of)
+        self.heap = []
+        self.seq = itertools.count()
+        # {recipient: [OutgoingMail]}, digest mails waiting for the end of their window
+        self.pending = {}
+        self.conn = None
+        self.t_used = 0
+        self.stats = {'queued': 0, 'dropped': 0, 'sent': 0, 'digests': 0, 'coalesced': 0, 'retries': 0,
+                      'failed': 0, 'smtp_connects': 0}
+
+    def submit(self, out_mail: OutgoingMail):
+        """
+        Enqueue a mail (non-blocking)
+        :param out_mail:
+        :return: False if the mail is dropped (queue full)
+        """
+        try:
+            self.queue.put_nowait(out_mail)
+            self.stats['queued'] += 1
+            return True
+        except queue.Full:
+            self.stats['dropped'] += 1
+            with self.app.app_context():
+                self.app.logger.error(f'Mail queue full, dropped "{out_mail.subj}"')
+            return False
+
+    def __call__(self):
+        while self.process:
+            try:
+                timeout = MAIL_SMTP_IDLE_S
+                if len(self.heap) > 0:
+                    timeout = min(timeout, max(0., self.heap[0][0] - time.time()))
+                try:
+                    self.__accept__(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    pass
+                self.__run_due__()
+                if self.conn is not None and time.time() - self.t_used >= MAIL_SMTP_IDLE_S:
+                    self.__close__()
+            except Exception as e:
+                with self.app.app_context():
+                    self.app.logger.error(f'MailDispatcher FAIL: {str(e)}')
+
+    def __push__(self, t, item):
+        heapq.heappush(self.heap, (t, next(self.seq), item))
+
+    def __accept__(self, out_mail: OutgoingMail):
+        now = time.time()
+        if out_mail.t_send > now:
+            self.__push__(out_mail.t_send, out_mail)
+            return
+        for dest in out_mail.dest_ls:
+            if out_mail.digest:
+                if dest not in self.pending:
+                    self.pending[dest] = []
+                    self.__push__(now + self.digest_window_s, dest)
+                self.pending[dest].append(out_mail)
+            else:
+                self.__send__(dest, out_mail.subj, out_mail.body, out_mail.footer, out_mail.attempts)
+
+    def __run_due__(self):
+        while len(self.heap) > 0 and self.heap[0][0] <= time.time():
+            _, _, item = heapq.heappop(self.heap)
+            if isinstance(item, OutgoingMail):
+                item.t_send = 0.
+                self.__accept__(item)
+            else:
+                self.__flush_digest__(item)
+
+    def __flush_digest__(self, dest):
+        mails = self.pending.pop(dest, [])
+        if len(mails) == 0:
+            return
+        if len(mails) == 1:
+            self.__send__(dest, mails[0].subj, mails[0].body, mails[0].footer)
+            return
+        subj = f'[Digest] {len(mails)} notifications: ' + ', '.join(sorted({m.subj for m in mails}))
+        body = '\n\n'.join(f'--- {m.subj} ---\n{m.body}' for m in mails)
+        self.stats['digests'] += 1
+        self.stats['coalesced'] += len(mails)
+        self.__send__(dest, subj, body, mails[0].footer)
+
+    def __connection__(self):
+        if self.conn is None:
+            conn = self.mail.connect()
+            conn.__enter__()
+            self.conn = conn
+            self.stats['smtp_connects'] += 1
+        self.t_used = time.time()
+        return self.conn
+
+    def __close__(self):
+        conn, self.conn = self.conn, None
+        try:
+            if conn is not None:
+                conn.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def __send__(self, dest, subj, body, footer='', attempts=0):
+        try:
+            with self.app.app_context():
+                msg = Message(subj, sender=self.sender, recipients=[dest], body=body + footer)
+                if not DEBUG:
+                    self.__connection__().send(msg)
+            self.stats['sent'] += 1
+        except Exception as e:
+            self.__close__()
+            attempts += 1
+            if attempts > MAIL_MAX_RETRIES:
+                self.stats['failed'] += 1
+                with self.app.app_context():
+                    self.app.logger.error(f'Mail "{subj}" to {dest} FAIL: {str(e)}')
+                return
+            self.stats['retries'] += 1
+            backoff = min(MAIL_BACKOFF_MAX_S, MAIL_BACKOFF_S * 2 ** (attempts - 1))
+            self.__push__(time.time() + backoff, OutgoingMail([dest], subj, body, footer, attempts=attempts))
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queue'] = self.queue.qsize()
+        stats['scheduled'] = len(self.heap)
+        stats['smtp_open'] = self.conn is not None
+        return stats
@@ -1,10 +1,12 @@
 import os
 from datetime import datetime
 
-from apscheduler.triggers.date import DateTrigger
 from flask import Flask
-from flask_apscheduler import APScheduler
-from flask_mail import Mail, Message
+from flask_mail import Mail
+
+from net_io.mail_dispatcher import MailDispatcherThreadBody, OutgoingMail
+from utils.shared_state import SharedState, SET_NO_DISTURB
+from utils.user_directory import UserDirectory
 
 from configs.config import email_pass, email_addr, MAIL_SERVER, MAIL_PORT, MAIL_USE_TLS, MAIL_USE_SSL, \
     DISABLE_ENABLE_URL
@@ -14,18 +16,18 @@ DEBUG = bool(os.getenv('DEBUG'))
 
 class MailManager:
     """
-    API Class that contain all methods to interact with Email Server
+    API Class that contain all methods to interact with Email Server.
+    Emails are sent in background by its MailDispatcherThreadBody (`dispatcher`), that must be started in a thread
     """
-    def __init__(self, app: Flask, user_class, alert_recipients=None, scheduler: APScheduler = None):
+    def __init__(self, app: Flask, user_dir: UserDirectory, shared_state: SharedState, alert_recipients=None):
         """
         :param app: Target FlaskApp
-        :param user_class: User Class to interact with User DB
+        :param user_dir: Directory of Users, resolving usernames to email addresses
+        :param shared_state: Shared state of Collector processes, keeping the no-disturb users
         :param alert_recipients: Username-List of all user interested on alert mails
-        :param scheduler: APScheduler object, used to postpone email's send
         """
         if alert_recipients is None:
             alert_recipients = []
-        self.scheduler = scheduler
         app.config['MAIL_SERVER'] = MAIL_SERVER
         app.config['MAIL_PORT'] = MAIL_PORT
         app.config['MAIL_USERNAME'] = email_addr
@@ -38,15 +40,23 @@ class MailManager:
 
         self.app = app
         self.mail = Mail(app)
-        self.User = user_class
+        self.dispatcher = MailDispatcherThreadBody(app, self.mail, self.sender)
+        self.users = user_dir
         self.alert_user_ls = alert_recipients
 
-        self.no_disturb_users = set()
+        self.shared = shared_state
 
         if DEBUG:
             with app.app_context():
                 app.logger.warning(f'env var DEBUG={DEBUG}, EMAIL SEND DISABLED!')
 
+    @property
+    def no_disturb_users(self):
+        """
+        :return: Set of usernames that disabled the emails
+        """
+        return self.shared.set_members(SET_NO_DISTURB)
+
     def send_1_email(self, dest, subj, body, date: datetime = None):
         """
         Send an Email forwarding the request to email Server via SMTP
@@ -56,70 +66,46 @@ class MailManager:
         :param date: datetime object to specify postpone send action
         :return:
         """
-        if date and self.scheduler:
-            tim = date.timestamp()
-            j = self.scheduler.add_job(id=f'delay_mail_{tim}', name=f'DelayedMail-{tim}',
-                                       func=lambda: self.send_1_email(dest, subj, body),
-                                       trigger=DateTrigger(run_date=date))
-            return
-        with self.app.app_context():
-            msg = Message(subj, sender=self.sender, recipients=[dest])
-            msg.body = body
-            if not DEBUG:
-                self.mail.send(msg)
+        self.dispatcher.submit(OutgoingMail([dest], subj, body, t_send=date.timestamp() if date else 0.))
 
     def broadcast_alert_email(self, subj, body):
-        self.broadcast_user_email(self.alert_user_ls, subj, body)
+        """
+        Broadcast an alert to `alert_recipients`: alerts close in time are merged in a digest mail
+        """
+        self.broadcast_user_email(self.alert_user_ls, subj, body, digest=True)
 
-    def broadcast_user_email(self, user_ls, subj, body, date: datetime = None):
+    def broadcast_user_email(self, user_ls, subj, body, date: datetime = None, digest=False):
         """
         Broadcast an email to each user in `user_ls` (if username is not in no-disturb-list)
         :param user_ls: List of usernames
         :param subj:
         :param body:
         :param date: datetime object to specify postpone send action
+        :param digest: If True, the email can be merged with others sent to the same users in a short time
         :return:
         """
-        dest_set = set()
-        for username in user_ls:
-            user = self.User.query.filter_by(username=username).first()
-            if user and username not in self.no_disturb_users:
-                dest_set.add(user.email)
-        self.broadcast_email(list(dest_set), subj, body, date)
+        dest_set = self.users.emails(user_ls, exclude=self.no_disturb_users)
+        self.broadcast_email(list(dest_set), subj, body, date, digest)
 
-    def broadcast_email(self, dest_ls, subj, body, date: datetime = None):
+    def broadcast_email(self, dest_ls, subj, body, date: datetime = None, digest=False):
         """
         Send an email to each address in `dest_ls` list
         :param dest_ls: List of email addresses
         :param subj:
         :param body:
         :param date: datetime object to specify postpone send action
+        :param digest: If True, the email can be merged with others sent to the same addresses in a short time
         :return:
         """
         if len(dest_ls) < 1:
             return
-        if date and self.scheduler:
-            tim = date.timestamp()
-            j = self.scheduler.add_job(id=f'delay_mail_{tim}', name=f'DelayedMail-{tim}',
-                                       func=lambda: self.broadcast_email(dest_ls, subj, body),
-                                       trigger=DateTrigger(run_date=date))
-            return
+        self.dispatcher.submit(OutgoingMail(dest_ls, subj, body, self.__disable_info_footer__(), digest,
+                                            date.timestamp() if date else 0.))
 
-        with self.app.app_context():
-            body = self.__add_disable_info_footer__(body)
-            with self.mail.connect() as conn:
-                for dst in dest_ls:
-                    message = body
-                    subject = subj
-                    msg = Message(recipients=[dst],
-                                  body=message,
-                                  subject=subject)
-                    if not DEBUG:
-                        conn.send(msg)
-
-    def __add_disable_info_footer__(self, body):
+    @staticmethod
+    def __disable_info_footer__():
         dis_enable_url = DISABLE_ENABLE_URL
-        body += '\n______________________________________________________________________________\n'
+        body = '\n______________________________________________________________________________\n'
         body += f'\tTo Disable this emails, follow this link: {dis_enable_url}/off \n'
         body += '______________________________________________________________________________\n'
         # body += f'To Re-Enable this emails, follow this link: {dis_enable_url}/on \n'
@@ -131,7 +117,7 @@ class MailManager:
         :param username:
         :return:
         """
-        self.no_disturb_users.add(username)
+        self.shared.set_add(SET_NO_DISTURB, username)
 
     def reactivate_user_email(self, username):
         """
@@ -139,20 +125,20 @@ class MailManager:
         :param username:
         :return:
         """
-        if username in self.no_disturb_users:
-            self.no_disturb_users.remove(username)
+        self.shared.set_remove(SET_NO_DISTURB, username)
 
 
-def setup_mail_manager(app: Flask, user_class, alert_recipients=None):
+def setup_mail_manager(app: Flask, user_dir: UserDirectory, shared_state: SharedState, alert_recipients=None):
     """
     Utility function used to setup Mail manager object
     :param app: FlaskApp
-    :param user_class: ORM User Class
+    :param user_dir: Directory of Users
+    :param shared_state: Shared state of Collector processes
     :param alert_recipients: List of username interested to receive alert emails
     :return: MailManager instance
     """
     if alert_recipients is None:
         alert_recipients = []
-    manager = MailManager(app, user_class, alert_recipients)
+    manager = MailManager(app, user_dir, shared_state, alert_recipients)
 
     return manager
@@ -1,17 +1,14 @@
-import asyncio
 import json
-import ssl
 
 import websockets
 from websockets.legacy.server import WebSocketServerProtocol
 
-from configs.config import USERS, WS_PORT_MSG, WS_PING_TIMEOUT, WS_PING_INTERVAL, WS_CLOSE_TIMEOUT
+from net_io.ws_service import WSNetService
+from utils.shared_state import SharedState, CH_MESSAGES
 
-WS_PORT = WS_PORT_MSG
+from configs.config import USERS, WS_PORT_MSG
 
-PING_TIMEOUT = WS_PING_TIMEOUT
-PING_INTERVAL = WS_PING_INTERVAL
-CLOSE_TIMEOUT = WS_CLOSE_TIMEOUT
+WS_PORT = WS_PORT_MSG
 
 TAG_SYSADMIN = USERS[0]
 TAG_DEPTADMIN = USERS[1]
@@ -49,18 +46,17 @@ class Message:
 
 class MSGManagerThreadBody:
     """
-    Wrapper-Class that implement WebSocketServer interactions.
+    Wrapper-Class that implement the messages WebSocketServer interactions.
+    Messages are published on the shared state, so they reach the clients connected to any Collector process.
     """
-    def __init__(self, cert_file, key_file):
+    def __init__(self, net_service: WSNetService, shared_state: SharedState):
         """
-        Setup SecureWebSocket parameters
-        :param cert_file:
-        :param key_file:
+        :param net_service: Network service running the WebSocket server
+        :param shared_state: Shared state of Collector processes
         """
         self.process = True
-
-        self.ssl_cert = cert_file
-        self.ssl_key = key_file
+        self.net = net_service
+        self.shared = shared_state
 
         # Dictionary structure that contain all Registered WSS, grouped by user-kind
         self.connections = {
@@ -68,6 +64,8 @@ class MSGManagerThreadBody:
             TAG_DEPTADMIN: set(),
             TAG_SYSADMIN: set()
         }
+        net_service.add_server(self.register_ws, WS_PORT)
+        shared_state.subscribe(CH_MESSAGES, self.__on_message__)
 
     def send_message_to(self, dest_tag, head, msg, kind='info', timeout=3):
         """
@@ -83,13 +81,13 @@ class MSGManagerThreadBody:
 
     def __send_1_message__(self, dest_tag, msg_obj: Message):
         """
-        Send a message to desired WSS
+        Send a message to desired WSS (thread-safe)
         :param dest_tag: username-tag
         :param msg_obj:
         :return:
         """
         assert dest_tag in self.connections.keys()
-        websockets.broadcast(self.connections[dest_tag], msg_obj.jsonify())
+        self.shared.publish(CH_MESSAGES, {'dest': dest_tag, 'body': msg_obj.body})
 
     def broadcast_message(self, head, msg, kind='info', timeout=3):
         """
@@ -104,47 +102,35 @@ class MSGManagerThreadBody:
         self.__broadcast_message__(msg_to_send)
 
     def __broadcast_message__(self, msg_obj: Message):
-        for s in self.connections.values():
-            websockets.broadcast(s, msg_obj.jsonify())
+        self.shared.publish(CH_MESSAGES, {'dest': None, 'body': msg_obj.body})
 
-    def __call__(self):
+    def __on_message__(self, data):
         """
-        Setup a Secure WebSocket and define async registration function to WebSocketServer
+        Send a published message to the WSS of this process (`dest` None: all user's Tags)
+        :param data: {dest: username-tag | None, body: Message.body}
         :return:
         """
+        msg_j = json.dumps(data['body'])
+        dest_tag = data['dest']
+        groups = self.connections.values() if dest_tag is None else [self.connections[dest_tag]]
+        for s in groups:
+            self.net.call_soon(websockets.broadcast, s, msg_j)
 
-        evt_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(evt_loop)
-
-        async def register_ws(ws):
-            ws: WebSocketServerProtocol
-            try:
-                tag_ws = await ws.recv()
-                assert tag_ws in self.connections.keys()
-                self.connections[tag_ws].add(ws)
-            except Exception as e:
-                await ws.close(reason=str(e))
-                return
-            try:
-                await ws.wait_closed()
-            finally:
-                self.connections[tag_ws].remove(ws)
-
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        cert_pem = self.ssl_cert
-        key_pem = self.ssl_key
-
-        ssl_context.load_cert_chain(certfile=cert_pem, keyfile=key_pem)
-
-        start_server = websockets.serve(ws_handler=register_ws,
-                                        host="0.0.0.0",
-                                        port=WS_PORT,
-                                        ssl=ssl_context,
-                                        ping_timeout=PING_TIMEOUT,
-                                        ping_interval=PING_INTERVAL,
-                                        close_timeout=CLOSE_TIMEOUT
-                                        )
-
-        asyncio.get_event_loop().run_until_complete(start_server)
-        # print("server Ready and RUN (Updater)")
-        asyncio.get_event_loop().run_forever()
+    async def register_ws(self, ws):
+        """
+        Register a new client, in the group of its user's Tag (first message received)
+        :param ws:
+        :return:
+        """
+        ws: WebSocketServerProtocol
+        try:
+            tag_ws = await ws.recv()
+            assert tag_ws in self.connections.keys()
+            self.connections[tag_ws].add(ws)
+        except Exception as e:
+            await ws.close(reason=str(e))
+            return
+        try:
+            await ws.wait_closed()
+        finally:
+            self.connections[tag_ws].remove(ws)
@@ -13,6 +13,8 @@ class MUCounts:
         self.entrances = []
         self.exits = []
         self.device_id = ''
+        # Sequence number (per MU) of batched updates
+        self.seq = None
         if json_data is not None:
             self.load(json_data)
 
@@ -30,6 +32,8 @@ class MUCounts:
             raise Exception('NO device_id field in JSON')
 
         self.device_id = j_data['device_id']
+        if 'seq' in j_data:
+            self.seq = int(j_data['seq'])
 
         for e in j_data['entrances']:
             self.entrances.append((e[0], e[1]))
@@ -37,10 +41,40 @@ class MUCounts:
         for e in j_data['exits']:
             self.exits.append((e[0], e[1]))
 
+    def get_records(self):
+        """
+        :return: List of (timestamp, entered, exited), one for each timestamp of Entrances/Exits estimations
+        """
+        evts = {}
+        for e in self.entrances:
+            time_s = e[1]
+            if not time_s in evts:
+                evts[time_s] = []
+            evts[time_s].append(('in', e[0]))
+        for e in self.exits:
+            time_s = e[1]
+            if not time_s in evts:
+                evts[time_s] = []
+            evts[time_s].append(('out', e[0]))
+
+        records = []
+        for t, ls in zip(evts.keys(), evts.values()):
+            entered, exits, = 0, 0
+            for e in ls:
+                if e[0] == 'in':
+                    entered = entered + e[1]
+                else:
+                    exits = exits + e[1]
+
+            records.append((int(t), entered, exits))
+        return records
+
     def jsonify(self):
         """
         :return: Json representation of `this`
         """
         obj_d = {'device_id': self.device_id, 'entrances': self.entrances, 'exits': self.exits}
+        if self.seq is not None:
+            obj_d['seq'] = self.seq
         obj_j = json.dumps(obj_d)
         return obj_j
@@ -0,0 +1,130 @@
+import json
+import math
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    orjson = None
+    _loads = json.loads
+    _JSONDecodeError = json.JSONDecodeError
+
+DEVICE_ID_MAX_LEN = 32
+# Ranges of DB columns: timestamps and sequence numbers are BIGINT, counts are INTEGER
+BIGINT_MAX = 2 ** 63 - 1
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+
+class MUCountsFormatError(ValueError):
+    """
+    Malformed MU update message (the message reports the offending field)
+    """
+    pass
+
+
+class MUCountsRecords:
+    """
+    Decoded MU update: Entrances/Exits already aggregated for each timestamp
+    """
+    __slots__ = ('device_id', 'seq', 'records')
+
+    def __init__(self, device_id, seq, records):
+        """
+        :param device_id: MU's ID
+        :param seq: Sequence number (per MU) of batched updates, or None
+        :param records: List of (timestamp, entered, exited)
+        """
+        self.device_id = device_id
+        self.seq = seq
+        self.records = records
+
+    def get_records(self):
+        """
+        :return: List of (timestamp, entered, exited), one for each timestamp of Entrances/Exits estimations
+        """
+        return self.records
+
+
+def _check_evt(field, i, e):
+    """
+    Slow path: validate (and normalize) a single [count, timestamp] event
+    :return: (count, int timestamp)
+    """
+    if type(e) is not list or len(e) != 2:
+        raise MUCountsFormatError(f'{field}[{i}]: expected [count, timestamp]')
+    n, t = e
+    if type(n) is not int:
+        raise MUCountsFormatError(f'{field}[{i}][0]: count must be an integer, not {type(n).__name__}')
+    if not INT32_MIN <= n <= INT32_MAX:
+        raise MUCountsFormatError(f'{field}[{i}][0]: count out of range')
+    if type(t) is float:
+        # NaN/Infinity are accepted by the stdlib JSON parser
+        if not math.isfinite(t):
+            raise MUCountsFormatError(f'{field}[{i}][1]: timestamp must be finite')
+        t = int(t)
+    elif type(t) is not int:
+        raise MUCountsFormatError(f'{field}[{i}][1]: timestamp must be a number, not {type(t).__name__}')
+    if not 0 <= t <= BIGINT_MAX:
+        raise MUCountsFormatError(f'{field}[{i}][1]: timestamp out of range')
+    return n, t
+
+
+def _aggregate(evts, field, idx, agg):
+    """
+    Add `evts` counts ([[count, timestamp], ...]) to `agg` {timestamp: [entered, exited]}, at position `idx`
+    """
+    if type(evts) is not list:
+        raise MUCountsFormatError(f'{field}: expected a list')
+    agg_get = agg.get
+    for i, e in enumerate(evts):
+        if type(e) is list and len(e) == 2 and type(e[0]) is int and type(e[1]) is int \
+                and INT32_MIN <= e[0] <= INT32_MAX and 0 <= e[1] <= BIGINT_MAX:
+            n, t = e
+        else:
+            n, t = _check_evt(field, i, e)
+        counts = agg_get(t)
+        if counts is None:
+            counts = agg[t] = [0, 0]
+        counts[idx] += n
+        if not INT32_MIN <= counts[idx] <= INT32_MAX:
+            raise MUCountsFormatError(f'{field}: total count of timestamp {t} out of range')
+
+
+def decode_mucounts(data, require_seq=False):
+    """
+    Parse and validate a MU update message, aggregating Entrances/Exits for each timestamp in one pass
+    (`orjson` is used if installed)
+    :param data: JSON message (bytes or str): {device_id, [seq], entrances: [[n, t], ...], exits: [[n, t], ...]}
+    :param require_seq: Reject messages without a sequence number
+    :return: MUCountsRecords
+    """
+    try:
+        obj = _loads(data)
+    except (_JSONDecodeError, UnicodeDecodeError) as e:
+        raise MUCountsFormatError(f'Invalid JSON: {e}')
+    if type(obj) is not dict:
+        raise MUCountsFormatError('Expected a JSON object')
+
+    device_id = obj.get('device_id')
+    if type(device_id) is not str or not device_id:
+        raise MUCountsFormatError('device_id: expected a non-empty string')
+    if len(device_id) > DEVICE_ID_MAX_LEN:
+        raise MUCountsFormatError(f'device_id: longer than {DEVICE_ID_MAX_LEN} chars')
+
+    seq = obj.get('seq')
+    if seq is None:
+        if require_seq:
+            raise MUCountsFormatError('seq: missing')
+    elif type(seq) is not int or not 0 <= seq <= BIGINT_MAX:
+        raise MUCountsFormatError('seq: expected a non-negative (64 bit) integer')
+
+    for field in ('entrances', 'exits'):
+        if field not in obj:
+            raise MUCountsFormatError(f'{field}: missing')
+    agg = {}
+    _aggregate(obj['entrances'], 'entrances', 0, agg)
+    _aggregate(obj['exits'], 'exits', 1, agg)
+
+    return MUCountsRecords(device_id, seq, [(t, c[0], c[1]) for t, c in agg.items()])
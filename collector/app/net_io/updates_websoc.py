@@ -1,81 +1,131 @@
-import asyncio
 import json
-import ssl
 
 import websockets
 
-from configs.config import WS_PORT_UPDATES, WS_PING_TIMEOUT, WS_PING_INTERVAL, WS_CLOSE_TIMEOUT
+from net_io.ws_service import WSNetService
 
-WS_PORT = WS_PORT_UPDATES
+from configs.config import WS_PORT_UPDATES, UPDATES_COALESCE_WINDOW_S
 
-PING_TIMEOUT = WS_PING_TIMEOUT
-PING_INTERVAL = WS_PING_INTERVAL
-CLOSE_TIMEOUT = WS_CLOSE_TIMEOUT
+WS_PORT = WS_PORT_UPDATES
 
 
 class UpdateManagerThreadBody:
     """
-    Implementation of thread that take care of broadcast updates on Counts Estimations
-    (Persons: Entered/Exited/Estimated-Inside)
+    Counts-updates WebSocket server, that take care of broadcast updates on Counts Estimations
+    (Persons: Entered/Exited/Estimated-Inside).
+    Broadcast requests are coalesced: the first request arms a timer of `coalesce_window` seconds, and at its
+    expiration the current Counts (read from the updates source) are serialized once and sent only if changed.
+    The updates source can block (locks, DB), so it is run in a worker thread, never on the network loop.
     """
-    def __init__(self, init_updates, cert_file, key_file):
+    def __init__(self, init_updates, net_service: WSNetService, coalesce_window=UPDATES_COALESCE_WINDOW_S):
         """
         :param init_updates: init value to be broadcasted
-        :param cert_file: public_cert.pem
-        :param key_file: private_key.pem
+        :param net_service: Network service running the WebSocket server
+        :param coalesce_window: seconds
         """
         self.init_updates = init_updates
         self.process = True
-        self.ssl_cert = cert_file
-        self.ssl_key = key_file
+        self.net = net_service
         self.connections = set()
         self.some_error = False
 
+        self.coalesce_window = coalesce_window
+        self.source = None
+        self.timer = None
+        # Updates source running in a worker thread, and requests received meanwhile
+        self.computing = False
+        self.rearm = False
+        # Touched only on the network service loop
+        self.stats = {'requested': 0, 'coalesced': 0, 'unchanged': 0, 'sent': 0, 'source_errors': 0}
+        net_service.add_server(self.register_ws_upd, WS_PORT)
+
+    def set_source(self, source):
+        """
+        :param source: function() that return the current updates: {tot: z, in: x, out: y, error: bool}
+        :return:
+        """
+        self.source = source
+
+    def schedule_broadcast(self):
+        """
+        Request a broadcast of current Counts estimations (thread-safe), coalesced with other requests
+        of the same window
+        :return:
+        """
+        if self.net.is_serving():
+            self.net.call_soon(self.__arm__)
+
+    def __arm__(self):
+        self.stats['requested'] += 1
+        if self.timer is not None or self.computing:
+            self.stats['coalesced'] += 1
+            # The source may be read before this request: read it again when done
+            self.rearm = self.rearm or self.computing
+            return
+        self.timer = self.net.loop.call_later(self.coalesce_window, self.__tick__)
+
+    def __tick__(self):
+        self.timer = None
+        if self.source is None:
+            return
+        self.computing = True
+        fut = self.net.loop.run_in_executor(None, lambda: json.dumps(self.source()))
+        fut.add_done_callback(self.__on_payload__)
+
+    def __on_payload__(self, fut):
+        """
+        Run on the network service loop, when the updates source returns
+        """
+        self.computing = False
+        if fut.exception() is not None:
+            self.stats['source_errors'] += 1
+        else:
+            self.__broadcast__(fut.result())
+        if self.rearm:
+            self.rearm = False
+            self.timer = self.net.loop.call_later(self.coalesce_window, self.__tick__)
+
     def broadcast_update(self, data: dict):
         """
-        Send to all registered client the current Counts estimations.
+        Send to all registered client the given Counts estimations (thread-safe), without coalescing.
         Furthermore, add a new field to `data` dict, that represent if there is some error in PeopleCounts estimation
         :param data: {in: x, out: y, tot: z}
         :return:
         """
+        if not self.net.is_serving():
+            return
         data['error'] = self.some_error
         data_j = json.dumps(data)
-        websockets.broadcast(self.connections, data_j)
+        self.net.call_soon(self.__broadcast__, data_j)
+
+    def __broadcast__(self, data_j):
+        """
+        Run on the network service loop, that owns the connections. Unchanged payloads are not sent
+        """
+        if data_j == self.init_updates:
+            self.stats['unchanged'] += 1
+            return
         self.init_updates = data_j
+        websockets.broadcast(self.connections, data_j)
+        self.stats['sent'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['suppressed'] = stats['coalesced'] + stats['unchanged']
+        stats['clients'] = len(self.connections)
+        return stats
 
-    def __call__(self):
+    async def register_ws_upd(self, ws):
         """
-        Setup a Secure WebSocket and define async registration-function to WebSocketServer
+        Register a new client, sending it the current Counts estimations
+        :param ws:
         :return:
         """
-        evt_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(evt_loop)
-
-        async def register_ws_upd(ws):
-            # ws: WebSocketServerProtocol
-            # print('Connection Opened (Updates)')
-            self.connections.add(ws)
-            try:
-                await ws.send(self.init_updates)
-                await ws.wait_closed()
-            finally:
-                self.connections.remove(ws)
-
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        cert_pem = self.ssl_cert
-        key_pem = self.ssl_key
-
-        ssl_context.load_cert_chain(certfile=cert_pem, keyfile=key_pem)
-
-        start_server = websockets.serve(ws_handler=register_ws_upd,
-                                        host="0.0.0.0",
-                                        port=WS_PORT,
-                                        ssl=ssl_context,
-                                        ping_timeout=PING_TIMEOUT,
-                                        ping_interval=PING_INTERVAL,
-                                        close_timeout=CLOSE_TIMEOUT
-                                        )
-
-        asyncio.get_event_loop().run_until_complete(start_server)
-        # print("server Ready and RUN (Updater)")
-        asyncio.get_event_loop().run_forever()
+        # ws: WebSocketServerProtocol
+        # print('Connection Opened (Updates)')
+        self.connections.add(ws)
+        try:
+            await ws.send(self.init_updates)
+            await ws.wait_closed()
+        finally:
+            self.connections.remove(ws)
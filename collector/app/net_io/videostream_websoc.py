@@ -1,5 +1,4 @@
 import asyncio
-import pickle
 import queue
 import ssl
 import time
@@ -10,7 +9,10 @@ from websockets.exceptions import ConnectionClosedError
 from websockets.legacy.client import WebSocketClientProtocol
 from websockets.legacy.server import WebSocketServerProtocol
 
+from net_io.frame_protocol import EncodedFrame, FrameProtocolError, CODEC_JPEG
+from net_io.ws_service import WSNetService
 from utils.frames_dict import FramesDict
+from utils.shared_state import SharedState
 
 from configs.config import WS_PORT_VIDEO, WS_PING_TIMEOUT, WS_PING_INTERVAL, WS_CLOSE_TIMEOUT, video_token
 
@@ -23,94 +25,80 @@ CLOSE_TIMEOUT = WS_CLOSE_TIMEOUT
 
 class VideoGatherThreadBody:
     """
-    Thread-Body that setup and receive debug-frames stream from MUs
+    Video-gather WebSocket server: receive debug-frames stream from MUs
     """
-    def __init__(self, f_dict: FramesDict, cert_file, key_file):
+    def __init__(self, f_dict: FramesDict, net_service: WSNetService, shared_state: SharedState):
         """
         :param f_dict: FrameDictionary object, to keep in memory the last frame sent form each MU
-        :param cert_file: public_cert.pem
-        :param key_file: private_key.pem
+        :param net_service: Network service running the WebSocket server
+        :param shared_state: Shared state, where frames are published to other Collector processes
         """
         self.frames_dict = f_dict
+        self.shared = shared_state
         self.process = True
-        self.ssl_cert = cert_file
-        self.ssl_key = key_file
+        net_service.add_server(self.get_frames, WS_PORT)
 
-    def __call__(self):
+    async def get_frames(self, ws):
         """
-        Setup the Secure WebSocket, defining the callback function that receive frames from a MU
+        Callback function that receive frames from a MU
+        :param ws:
         :return:
         """
-        evt_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(evt_loop)
-
-        async def get_frames(ws):
-            ws: WebSocketServerProtocol
-            # print('Connection Opened')
-            listen = True
-            sent = None
-
-            send_ack = 0
-
-            msg = await ws.recv()
-            if msg != video_token:
-                await ws.close(code=404)
-
-            while listen:
-                try:
-                    # if sent is not None and sent.cr_running:
-                    #     print('\n... sent.cr_running ...\n')
-                    if sent is not None:
-                        await sent
-                        sent = None
-                    msg = await ws.recv()
-                    (dev_id, img) = pickle.loads(msg)
-                    self.frames_dict.add_frame(dev_id, img)
-
-                    send_ack = (send_ack + 1) % 100
-                    if send_ack == 0:
-                        sent = ws.send('OK')
-                except ConnectionClosedError as e:
-                    log(ERROR, f'[WS-Handler]: {e}')
-                    listen = False
-            # print('')
-            # print('Connection Closed')
-
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        cert_pem = self.ssl_cert
-        key_pem = self.ssl_key
-
-        ssl_context.load_cert_chain(certfile=cert_pem, keyfile=key_pem)
-
-        start_server = websockets.serve(ws_handler=get_frames,
-                                        host="0.0.0.0",
-                                        port=WS_PORT,
-                                        ssl=ssl_context,
-                                        ping_timeout=PING_TIMEOUT,
-                                        ping_interval=PING_INTERVAL,
-                                        close_timeout=CLOSE_TIMEOUT
-                                        )
-
-        asyncio.get_event_loop().run_until_complete(start_server)
-        # print("server Ready and RUN")
-        asyncio.get_event_loop().run_forever()
+        ws: WebSocketServerProtocol
+        # print('Connection Opened')
+        listen = True
+        sent = None
+
+        send_ack = 0
+
+        msg = await ws.recv()
+        if msg != video_token:
+            await ws.close(code=404)
+
+        while listen:
+            try:
+                # if sent is not None and sent.cr_running:
+                #     print('\n... sent.cr_running ...\n')
+                if sent is not None:
+                    await sent
+                    sent = None
+                msg = await ws.recv()
+                frame = EncodedFrame.unpack(msg)
+                self.frames_dict.add_frame(frame.device_id, frame)
+                self.shared.put_frame(frame)
+
+                send_ack = (send_ack + 1) % 100
+                if send_ack == 0:
+                    sent = ws.send('OK')
+            except FrameProtocolError as e:
+                log(ERROR, f'[WS-Handler]: {e}')
+            except ConnectionClosedError as e:
+                log(ERROR, f'[WS-Handler]: {e}')
+                listen = False
+        # print('')
+        # print('Connection Closed')
 
 
 class VideoStreamerThreadBody:
     """
     Thread body to use to interact with Frames-gather Server-Side WSS
     """
-    def __init__(self, serv_addr='localhost', host_id='host_name', ca_file='ca_cert.pem'):
+    def __init__(self, serv_addr='localhost', host_id='host_name', ca_file='ca_cert.pem', codec=CODEC_JPEG, quality=80):
         """
         :param serv_addr:
         :param host_id: Hostname used to be identified from Server-Side
         :param ca_file: Full-chain certificate to believe in
+        :param codec: Frames encoding sent to the Server (CODEC_JPEG | CODEC_WEBP)
+        :param quality: Encoder quality [0-100]
         """
         self.q_frames = queue.Queue(maxsize=30)
         self.uri = f"wss://{serv_addr}:{WS_PORT}"
         self.ca_file = ca_file
         self.process = True
         self.my_name = host_id
+        self.codec = codec
+        self.quality = quality
+        self.seq = 0
 
     def __call__(self):
         """
@@ -170,7 +158,8 @@ class VideoStreamerThreadBody:
                                 read_ack = (read_ack + 1) % 100
 
                                 f = self.q_frames.get_nowait()
-                                msg = pickle.dumps((self.my_name, f))
+                                self.seq = (self.seq + 1) % 2 ** 32
+                                msg = EncodedFrame.from_image(self.my_name, self.seq, f, self.codec, self.quality).pack()
                                 # await ping
                                 await ws.send(msg)
                                 # print("sent msg")
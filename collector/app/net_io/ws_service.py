@@ -0,0 +1,139 @@
+import asyncio
+import ssl
+import threading
+
+import websockets
+
+from configs.config import WS_PING_TIMEOUT, WS_PING_INTERVAL, WS_CLOSE_TIMEOUT
+
+PING_TIMEOUT = WS_PING_TIMEOUT
+PING_INTERVAL = WS_PING_INTERVAL
+CLOSE_TIMEOUT = WS_CLOSE_TIMEOUT
+
+
+class WSNetService:
+    """
+    Single asyncio network service of the Collector: all Secure WebSocket servers (video-gather, counts-updates,
+    messages) run on one event loop, in one thread, sharing one TLS context.
+    Sockets are owned by the loop: sync code (Flask workers, background threads) must use :meth:`call_soon` to act
+    on them. The service runs only in the process holding the network leadership: elsewhere (or before the servers
+    are started) submissions are dropped, as there are no connections to act on.
+    """
+    def __init__(self, cert_file, key_file):
+        """
+        :param cert_file: public_cert.pem
+        :param key_file: private_key.pem
+        """
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+
+        self.loop = asyncio.new_event_loop()
+        self.servers = []
+        # Set while the servers are running
+        self.ready = threading.Event()
+        # Cleared by stop(): checked (holding `self.lock`) once the servers are started
+        self.process = True
+        self.lock = threading.Lock()
+        # Thread of the last run
+        self.thread = None
+        self.stats = {'dropped_calls': 0}
+
+    def add_server(self, ws_handler, port):
+        """
+        Register a WebSocket server, started together with the service
+        :param ws_handler: async function(ws)
+        :param port:
+        :return:
+        """
+        self.servers.append((ws_handler, port))
+
+    def is_serving(self):
+        """
+        :return: True if the servers run in this process
+        """
+        return self.ready.is_set()
+
+    def call_soon(self, callback, *args):
+        """
+        Thread-safe submission of a (sync) callback, run on the service loop
+        :param callback:
+        :param args:
+        :return: False if the callback is dropped (service not running)
+        """
+        if not self.ready.is_set():
+            self.stats['dropped_calls'] += 1
+            return False
+        self.loop.call_soon_threadsafe(callback, *args)
+        return True
+
+    def submit(self, coro):
+        """
+        Thread-safe submission of a coroutine, run on the service loop
+        :param coro:
+        :return: concurrent.futures.Future of the coroutine result, or None if the service is not running
+        """
+        if not self.ready.is_set():
+            coro.close()
+            self.stats['dropped_calls'] += 1
+            return None
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def start(self):
+        """
+        Run the service in a new thread, e.g. when the network leadership is acquired. A previous run is waited for
+        (it must have been stopped), as the event loop can be run by one thread at a time
+        :return:
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive() and self.process:
+                return
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            self.process = True
+        self.thread = threading.Thread(target=self)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the servers and the event loop (thread-safe), e.g. when the network leadership is lost. If the servers
+        are still starting, they are closed as soon as they are started
+        :return:
+        """
+        with self.lock:
+            self.process = False
+            if self.ready.is_set():
+                self.ready.clear()
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def __call__(self):
+        """
+        Start all registered servers and run the event loop forever
+        :return:
+        """
+        asyncio.set_event_loop(self.loop)
+        ws_servers = []
+        try:
+            for ws_handler, port in self.servers:
+                start_server = websockets.serve(ws_handler=ws_handler,
+                                                host="0.0.0.0",
+                                                port=port,
+                                                ssl=self.ssl_context,
+                                                ping_timeout=PING_TIMEOUT,
+                                                ping_interval=PING_INTERVAL,
+                                                close_timeout=CLOSE_TIMEOUT
+                                                )
+                ws_servers.append(self.loop.run_until_complete(start_server))
+            with self.lock:
+                serve = self.process
+                if serve:
+                    self.ready.set()
+            if serve:
+                # Until stop() (possibly already requested)
+                self.loop.run_forever()
+        finally:
+            # Stopped: close servers (and their connections), so that ports are released
+            self.ready.clear()
+            for ws_server in ws_servers:
+                ws_server.close()
+                self.loop.run_until_complete(ws_server.wait_closed())
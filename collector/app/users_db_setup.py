@@ -7,7 +7,7 @@ from configs.config import USERS, USERS_PASS, USERS_EMAIL, USER_DB_LOCATION
 
 print(f'__name__ = {__name__}')
 app = Flask(__name__)
-db, User = login_setup(app)
+db, User, _, _ = login_setup(app)
 
 
 def add_user(username, password, mail):
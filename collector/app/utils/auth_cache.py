@@ -0,0 +1,177 @@
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+from utils.shared_state import CH_AUTH_CACHE, SET_SIGNATURES, ExpiringSet
+
+from configs.config import AUTH_CACHE_TTL_S, AUTH_CACHE_MAX_ENTRIES, MU_AUTH_KEYS, AUTH_SIGNATURE_MAX_SKEW_S
+
+# Header of HMAC-signed requests: "<username>:<timestamp>:<hex HMAC-SHA256>"
+SIGNATURE_HEADER = 'X-MU-Signature'
+
+
+def signature_message(ts, method, full_path, body: bytes):
+    """
+    :return: Signed bytes of a request: "<timestamp>\\n<method>\\n<path?query>\\n" + body
+    """
+    return f'{ts}\n{method}\n{full_path}\n'.encode() + body
+
+
+def sign_request(key: str, ts, method, full_path, body: bytes):
+    """
+    :param key: Secret key of the signing MU (see `MU_AUTH_KEYS`)
+    :return: Hex HMAC-SHA256 of the request
+    """
+    return hmac.new(key.encode(), signature_message(ts, method, full_path, body), hashlib.sha256).hexdigest()
+
+
+def verify_signature(header: str, method, full_path, body: bytes, keys=MU_AUTH_KEYS,
+                     max_skew_s=AUTH_SIGNATURE_MAX_SKEW_S, seen=None):
+    """
+    :param header: SIGNATURE_HEADER value
+    :param method: Request method
+    :param full_path: Request path, with query string (if any)
+    :param body: Request body
+    :param keys: {username: secret key}
+    :param max_skew_s: Max difference (seconds) between the signature timestamp and now
+    :param seen: SeenSignatures (optional): signatures already accepted are rejected (replays)
+    :return: Username of the signing MU, or None if the signature is not valid
+    """
+    try:
+        username, ts, digest = header.split(':', 2)
+        key = keys[username]
+        ts_int = int(ts)
+        if abs(time.time() - ts_int) > max_skew_s:
+            return None
+    except (KeyError, ValueError):
+        return None
+    if not hmac.compare_digest(sign_request(key, ts, method, full_path, body), digest):
+        return None
+    if seen is not None and not seen.add(f'{username}:{ts_int}:{digest}', ts_int + max_skew_s):
+        return None
+    return username
+
+
+class SeenSignatures:
+    """
+    Accepted signatures, kept until their timestamp falls out of the allowed clock skew (then they are rejected
+    anyway), so that a captured signed request cannot be replayed.
+    Signatures are claimed in the state shared by all Collector processes, so a request accepted by a process is
+    rejected by the others too.
+    """
+    def __init__(self, shared_state=None):
+        """
+        :param shared_state: Shared state of Collector processes (if None, signatures are kept by this process only)
+        """
+        self.shared = shared_state
+        self.local = ExpiringSet()
+        self.lock = threading.Lock()
+        self.stats = {'accepted': 0, 'replays': 0}
+
+    def add(self, signature: str, t_expire):
+        """
+        :param signature: "<username>:<timestamp>:<digest>"
+        :param t_expire: Timestamp after which `signature` is too old to be accepted
+        :return: False if `signature` was already seen (replay)
+        """
+        if self.shared is not None:
+            accepted = self.shared.claim(SET_SIGNATURES, signature, t_expire)
+        else:
+            accepted = self.local.add(signature, t_expire)
+        with self.lock:
+            self.stats['accepted' if accepted else 'replays'] += 1
+        return accepted
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+class AuthCache:
+    """
+    Successful HTTP Basic credentials verifications, so that MUs sending updates skip the password hash derivation
+    on each request. Entries are keyed on (username, keyed digest of the password) (plain passwords are not kept),
+    expire after `AUTH_CACHE_TTL_S` seconds and are evicted LRU beyond `AUTH_CACHE_MAX_ENTRIES`; entries of a user
+    are dropped in all Collector processes when its password is changed.
+    Each entry keeps the password hash it was verified against, and it is valid only while that is the user's
+    current hash: a verification made on a stale User directory and cached after the invalidation is never used.
+    """
+    def __init__(self, secret_key: str, shared_state=None, ttl=AUTH_CACHE_TTL_S, max_entries=AUTH_CACHE_MAX_ENTRIES):
+        """
+        :param secret_key: Key of the password digests
+        :param shared_state: Shared state of Collector processes (optional), used to invalidate their caches
+        :param ttl: Max age (seconds) of a verification
+        :param max_entries:
+        """
+        self.key = (secret_key or '').encode()
+        self.shared = shared_state
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # {(username, digest): (t_expire, user_id, password hash)}
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        # Accepted HMAC signatures, see verify_signature()
+        self.signatures = SeenSignatures(shared_state)
+        if shared_state is not None:
+            shared_state.subscribe(CH_AUTH_CACHE, self.__on_invalidate__)
+
+    def __digest__(self, password: str):
+        return hmac.new(self.key, password.encode(), hashlib.sha256).digest()
+
+    def get(self, username: str, password: str, pw_hash: str):
+        """
+        :param pw_hash: Current password hash of the user
+        :return: User's ID of verified credentials, or None
+        """
+        key = (username, self.__digest__(password))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time() and entry[2] == pw_hash:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, username: str, password: str, user_id, pw_hash: str):
+        """
+        Remember credentials verified against the Users DB
+        :param pw_hash: Password hash the credentials were verified against
+        """
+        if self.max_entries <= 0:
+            return
+        key = (username, self.__digest__(password))
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, user_id, pw_hash)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_user(self, username: str):
+        """
+        Drop cached verifications of `username` (password changed), in all Collector processes
+        :param username:
+        :return:
+        """
+        if self.shared is not None:
+            self.shared.publish(CH_AUTH_CACHE, {'username': username})
+        else:
+            self.__on_invalidate__({'username': username})
+
+    def __on_invalidate__(self, data):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == data['username']]:
+                del self.entries[key]
+            self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+        stats['signatures'] = self.signatures.get_stats()
+        return stats
@@ -0,0 +1,241 @@
+import bisect
+import threading
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from flask import Flask
+
+from db.db_base import Session
+from endpoints.queries_utils import get_next_closedays_set
+from utils.shared_state import SharedState, CH_CALENDAR
+
+from configs.config import DEFAULT_TIMEZONE, NIGHT_TIMERANGE, WEEK_CLOSE_DAYS, CALENDAR_HORIZON_DAYS
+
+
+class BuildingCalendar:
+    """
+    Opening hours of the building: sorted closing time-ranges (nights, `WEEK_CLOSE_DAYS` and close days), for a
+    rolling horizon of `CALENDAR_HORIZON_DAYS` days.
+    Each day is closed from `NIGHT_TIMERANGE[0]` to `NIGHT_TIMERANGE[1]` of the next day, and close days (or weekly
+    close days) are closed for the whole day; overlapping or contiguous closures are merged.
+    Boundaries are computed on local wall-clock hours of `DEFAULT_TIMEZONE` and kept as POSIX timestamps, so lookups
+    are correct across DST changes. Naive datetimes are considered local.
+    """
+    def __init__(self, flsk_app: Flask, shared_state: SharedState, horizon_days=CALENDAR_HORIZON_DAYS,
+                 tz_name=DEFAULT_TIMEZONE):
+        """
+        :param flsk_app:
+        :param shared_state: Shared state of Collector processes, used to notify close-days changes
+        :param horizon_days: Number of days covered by the calendar
+        :param tz_name: Building timezone
+        """
+        self.app = flsk_app
+        self.shared = shared_state
+        self.horizon_days = horizon_days
+        self.tz = ZoneInfo(tz_name)
+        self.lock = threading.Lock()
+        # Closing time-ranges [starts[i], ends[i]), sorted and disjoint
+        self.starts = []
+        self.ends = []
+        self.close_days = set()
+        self.day_from = None
+        self.day_to = None
+        self.stats = {'builds': 0, 'splices': 0}
+        shared_state.subscribe(CH_CALENDAR, self.__on_change__)
+
+    def __ts__(self, day: date, hour=0):
+        return datetime.combine(day, time(hour), tzinfo=self.tz).timestamp()
+
+    def __to_ts__(self, dt: datetime):
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=self.tz)
+        return dt.timestamp()
+
+    def __to_dt__(self, ts):
+        """
+        :return: Naive local datetime
+        """
+        return datetime.fromtimestamp(ts, self.tz).replace(tzinfo=None)
+
+    def __is_close_day__(self, day: date):
+        return day.weekday() in WEEK_CLOSE_DAYS or day in self.close_days
+
+    def __day_ranges__(self, day: date):
+        """
+        :return: Closing time-ranges that start in `day`
+        """
+        ranges = [(self.__ts__(day, NIGHT_TIMERANGE[0]), self.__ts__(day + timedelta(days=1), NIGHT_TIMERANGE[1]))]
+        if self.__is_close_day__(day):
+            ranges.append((self.__ts__(day), self.__ts__(day + timedelta(days=1))))
+        return ranges
+
+    @staticmethod
+    def __merge__(ranges):
+        """
+        :param ranges: List of (start, end)
+        :return: Sorted list of disjoint (start, end), merging overlapping or contiguous ranges
+        """
+        merged = []
+        for start, end in sorted(ranges):
+            if len(merged) > 0 and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1][1] = end
+            else:
+                merged.append([start, end])
+        return merged
+
+    def __build__(self, day_from: date):
+        """
+        Rebuild the whole calendar, from `day_from`. Must be called holding `self.lock`
+        """
+        day_to = day_from + timedelta(days=self.horizon_days)
+        session = Session()
+        try:
+            self.close_days = set(get_next_closedays_set(day_from, self.horizon_days, session))
+        finally:
+            session.close()
+        ranges = []
+        day = day_from - timedelta(days=2)
+        while day <= day_to:
+            ranges += self.__day_ranges__(day)
+            day += timedelta(days=1)
+        merged = self.__merge__(ranges)
+        self.starts = [r[0] for r in merged]
+        self.ends = [r[1] for r in merged]
+        self.day_from, self.day_to = day_from, day_to
+        self.stats['builds'] += 1
+
+    def __splice__(self, day_1: date, day_2: date):
+        """
+        Recompute the closing time-ranges of days [day_1, day_2] only. Must be called holding `self.lock`
+        """
+        t_1, t_2 = self.__ts__(day_1), self.__ts__(day_2 + timedelta(days=1))
+        # Contiguous ranges are affected too (they could be merged)
+        i = bisect.bisect_left(self.ends, t_1)
+        j = bisect.bisect_right(self.starts, t_2)
+        # Keep the parts of affected ranges outside [t_1, t_2), and add again ranges inside it
+        ranges = []
+        for start, end in zip(self.starts[i:j], self.ends[i:j]):
+            if start < t_1:
+                ranges.append((start, t_1))
+            if end > t_2:
+                ranges.append((t_2, end))
+        day = day_1 - timedelta(days=2)
+        while day <= day_2:
+            for start, end in self.__day_ranges__(day):
+                start, end = max(start, t_1), min(end, t_2)
+                if start < end:
+                    ranges.append((start, end))
+            day += timedelta(days=1)
+        merged = self.__merge__(ranges)
+        self.starts[i:j] = [r[0] for r in merged]
+        self.ends[i:j] = [r[1] for r in merged]
+        self.stats['splices'] += 1
+
+    def __ensure__(self, ts):
+        """
+        Roll the calendar horizon, if `ts` is not well inside it. Must be called holding `self.lock`
+        """
+        if self.day_from is not None and \
+                self.__ts__(self.day_from) <= ts < self.__ts__(self.day_to - timedelta(days=self.horizon_days // 2)):
+            return
+        self.__build__(self.__to_dt__(ts).date() - timedelta(days=1))
+
+    def __find__(self, ts):
+        """
+        :return: Index of the closing time-range containing `ts`, or -1
+        """
+        i = bisect.bisect_right(self.starts, ts) - 1
+        if i >= 0 and ts < self.ends[i]:
+            return i
+        return -1
+
+    def is_closed(self, dt: datetime):
+        """
+        :param dt:
+        :return: True if the building is closed at `dt`
+        """
+        ts = self.__to_ts__(dt)
+        with self.lock:
+            self.__ensure__(ts)
+            return self.__find__(ts) >= 0
+
+    def next_transition(self, dt: datetime):
+        """
+        :param dt:
+        :return: First datetime after `dt` when the building opens (if closed at `dt`) or closes (if open)
+        """
+        ts = self.__to_ts__(dt)
+        with self.lock:
+            self.__ensure__(ts)
+            i = self.__find__(ts)
+            if i >= 0:
+                return self.__to_dt__(self.ends[i])
+            return self.__to_dt__(self.starts[bisect.bisect_right(self.starts, ts)])
+
+    def get_close_range(self, dt_from: datetime):
+        """
+        :param dt_from:
+        :return: datetime Tuple: (start_close, end_close) of the closing time-range containing `dt_from` (starting
+        from `dt_from`) or, if the building is open, of the next one
+        """
+        ts = self.__to_ts__(dt_from)
+        with self.lock:
+            self.__ensure__(ts)
+            i = self.__find__(ts)
+            if i >= 0:
+                return dt_from, self.__to_dt__(self.ends[i])
+            i = bisect.bisect_right(self.starts, ts)
+            return self.__to_dt__(self.starts[i]), self.__to_dt__(self.ends[i])
+
+    def is_close_date(self, day: date):
+        """
+        :param day:
+        :return: True if `day` is a close-day (or a weekly close day)
+        """
+        with self.lock:
+            self.__ensure__(self.__ts__(day))
+            return self.__is_close_day__(day)
+
+    def is_night_range(self, dt_start: datetime, dt_end: datetime):
+        """
+        :param dt_start:
+        :param dt_end:
+        :return: True if the time-range is not longer than the night that contains `dt_start`
+        """
+        assert dt_start <= dt_end
+        day = dt_start.date()
+        if dt_start.hour < NIGHT_TIMERANGE[0]:
+            day -= timedelta(days=1)
+        night_s = self.__ts__(day + timedelta(days=1), NIGHT_TIMERANGE[1]) - self.__ts__(day, NIGHT_TIMERANGE[0])
+        return self.__to_ts__(dt_end) - self.__to_ts__(dt_start) <= night_s
+
+    def close_days_changed(self, day_1: date, day_2: date):
+        """
+        Update the calendars of all Collector processes, after close days in [day_1, day_2] were added or removed
+        :param day_1:
+        :param day_2:
+        :return:
+        """
+        self.shared.publish(CH_CALENDAR, {'from': day_1.isoformat(), 'to': day_2.isoformat()})
+
+    def __on_change__(self, data):
+        day_1, day_2 = date.fromisoformat(data['from']), date.fromisoformat(data['to'])
+        with self.lock:
+            if self.day_from is None or day_2 < self.day_from or day_1 > self.day_to:
+                return
+            day_1, day_2 = max(day_1, self.day_from), min(day_2, self.day_to)
+            session = Session()
+            try:
+                days = get_next_closedays_set(day_1, (day_2 - day_1).days, session)
+            finally:
+                session.close()
+            self.close_days = {d for d in self.close_days if not day_1 <= d <= day_2} | days
+            self.__splice__(day_1, day_2)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['ranges'] = len(self.starts)
+            stats['days'] = [str(self.day_from), str(self.day_to)]
+        return stats
@@ -0,0 +1,105 @@
+import json
+import threading
+
+from flask import Flask
+from sqlalchemy import event
+
+from db.counts_writer import rollup_deltas
+from net_io.updates_websoc import UpdateManagerThreadBody
+from utils.counts_engine import CountsEngine
+from utils.shared_state import SharedState, CH_COUNTS_FEED
+
+from configs.config import CHANGE_FEED_MAX_PAYLOAD
+
+FEED_BUCKET_S = 60
+
+
+def counts_feed_payload(rows, max_payload=CHANGE_FEED_MAX_PAYLOAD):
+    """
+    Compact description of a committed Counts batch: Entrances/Exits per (gate, minute).
+    If it does not fit a NOTIFY payload, receivers are asked to reload totals from the DB.
+    :param rows: List of (timestamp, gate_id, p_in, p_out)
+    :param max_payload: Max JSON length (Postgres NOTIFY payload must be shorter than 8000 bytes)
+    :return: {'rows': [[gate_id, minute_ts, p_in, p_out], ...]} | {'reseed': True}
+    """
+    payload = {'rows': [[d['gate_id'], d['bucket'], d['in'], d['out']] for d in rollup_deltas(rows, FEED_BUCKET_S)]}
+    if len(json.dumps(payload, separators=(',', ':'))) > max_payload:
+        return {'reseed': True}
+    return payload
+
+
+class CountsChangeFeed:
+    """
+    Change feed of the Counts table among Collector processes.
+    Each transaction that commits Counts records also notifies a compact description of them; each process applies
+    the batches committed by the others to its in-memory totals, and updates its own dashboards. Totals are reloaded
+    from the DB each time the listener (re)connects, as notifications are lost while it is down.
+    """
+    def __init__(self, flsk_app: Flask, shared_state: SharedState, counts_engine: CountsEngine,
+                 update_manager: UpdateManagerThreadBody):
+        self.app = flsk_app
+        self.shared = shared_state
+        self.counts = counts_engine
+        self.upd_mngr = update_manager
+        self.lock = threading.Lock()
+        self.stats = {'emitted': 0, 'received': 0, 'applied_rows': 0, 'reseeds': 0}
+        # function(t_from, t_to, gate_ids), called when Counts records are committed by any process (no arguments if
+        # the committed records are unknown)
+        self.change_hooks = []
+        shared_state.subscribe(CH_COUNTS_FEED, self.on_change)
+        shared_state.resync_on_reconnect(CH_COUNTS_FEED, {'reseed': True})
+
+    def emit(self, session, rows):
+        """
+        Notify a Counts batch, at the commit of `session` transaction
+        :param session: DB-session where the records were written
+        :param rows: List of (timestamp, gate_id, p_in, p_out)
+        :return:
+        """
+        if len(rows) == 0:
+            return
+        self.shared.notify_on_commit(session, CH_COUNTS_FEED, counts_feed_payload(rows))
+        with self.lock:
+            self.stats['emitted'] += 1
+        if len(self.change_hooks) > 0:
+            ts = [r[0] for r in rows]
+            t_from, t_to, gate_ids = min(ts), max(ts), {r[1] for r in rows}
+            event.listen(session, 'after_commit', lambda _: self.__changed__(t_from, t_to, gate_ids), once=True)
+
+    def __changed__(self, *args):
+        for hook in self.change_hooks:
+            try:
+                hook(*args)
+            except Exception as e:
+                with self.app.app_context():
+                    self.app.logger.error(f'Counts change hook FAIL: {str(e)}')
+
+    def on_change(self, data):
+        """
+        Apply a batch committed by another process (minute timestamps are used to match the daily time-range)
+        :param data: counts_feed_payload() result
+        :return:
+        """
+        with self.lock:
+            self.stats['received'] += 1
+        if data.get('reseed'):
+            self.counts.reseed()
+            with self.lock:
+                self.stats['reseeds'] += 1
+            self.__changed__()
+        else:
+            per_gate = {}
+            for gate_id, t, p_in, p_out in data['rows']:
+                per_gate.setdefault(gate_id, []).append((t, p_in, p_out))
+            for gate_id, records in per_gate.items():
+                self.counts.add_records(gate_id, records, xid=data.get('xid'))
+            with self.lock:
+                self.stats['applied_rows'] += len(data['rows'])
+            if len(data['rows']) > 0:
+                minutes = [r[1] for r in data['rows']]
+                self.__changed__(min(minutes), max(minutes) + FEED_BUCKET_S - 1, set(per_gate))
+        self.upd_mngr.schedule_broadcast()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
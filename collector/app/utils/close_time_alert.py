@@ -0,0 +1,193 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+
+from flask import Flask
+
+from net_io.mail_management import MailManager
+from utils.change_feed import FEED_BUCKET_S
+from utils.counts_engine import CountsEngine, txid_visible
+from utils.shared_state import SharedState, CH_COUNTS_FEED
+
+from configs.config import ALL_STR, INST_ALERT_TRIGGER_P_NUM, INST_ALERT_RENEW_RANGE_H, \
+    email_anomal_activities_recipients
+
+
+class CloseTimeAlert:
+    """
+    Anomalous activity detector for building closing time-ranges.
+    While armed (by the scheduler, at the start of each closing time-range) it keeps the Entrances/Exits balance of
+    the incoming Counts records, and sends the alert email as soon as `INST_ALERT_TRIGGER_P_NUM` is reached.
+    The balance is restarted after each alert, and when Exits exceed Entrances; records older than
+    `INST_ALERT_RENEW_RANGE_H` hours are forgotten. While disarmed, incoming records are ignored.
+    When the change feed asks for a reseed (committed records unknown), the balance is reloaded with a single count of
+    the records since the balance start (DB plus write-behind spool).
+    """
+    def __init__(self, flsk_app: Flask, mail_man: MailManager, counts_engine: CountsEngine,
+                 shared_state: SharedState, trigger_p_num=INST_ALERT_TRIGGER_P_NUM,
+                 renew_range_h=INST_ALERT_RENEW_RANGE_H):
+        """
+        :param flsk_app:
+        :param mail_man: MailManager object
+        :param counts_engine: In-memory running totals of current daily Counts (reported in the alert)
+        :param shared_state: Shared state of Collector processes: Counts committed by other processes are observed
+        from its change feed
+        :param trigger_p_num: Min balance (Entrances - Exits) that trigger the alert
+        :param renew_range_h: Max age (hours) of observed records
+        """
+        self.app = flsk_app
+        self.mail_man = mail_man
+        self.counts = counts_engine
+        self.trigger_p_num = trigger_p_num
+        self.renew_s = renew_range_h * 3600
+        self.lock = threading.Lock()
+        self.armed = False
+        self.t_start = 0
+        self.t_end = 0
+        # Heap of observed (end timestamp, p_in, p_out), and their sums
+        self.records = []
+        self.p_in = 0
+        self.p_out = 0
+        # Spool write sequence number, and DB snapshot, of the last reload (see CountsEngine.add_records)
+        self.seed_seq = 0
+        self.seed_snapshot = None
+        self.stats = {'armed': 0, 'observed_records': 0, 'alerts': 0, 'reloads': 0}
+        shared_state.subscribe(CH_COUNTS_FEED, self.__on_feed__)
+
+    def arm(self, dt_start: datetime, dt_end: datetime):
+        """
+        Start observing Counts records of a closing time-range
+        :param dt_start:
+        :param dt_end:
+        :return:
+        """
+        with self.lock:
+            self.armed = True
+            self.__restart__(dt_start.timestamp())
+            self.t_end = dt_end.timestamp()
+            self.stats['armed'] += 1
+
+    def disarm(self):
+        with self.lock:
+            self.armed = False
+            self.__restart__(0)
+
+    def __restart__(self, t_start):
+        """
+        Restart the balance from `t_start`. Must be called holding `self.lock`
+        """
+        self.t_start = t_start
+        self.records = []
+        self.p_in, self.p_out = 0, 0
+
+    def __expire__(self, t_now):
+        """
+        Forget records older than `INST_ALERT_RENEW_RANGE_H`. Must be called holding `self.lock`
+        """
+        t_from = t_now - self.renew_s
+        if self.t_start < t_from:
+            self.t_start = t_from
+        while len(self.records) > 0 and self.records[0][0] <= self.t_start:
+            _, p_in, p_out = heapq.heappop(self.records)
+            self.p_in -= p_in
+            self.p_out -= p_out
+
+    def observe(self, device_id, records, seq=None, xid=None, span=1):
+        """
+        :param device_id: Gate's ID
+        :param records: List of (timestamp, entered, exited)
+        :param seq: Write sequence number of the records (see IngestSpool), if written by this process
+        :param xid: ID of the transaction that committed the records, if written by another process
+        :param span: Seconds covered by each record (records of a time bucket start at the bucket start)
+        :return:
+        """
+        if not self.armed:
+            return
+        t_now = time.time()
+        with self.lock:
+            if not self.armed:
+                return
+            if (seq is not None and seq <= self.seed_seq) or \
+                    (xid is not None and self.seed_snapshot is not None and txid_visible(xid, self.seed_snapshot)):
+                # Already counted by the last reload
+                return
+            self.__expire__(t_now)
+            for t, p_in, p_out in records:
+                if t + span > self.t_start and t <= self.t_end:
+                    heapq.heappush(self.records, (t + span, p_in, p_out))
+                    self.p_in += p_in
+                    self.p_out += p_out
+                    self.stats['observed_records'] += 1
+            alert = self.__check__(t_now)
+        if alert is not None:
+            self.__send_alert__(*alert)
+
+    def __check__(self, t_now):
+        """
+        Check the balance, restarting it after an alert or if Exits exceed Entrances. Must be called holding
+        `self.lock`
+        :return: __send_alert__() arguments, or None
+        """
+        p_num = self.p_in - self.p_out
+        t_start = self.t_start
+        alert = p_num >= self.trigger_p_num
+        if alert:
+            self.stats['alerts'] += 1
+        if alert or self.p_in < self.p_out:
+            self.__restart__(t_now)
+        return (p_num, datetime.fromtimestamp(t_start), datetime.fromtimestamp(t_now)) if alert else None
+
+    def __reload__(self):
+        """
+        Replace the observed records with a single count of the Counts records since the balance start
+        :return:
+        """
+        t_now = time.time()
+        with self.lock:
+            if not self.armed:
+                return
+            self.__expire__(t_now)
+            gates, self.seed_seq, self.seed_snapshot = self.counts.read_totals(
+                datetime.fromtimestamp(self.t_start), datetime.fromtimestamp(min(t_now, self.t_end)))
+            self.p_in = sum(totals[0] for totals in gates.values())
+            self.p_out = sum(totals[1] for totals in gates.values())
+            # Forgotten as a whole, `INST_ALERT_RENEW_RANGE_H` hours after the reload
+            self.records = [(t_now, self.p_in, self.p_out)]
+            self.stats['reloads'] += 1
+            alert = self.__check__(t_now)
+        if alert is not None:
+            self.__send_alert__(*alert)
+
+    def __on_feed__(self, data):
+        """
+        Observe Counts committed by other Collector processes (minute timestamps)
+        :param data: counts_feed_payload() result
+        :return:
+        """
+        if not self.armed:
+            return
+        if data.get('reseed'):
+            self.__reload__()
+            return
+        self.observe(None, [(t, p_in, p_out) for _, t, p_in, p_out in data['rows']], xid=data.get('xid'),
+                     span=FEED_BUCKET_S)
+
+    def __send_alert__(self, p_num, dt_start: datetime, dt_now: datetime):
+        msg = 'Someone in the building:\n'
+        msg += f'\tDetected {p_num} Persons in the building in time-rage '
+        msg += f'{dt_start.replace(microsecond=0)} --- {dt_now.replace(microsecond=0)}\n\n'
+        msg += f'Total people estimated today: {self.counts.get_counts(ALL_STR)["tot"]}\n\n'
+        msg += 'For further information, please inspect the Event List\n'
+
+        # Sent in background by the mail dispatcher, out of the ingestion path
+        self.mail_man.broadcast_user_email(email_anomal_activities_recipients, 'Anomalous Activity in Close Time', msg)
+        with self.app.app_context():
+            self.app.logger.info('Instant Alert mail queued')
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['is_armed'] = self.armed
+            stats['balance'] = self.p_in - self.p_out
+        return stats
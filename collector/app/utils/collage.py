@@ -0,0 +1,115 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from net_io.frame_protocol import FrameProtocolError
+from utils.frame_broadcaster import mjpeg_part
+from utils.frames_dict import FramesDict
+
+from configs.config import COLLAGE_N_COL, COLLAGE_CELL_SIZE, COLLAGE_FPS
+
+
+class CollageCompositor:
+    """
+    Mosaic of all MUs debug-streams ("all cameras" view).
+    Own a preallocated canvas, where only the tiles whose source frame changed are redrawn (each frame downscaled to
+    the grid cell size). The encoded mosaic is cached, so all viewers share one composite per tick. Canvas and mosaic
+    are counted in the frames store size.
+    A frame that cannot be decoded leaves its tile unchanged (it is not retried).
+    """
+    def __init__(self, frames_dict: FramesDict, n_col=COLLAGE_N_COL, cell_size=COLLAGE_CELL_SIZE, fps=COLLAGE_FPS):
+        """
+        :param frames_dict: Debug-frames of all MUs
+        :param n_col: Number of mosaic columns
+        :param cell_size: (width, height) of each tile
+        :param fps: Max composite rate
+        """
+        self.frames_d = frames_dict
+        self.n_col = n_col
+        self.cell_w, self.cell_h = cell_size
+        self.period = 1 / fps
+
+        self.lock = threading.Lock()
+        self.canvas = None
+        self.layout = ()
+        self.tiles_seq = {}
+
+        self.seq = 0
+        self.part = None
+        self.t_composite = 0
+        self.decode_errors = 0
+
+    def __relayout__(self, devices):
+        """
+        Allocate a new (black) canvas for the given devices list
+        :param devices: Tuple of device IDs, in tiles order
+        :return:
+        """
+        n_rows = -(-len(devices) // self.n_col)
+        self.canvas = np.zeros((n_rows * self.cell_h, self.n_col * self.cell_w, 3), dtype=np.uint8)
+        self.layout = devices
+        self.tiles_seq = {}
+
+    def __blit__(self, idx, img):
+        """
+        Draw a frame in the `idx` tile, downscaled (keeping aspect ratio) and centered in the cell
+        :param idx:
+        :param img:
+        :return:
+        """
+        row, col = divmod(idx, self.n_col)
+        y0, x0 = row * self.cell_h, col * self.cell_w
+        cell = self.canvas[y0:y0 + self.cell_h, x0:x0 + self.cell_w]
+        cell[:] = 0
+
+        h, w = img.shape[:2]
+        scale = min(self.cell_w / w, self.cell_h / h)
+        new_w, new_h = max(1, int(w * scale)), max(1, int(h * scale))
+        if (new_w, new_h) != (w, h):
+            img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        dy, dx = (self.cell_h - new_h) // 2, (self.cell_w - new_w) // 2
+        cell[dy:dy + new_h, dx:dx + new_w] = img
+
+    def get_composite(self):
+        """
+        :return: Tuple (seq, part) of the current mosaic (formatted for the debug-stream), or None if no MU is streaming
+        """
+        with self.lock:
+            t_now = time.time()
+            if self.part is not None and t_now - self.t_composite < self.period:
+                return self.seq, self.part
+
+            devices = tuple(sorted(self.frames_d.get_streamers()))
+            if len(devices) == 0:
+                self.part = None
+                return None
+            if devices != self.layout:
+                self.__relayout__(devices)
+                self.part = None
+
+            changed = False
+            for idx, dev_id in enumerate(devices):
+                broadcaster = self.frames_d.get_broadcaster(dev_id)
+                if broadcaster is None:
+                    continue
+                frame_seq, frame = broadcaster.current()
+                if frame is None or self.tiles_seq.get(dev_id) == frame_seq:
+                    continue
+                self.tiles_seq[dev_id] = frame_seq
+                try:
+                    img = frame.decode()
+                except (FrameProtocolError, cv2.error, ValueError):
+                    self.decode_errors += 1
+                    continue
+                self.__blit__(idx, img)
+                changed = True
+
+            if changed or self.part is None:
+                _, buf = cv2.imencode('.jpg', self.canvas)
+                self.part = mjpeg_part('image/jpeg', buf.tobytes())
+                self.seq += 1
+                self.frames_d.account_extra('collage', self.canvas.nbytes + len(self.part))
+            self.t_composite = t_now
+            return self.seq, self.part
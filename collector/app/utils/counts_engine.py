@@ -0,0 +1,200 @@
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy import text
+
+from db.db_base import Session
+from utils.ingest_spool import IngestSpool
+from endpoints.queries_utils import estimate_people_num, get_now_timerange, DEVICE_DEFAULT
+
+from configs.config import ALL_STR
+
+ALL = ALL_STR
+
+
+def parse_txid_snapshot(snapshot):
+    """
+    :param snapshot: txid_current_snapshot() text: 'xmin:xmax:xip,...'
+    :return: (xmin, xmax, frozenset of in-progress xids)
+    """
+    xmin, xmax, xip = snapshot.split(':')
+    return int(xmin), int(xmax), frozenset(int(x) for x in xip.split(',') if x)
+
+
+def txid_visible(xid, snapshot):
+    """
+    :param xid: Transaction ID (txid_current())
+    :param snapshot: parse_txid_snapshot() result
+    :return: True if the transaction `xid` was committed when `snapshot` was taken
+    """
+    xmin, xmax, xip = snapshot
+    return xid < xmin or (xid < xmax and xid not in xip)
+
+
+class CountsEngine:
+    """
+    In-memory running totals of the current daily Counts time-range (see `NOW_TIMERANGE`).
+    Keep, for each gate, the sum of Entrances/Exits recorded inside the current time-range: it is seeded from the DB
+    at startup and at each time-range rollover, then updated incrementally with each new Counts record.
+    Records already included by the last seed are skipped: records of this process by their spool write sequence
+    number, records of other processes (change feed) by their transaction ID, compared with the seed DB snapshot.
+    """
+    def __init__(self, flsk_app: Flask, spool: IngestSpool = None):
+        """
+        :param flsk_app: FlaskApp, used for logging
+        :param spool: Write-behind spool, whose pending records (not yet in DB) are added to seeded totals
+        """
+        self.app = flsk_app
+        self.spool = spool
+        self.lock = threading.Lock()
+        # {gate_id: [p_in, p_out]}
+        self.gates = {}
+        self.t_start = 0
+        self.t_end = -1
+        # Spool write sequence number, and DB snapshot, of the last seed
+        self.seed_seq = 0
+        self.seed_snapshot = None
+        self.stats = {'seeds': 0, 'skipped_batches': 0}
+
+        with self.lock:
+            self.__seed__(datetime.now())
+
+    def read_totals(self, dt_1: datetime, dt_2: datetime, session=None):
+        """
+        Read the totals of each gate in [dt_1, dt_2] from the DB, plus the records still pending in the write-behind
+        spool, together with the marks that tell which records are included (see :meth:`add_records`)
+        :param dt_1:
+        :param dt_2:
+        :param session: Already initialised DB-session, without an open transaction (if None, a new one is opened)
+        :return: ({gate_id: [p_in, p_out]}, spool write sequence number, DB txid snapshot)
+        """
+        own_session = session is None
+        if own_session:
+            session = Session()
+        pending = []
+        seq = 0
+        try:
+            # No spool commit while reading: the DB snapshot, totals, and pending records are taken at the same instant
+            with self.spool.flush_lock if self.spool is not None else nullcontext():
+                # A single DB snapshot for totals and the snapshot IDs
+                session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+                snapshot = parse_txid_snapshot(session.execute(text('SELECT txid_current_snapshot()::text')).scalar())
+                res = estimate_people_num(ALL, dt_1, dt_2, True, session)
+                if self.spool is not None:
+                    pending, seq = self.spool.pending_snapshot()
+                session.rollback()
+        finally:
+            if own_session:
+                session.close()
+
+        gates = {}
+        for gate_id, p_in, p_out in res:
+            gates[gate_id] = [int(p_in or 0), int(p_out or 0)]
+        t_start, t_end = int(dt_1.timestamp()), int(dt_2.timestamp())
+        for t, gate_id, p_in, p_out in pending:
+            if t_start <= int(t) <= t_end:
+                totals = gates.setdefault(gate_id, [0, 0])
+                totals[0] += p_in
+                totals[1] += p_out
+        return gates, seq, snapshot
+
+    def __seed__(self, dt_now: datetime, session=None):
+        """
+        Reload all gates totals from DB, for the time-range containing `dt_now`. Must be called holding `self.lock`
+        :param dt_now:
+        :param session: Already initialised DB-session (if None, a new one is opened)
+        :return:
+        """
+        dt_1, dt_2 = get_now_timerange(dt_now)
+        self.gates, self.seed_seq, self.seed_snapshot = self.read_totals(dt_1, dt_2, session)
+        self.t_start = int(dt_1.timestamp())
+        self.t_end = int(dt_2.timestamp())
+        self.stats['seeds'] += 1
+
+    def __check_rollover__(self):
+        """
+        Re-seed totals if current time is outside the tracked time-range. Must be called holding `self.lock`
+        :return:
+        """
+        dt_now = datetime.now()
+        if not (self.t_start <= int(dt_now.timestamp()) <= self.t_end):
+            self.__seed__(dt_now)
+
+    def reseed(self):
+        """
+        Reload all gates totals from DB
+        :return:
+        """
+        with self.lock:
+            self.__seed__(datetime.now())
+
+    def add_records(self, gate_id, records, seq=None, xid=None):
+        """
+        Apply already committed (or spooled) Counts records to the running totals.
+        Records with a timestamp outside the current time-range, or already included by the last seed, are ignored.
+        :param gate_id: Gate's ID (or reset record name)
+        :param records: Iterable of (timestamp, p_in, p_out)
+        :param seq: Write sequence number of the records (see IngestSpool), if written by this process
+        :param xid: ID of the transaction that committed the records, if written by another process
+        :return:
+        """
+        with self.lock:
+            self.__check_rollover__()
+            if (seq is not None and seq <= self.seed_seq) or \
+                    (xid is not None and self.seed_snapshot is not None and txid_visible(xid, self.seed_snapshot)):
+                self.stats['skipped_batches'] += 1
+                return
+            for t, p_in, p_out in records:
+                if not (self.t_start <= int(t) <= self.t_end):
+                    continue
+                totals = self.gates.setdefault(gate_id, [0, 0])
+                totals[0] += p_in
+                totals[1] += p_out
+
+    def get_counts(self, id_gate=ALL):
+        """
+        :param id_gate: Gate's ID, or `ALL_STR` to aggregate all gates
+        :return: current daily Counts Estimations {'tot': x, 'in': y, 'out': z}
+        """
+        with self.lock:
+            self.__check_rollover__()
+            if id_gate == ALL or id_gate == DEVICE_DEFAULT:
+                p_in = sum(t[0] for t in self.gates.values())
+                p_out = sum(t[1] for t in self.gates.values())
+            else:
+                p_in, p_out = self.gates.get(id_gate, (0, 0))
+        return {'tot': p_in - p_out, 'in': p_in, 'out': p_out}
+
+    def check_consistency(self):
+        """
+        Compare in-memory totals with the result of the SQL aggregation on the same time-range (plus records still
+        pending in the write-behind spool). On mismatch, log the differences and re-seed totals from the SQL result.
+        :return: Dict of mismatching gates {gate_id: {'memory': (in, out), 'db': (in, out)}}
+        """
+        session = Session()
+        try:
+            with self.lock:
+                self.__check_rollover__()
+                mem_gates = {g: tuple(t) for g, t in self.gates.items()}
+                self.__seed__(datetime.now(), session)
+                db_gates = {g: tuple(t) for g, t in self.gates.items()}
+        finally:
+            session.close()
+
+        diffs = {}
+        for gate_id in set(mem_gates) | set(db_gates):
+            mem = mem_gates.get(gate_id, (0, 0))
+            db = db_gates.get(gate_id, (0, 0))
+            if mem != db:
+                diffs[gate_id] = {'memory': mem, 'db': db}
+
+        if len(diffs) > 0:
+            with self.app.app_context():
+                self.app.logger.error(f'CountsEngine mismatch with DB (totals reloaded): {diffs}')
+        return diffs
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
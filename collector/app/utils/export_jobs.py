@@ -0,0 +1,377 @@
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from flask import Flask
+from sqlalchemy import func
+
+from db.db_base import Session, engine
+from db.export_job import ExportJobRecord
+from endpoints.queries_utils import count_records_query, mu_events_query
+from utils.shared_state import PROCESS_ID
+
+from configs.config import EXPORT_DIR, EXPORT_WORKERS, EXPORT_KEEP_H, EXPORT_BATCH_ROWS, EXPORT_PROGRESS_S
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Exportable tables: query builder function(device, ts_1, ts_2, session) on the existing filters
+EXPORT_TABLES = {
+    'people_counts': count_records_query,
+    'mu_status': mu_events_query,
+}
+EXPORT_FORMATS = {'csv': 'csv', 'csv.gz': 'csv.gz', 'parquet': 'parquet'}
+
+STREAM_CHUNK = 2 ** 16
+JOB_UNFINISHED = ('queued', 'running')
+JOB_FINISHED = ('done', 'failed')
+
+
+def export_sql(table, device, ts_1, ts_2, session):
+    """
+    :return: SQL of the export query (parameters inlined, as COPY does not accept bind parameters)
+    """
+    qry = EXPORT_TABLES[table](device, ts_1, ts_2, session)
+    return str(qry.statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def copy_csv(sql, out):
+    """
+    Write the result of `sql` as CSV (with header), by Postgres COPY TO STDOUT
+    :param sql: SELECT statement
+    :param out: File-like object with a `write(data)` method
+    :return:
+    """
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.copy_expert(f'COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)', out)
+        cur.close()
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+class _QueueWriter:
+    """
+    COPY output sink that hands chunks to a consumer thread (blocks while the consumer is behind)
+    """
+    def __init__(self, q: queue.Queue, aborted: threading.Event):
+        self.q = q
+        self.aborted = aborted
+
+    def write(self, data):
+        while True:
+            if self.aborted.is_set():
+                raise IOError('Export aborted by the client')
+            try:
+                self.q.put(data, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+def stream_csv(table, device, ts_1, ts_2, gzip=False):
+    """
+    Stream COPY output: the query runs in a producer thread, chunks are yielded as they come
+    :param table: One of EXPORT_TABLES
+    :param device:
+    :param ts_1:
+    :param ts_2:
+    :param gzip: Compress on the fly
+    :return: Generator of bytes chunks
+    """
+    session = Session()
+    try:
+        sql = export_sql(table, device, ts_1, ts_2, session)
+    finally:
+        session.close()
+    q = queue.Queue(maxsize=16)
+    aborted = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            copy_csv(sql, _QueueWriter(q, aborted))
+            q.put(done)
+        except Exception as e:
+            if not aborted.is_set():
+                q.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    buf = []
+    n_buf = 0
+    try:
+        while True:
+            data = q.get()
+            if data is done:
+                break
+            if isinstance(data, Exception):
+                raise data
+            data = data.encode() if isinstance(data, str) else data
+            if z is not None:
+                data = z.compress(data)
+            buf.append(data)
+            n_buf += len(data)
+            if n_buf >= STREAM_CHUNK:
+                yield b''.join(buf)
+                buf, n_buf = [], 0
+        if z is not None:
+            buf.append(z.flush())
+        yield b''.join(buf)
+    finally:
+        aborted.set()
+
+
+class _FileProgressWriter:
+    """
+    COPY output sink writing to a file (gzip-compressed or not), counting rows and bytes
+    """
+    def __init__(self, f, job):
+        self.f = f
+        self.job = job
+        self.z = None
+
+    def write(self, data):
+        data = data.encode() if isinstance(data, str) else data
+        self.job.rows += data.count(b'\n')
+        self.job.n_bytes += len(data)
+        self.f.write(self.z.compress(data) if self.z is not None else data)
+        self.job.progress()
+
+
+class ExportJob:
+    """
+    Progress of a running export (periodically saved to its ExportJobRecord)
+    """
+    def __init__(self, job_id, progress_s=EXPORT_PROGRESS_S):
+        self.job_id = job_id
+        self.progress_s = progress_s
+        self.rows = 0
+        self.n_bytes = 0
+        self.t_saved = 0
+
+    def progress(self, force=False):
+        if not force and time.time() - self.t_saved < self.progress_s:
+            return
+        self.t_saved = time.time()
+        session = Session()
+        try:
+            session.query(ExportJobRecord).filter(ExportJobRecord.job_id == self.job_id) \
+                .update({'rows': self.rows, 'n_bytes': self.n_bytes})
+            session.commit()
+        finally:
+            session.close()
+
+
+class ExportManager:
+    """
+    Background export jobs of Counts/MU-status records (CSV, gzip CSV, or Parquet if `pyarrow` is installed).
+    Jobs are run by a small pool of threads of the process that received the request, their state is kept in the
+    DB (so any Collector process can report it) and results are written in `EXPORT_DIR`, removed after
+    `EXPORT_KEEP_H` hours from the job end.
+    Unfinished jobs of dead processes of this host (restarted workers) are marked failed at startup.
+    """
+    def __init__(self, flsk_app: Flask, export_dir=EXPORT_DIR, n_workers=EXPORT_WORKERS, keep_h=EXPORT_KEEP_H):
+        self.app = flsk_app
+        self.export_dir = os.path.abspath(export_dir)
+        self.keep_s = keep_h * 3600
+        self.pool = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='export')
+        os.makedirs(self.export_dir, exist_ok=True)
+        self.fail_orphans()
+
+    @staticmethod
+    def __is_running__(owner):
+        """
+        :param owner: PROCESS_ID of a process of this host
+        :return: True if the process is still running (and it is not this one, just started)
+        """
+        pid = int(owner.rsplit(':', 1)[1])
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def fail_orphans(self):
+        """
+        Mark failed the unfinished jobs of this host whose process is no longer running (their result never comes)
+        :return: Number of failed jobs
+        """
+        session = Session()
+        try:
+            orphans = [r for r in session.query(ExportJobRecord).filter(
+                ExportJobRecord.state.in_(JOB_UNFINISHED),
+                ExportJobRecord.owner.like(f'{socket.gethostname()}:%')).all() if not self.__is_running__(r.owner)]
+            job_ids = []
+            for record in orphans:
+                if record.path and os.path.exists(record.path):
+                    os.remove(record.path)
+                record.state = 'failed'
+                record.error = 'export process terminated'
+                record.t_done = time.time()
+                job_ids.append(record.job_id)
+            session.commit()
+        finally:
+            session.close()
+        if len(job_ids) > 0:
+            with self.app.app_context():
+                self.app.logger.error(f'Exports of terminated processes FAILED: {job_ids}')
+        return len(job_ids)
+
+    @staticmethod
+    def check_format(fmt):
+        """
+        :param fmt: One of EXPORT_FORMATS
+        :return: Error message, or None if the format is available
+        """
+        if fmt not in EXPORT_FORMATS:
+            return f'format must be one of {sorted(EXPORT_FORMATS)}'
+        if fmt == 'parquet' and pyarrow is None:
+            return 'parquet format requires pyarrow'
+        return None
+
+    def submit(self, table, fmt, device, ts_1, ts_2):
+        """
+        :return: ExportJobRecord.to_dict() of the new (queued) job
+        """
+        assert table in EXPORT_TABLES
+        assert self.check_format(fmt) is None
+        job_id = uuid.uuid4().hex
+        session = Session()
+        try:
+            record = ExportJobRecord(job_id, PROCESS_ID, table, fmt, device, ts_1, ts_2, time.time())
+            session.add(record)
+            session.commit()
+            res = record.to_dict()
+        finally:
+            session.close()
+        self.pool.submit(self.__run__, job_id)
+        self.pool.submit(self.cleanup)
+        return res
+
+    def get_job(self, job_id):
+        """
+        :return: ExportJobRecord (detached), or None
+        """
+        session = Session()
+        try:
+            record = session.query(ExportJobRecord).get(job_id)
+            if record is not None:
+                session.expunge(record)
+            return record
+        finally:
+            session.close()
+
+    def __update_job__(self, job_id, **values):
+        session = Session()
+        try:
+            session.query(ExportJobRecord).filter(ExportJobRecord.job_id == job_id).update(values)
+            session.commit()
+        finally:
+            session.close()
+
+    def __run__(self, job_id):
+        record = self.get_job(job_id)
+        path = os.path.join(self.export_dir, f'{job_id}.{EXPORT_FORMATS[record.fmt]}')
+        job = ExportJob(job_id)
+        try:
+            session = Session()
+            try:
+                qry = EXPORT_TABLES[record.table](record.device, record.ts_from, record.ts_to, session)
+                total_rows = qry.order_by(None).with_entities(func.count()).scalar()
+                sql = export_sql(record.table, record.device, record.ts_from, record.ts_to, session)
+            finally:
+                session.close()
+            self.__update_job__(job_id, state='running', total_rows=total_rows, path=path)
+
+            if record.fmt == 'parquet':
+                self.__write_parquet__(record, path, job)
+            else:
+                with open(path, 'wb') as f:
+                    out = _FileProgressWriter(f, job)
+                    if record.fmt == 'csv.gz':
+                        out.z = zlib.compressobj(6, zlib.DEFLATED, 31)
+                    copy_csv(sql, out)
+                    if out.z is not None:
+                        f.write(out.z.flush())
+                # Header line
+                job.rows -= 1
+            job.n_bytes = os.path.getsize(path)
+            job.progress(force=True)
+            self.__update_job__(job_id, state='done', t_done=time.time())
+        except Exception as e:
+            with self.app.app_context():
+                self.app.logger.error(f'Export {job_id} FAIL: {str(e)}')
+            self.__update_job__(job_id, state='failed', error=str(e)[:256], t_done=time.time())
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __write_parquet__(self, record: ExportJobRecord, path, job: ExportJob):
+        """
+        Write query rows (server-side cursor) as Parquet row groups of `EXPORT_BATCH_ROWS` rows
+        """
+        session = Session()
+        writer = None
+        try:
+            qry = EXPORT_TABLES[record.table](record.device, record.ts_from, record.ts_to, session)
+            cols = [c.name for c in qry.statement.selected_columns]
+            batch = []
+
+            def write_batch():
+                nonlocal writer
+                columns = list(zip(*batch))
+                data = {c: [float(v) if isinstance(v, Decimal) else v for v in columns[i]] for i, c in enumerate(cols)}
+                table = pyarrow.Table.from_pydict(data)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                job.rows += len(batch)
+                job.progress()
+
+            for row in qry.yield_per(EXPORT_BATCH_ROWS):
+                batch.append(tuple(row))
+                if len(batch) >= EXPORT_BATCH_ROWS:
+                    write_batch()
+                    batch = []
+            if len(batch) > 0:
+                write_batch()
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, pyarrow.schema([(c, pyarrow.null()) for c in cols]))
+        finally:
+            if writer is not None:
+                writer.close()
+            session.close()
+
+    def cleanup(self):
+        """
+        Remove jobs (and result files) of this host finished more than `EXPORT_KEEP_H` hours ago
+        :return:
+        """
+        t_limit = time.time() - self.keep_s
+        session = Session()
+        try:
+            old = session.query(ExportJobRecord).filter(ExportJobRecord.state.in_(JOB_FINISHED),
+                                                        ExportJobRecord.t_done < t_limit,
+                                                        ExportJobRecord.owner.like(f'{socket.gethostname()}:%')).all()
+            for record in old:
+                if record.path and os.path.exists(record.path):
+                    os.remove(record.path)
+                session.delete(record)
+            session.commit()
+        finally:
+            session.close()
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from net_io.frame_protocol import EncodedFrame
+
+
+def mjpeg_part(mimetype, data):
+    """
+    Format an encoded image as a part of the `multipart/x-mixed-replace` debug-stream sent to Client's GUI
+    :param mimetype:
+    :param data: encoded image bytes
+    :return:
+    """
+    return b'--frame\r\n' b'Content-Type: ' + mimetype.encode() + b'\r\n\r\n' + data + b'\r\n'
+
+
+class FrameBroadcaster:
+    """
+    Fan-out of the debug-stream of a single MU. Each new frame is formatted once, tagged with a monotonically
+    increasing sequence number, and shared by all viewers: they wait for the next sequence instead of polling.
+    """
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.frame = None
+        self.part = None
+        self.t_update = 0
+        self.closed = False
+
+    def publish(self, frame: EncodedFrame):
+        """
+        Make a new frame available to all viewers
+        :param frame:
+        :return:
+        """
+        part = mjpeg_part(frame.mimetype, frame.data)
+        with self.cond:
+            self.seq += 1
+            self.frame = frame
+            self.part = part
+            self.t_update = time.time()
+            self.cond.notify_all()
+
+    def current(self):
+        """
+        :return: Tuple (seq, EncodedFrame) of the last published frame
+        """
+        with self.cond:
+            return self.seq, self.frame
+
+    def wait_next(self, last_seq, timeout):
+        """
+        Wait for a frame newer than `last_seq`
+        :param last_seq: sequence number of the last frame sent to the viewer (0 to get the current one)
+        :param timeout: seconds
+        :return: Tuple (seq, part), or None on timeout or if the stream is closed
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > last_seq or self.closed, timeout)
+            if self.closed or self.seq <= last_seq:
+                return None
+            return self.seq, self.part
+
+    def close(self):
+        """
+        Stream ended: wake up all viewers
+        :return:
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
@@ -1,102 +1,244 @@
+import heapq
+import threading
 import time
+from collections import deque
 
-import numpy as np
-from numpy import ndarray
+from net_io.frame_protocol import EncodedFrame
+from utils.frame_broadcaster import FrameBroadcaster
+
+from configs.config import FRAMES_RING_SIZE, FRAMES_MAX_BYTES, ALL_UNITS
+
+
+class FrameSlot:
+    """
+    Debug-frames of a single MU: ring buffer of the last received frames (kept encoded, as received), each coupled
+    with its save-timestamp, and the broadcaster that publishes them to the viewers.
+    `n_bytes` includes the copy of the last frame formatted by the broadcaster.
+    """
+    def __init__(self, device_id, ring_size):
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        self.ring = deque(maxlen=ring_size)
+        self.n_bytes = 0
+        self.part_bytes = 0
+        self.t_update = 0
+        self.broadcaster = FrameBroadcaster(device_id)
+
+    def push(self, t_save, frame: EncodedFrame):
+        """
+        :return: Size (bytes) freed: frame pushed out of the ring, to make room for the new one, and previous
+            broadcaster copy
+        """
+        with self.lock:
+            freed = len(self.ring[0][1].data) if len(self.ring) == self.ring.maxlen else 0
+            freed += self.part_bytes
+            self.ring.append((t_save, frame))
+            self.part_bytes = len(frame.data)
+            self.n_bytes += 2 * len(frame.data) - freed
+            self.t_update = t_save
+            return freed
+
+    def pop_oldest(self):
+        """
+        Evict the oldest frame (the last one received too: the broadcaster keeps publishing it)
+        :return: Size (bytes) of the evicted frame (0 if nothing to evict)
+        """
+        with self.lock:
+            if len(self.ring) == 0:
+                return 0
+            _, frame = self.ring.popleft()
+            self.n_bytes -= len(frame.data)
+            return len(frame.data)
+
+    def oldest_t(self):
+        with self.lock:
+            return self.ring[0][0] if len(self.ring) > 0 else None
+
+    def last(self):
+        with self.lock:
+            return self.ring[-1] if len(self.ring) > 0 else (0, None)
+
+    def history(self):
+        with self.lock:
+            return list(self.ring)
 
 
 class FramesDict:
     """
-    Frames dictionary, collect the last debug-frame sent from each MU. Implement all utilities methods to insert and
-    retrieve the current frame for each MU
+    Concurrent store of MUs debug-frames.
+    The video-gather thread adds frames, while request threads and the Status Manager read and remove streamers:
+    the streamers dict (and the bytes accounting) is guarded by `lock`, each device frames by their own slot lock.
+    Only frames of the expected units are stored. The total size counts the stored frames, the broadcasters copies
+    and the buffers derived from the frames (see :meth:`account_extra`): when it exceeds `max_bytes`, the oldest
+    frames (of any MU, up to the last one of each MU) are evicted first.
     """
-    def __init__(self):
-        self.d = {}
+    def __init__(self, ring_size=FRAMES_RING_SIZE, max_bytes=FRAMES_MAX_BYTES, units=ALL_UNITS):
+        """
+        :param ring_size: Number of last frames kept for each MU
+        :param max_bytes: Max total size of stored frames
+        :param units: IDs of the MUs whose frames are stored (frames of other devices are rejected)
+        """
+        self.ring_size = ring_size
+        self.max_bytes = max_bytes
+        self.units = frozenset(units)
+
+        self.lock = threading.Lock()
+        self.slots = {}
+        # Heap of (save-timestamp, id(slot), slot), one entry for each streamer (moved forward when due)
+        self.stale_heap = []
+        self.n_bytes = 0
+        # {name: size} of buffers derived from frames
+        self.extra = {}
+        self.stats = {'added_frames': 0, 'evicted_frames': 0, 'dropped_frames': 0, 'rejected_frames': 0}
+
+    def __get_slot__(self, host_id):
+        with self.lock:
+            return self.slots.get(host_id)
+
+    def __evict__(self):
+        """
+        Evict the oldest frames until the total size is under `max_bytes` (lock already held)
+        :return:
+        """
+        while self.n_bytes > self.max_bytes:
+            victim, t_victim = None, None
+            for slot in self.slots.values():
+                t_oldest = slot.oldest_t()
+                if t_oldest is not None and (t_victim is None or t_oldest < t_victim):
+                    victim, t_victim = slot, t_oldest
+            if victim is None:
+                return
+            self.n_bytes -= victim.pop_oldest()
+            self.stats['evicted_frames'] += 1
 
-    def add_frame(self, host_id, frame):
+    def add_frame(self, host_id, frame: EncodedFrame):
         """
-        Save the last frame sent from `host_id`, coupled with current system timestamp
+        Save the last frame sent from `host_id`, coupled with current system timestamp, and publish it to the viewers
         :param host_id:
         :param frame:
+        :return: False if the frame was dropped (bigger than `max_bytes`, or not of an expected unit)
+        """
+        if host_id not in self.units:
+            with self.lock:
+                self.stats['rejected_frames'] += 1
+            return False
+        if 2 * len(frame.data) > self.max_bytes:
+            with self.lock:
+                self.stats['dropped_frames'] += 1
+            return False
+
+        with self.lock:
+            slot = self.slots.get(host_id)
+            t_save = time.time()
+            if slot is None:
+                slot = FrameSlot(host_id, self.ring_size)
+                self.slots[host_id] = slot
+                heapq.heappush(self.stale_heap, (t_save, id(slot), slot))
+            freed = slot.push(t_save, frame)
+            # Stored frame and its broadcaster copy
+            self.n_bytes += 2 * len(frame.data) - freed
+            self.stats['added_frames'] += 1
+            self.__evict__()
+        slot.broadcaster.publish(frame)
+        return True
+
+    def account_extra(self, name, n_bytes):
+        """
+        Set the size of a buffer derived from the stored frames (e.g. the collage), counted in the total size
+        :param name: Buffer name
+        :param n_bytes:
         :return:
         """
-        self.d[host_id] = (time.time(), frame)
+        with self.lock:
+            self.n_bytes += n_bytes - self.extra.get(name, 0)
+            self.extra[name] = n_bytes
+            self.__evict__()
+
+    def get_broadcaster(self, host_id):
+        """
+        :param host_id:
+        :return: FrameBroadcaster of `host_id` debug-stream, if there is. Otherwise: `None`
+        """
+        slot = self.__get_slot__(host_id)
+        return None if slot is None else slot.broadcaster
 
     def get_frame(self, host_id):
         """
         :param host_id:
         :return: Last frame sent from MU with `host_id`, if there is. Otherwise: `None`
         """
-        f = None
-        if host_id in self.d:
-            _, f = self.d[host_id]
-        return f
+        slot = self.__get_slot__(host_id)
+        return None if slot is None else slot.last()[1]
 
-    def get_frame_no_duplicate(self, host_id, img: ndarray):
+    def get_history(self, host_id):
         """
-        Return the last frame sent, only if the frame differ from given `img` frame
         :param host_id:
-        :param img:
-        :return:
+        :return: List of (save-timestamp, frame) of the last frames sent from `host_id`, from the oldest
         """
-        f = None
-        if host_id in self.d:
-            _, f = self.d[host_id]
-            # if img.all(f) == f:
-            if (img == f).all(where=True):
-                f = None
-        else:
-            raise Exception(f'No more frames of {host_id}')
-        return f
+        slot = self.__get_slot__(host_id)
+        return [] if slot is None else slot.history()
 
     def last_update(self, host_id):
         """
         :param host_id:
         :return: save-timestamp of current `host_id` frame
         """
-        t = 0
-        if host_id in self.d:
-            t, _ = self.d[host_id]
-        return t
+        slot = self.__get_slot__(host_id)
+        return 0 if slot is None else slot.t_update
 
     def get_streamers(self):
         """
         :return: list of MUs IDs
         """
-        return list(self.d.keys())
-
-    def get_all_frames(self, n_col=2):
-        """
-        :param n_col:
-        :return: return a collage of all MU's frames
-        """
-        if len(self.d) == 0:
-            return None
-        row_buf = []
-        rows = []
-        for host in self.d:
-            _, frame = self.d[host]
-            row_buf.append(frame)
-            if len(row_buf) < n_col:
-                continue
-            h_stack = np.hstack(row_buf)
-            rows.append(h_stack)
-            row_buf.clear()
-        if len(row_buf) > 0:
-            while len(row_buf) < n_col:
-                row_buf.append(frame)
-
-            h_stack = np.hstack(row_buf)
-            rows.append(h_stack)
-            row_buf.clear()
-        v_stack = np.vstack(rows)
-        return v_stack
+        with self.lock:
+            return list(self.slots.keys())
+
+    def __remove__(self, device_id):
+        """
+        Remove `device_id` slot and close its broadcaster (lock already held)
+        """
+        slot = self.slots.pop(device_id)
+        self.n_bytes -= slot.n_bytes
+        slot.broadcaster.close()
+        return slot
 
     def remove_streamer(self, device_id):
         """
-        Simply remove dict entry for `device_id` 's frame
+        Remove all frames of `device_id`
         :param device_id:
         :return:
         """
-        # print(f'fd.remove_streamer(self, {device_id})')
-        rm_streamer = self.d.pop(device_id)
-        assert not (device_id in self.d)
+        with self.lock:
+            if device_id in self.slots:
+                self.__remove__(device_id)
+
+    def pop_stale(self, max_age):
+        """
+        Atomically remove all streamers without new frames since `max_age` seconds
+        :param max_age: seconds
+        :return: List of (device_id, last save-timestamp) of removed streamers
+        """
+        t_limit = time.time() - max_age
+        removed = []
+        with self.lock:
+            while len(self.stale_heap) > 0 and self.stale_heap[0][0] < t_limit:
+                _, _, slot = heapq.heappop(self.stale_heap)
+                slot: FrameSlot
+                if self.slots.get(slot.device_id) is not slot:
+                    # Already removed
+                    continue
+                if slot.t_update >= t_limit:
+                    heapq.heappush(self.stale_heap, (slot.t_update, id(slot), slot))
+                    continue
+                self.__remove__(slot.device_id)
+                removed.append((slot.device_id, slot.t_update))
+        return removed
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['streamers'] = len(self.slots)
+            stats['stored_frames'] = sum(len(slot.ring) for slot in self.slots.values())
+            stats['stored_bytes'] = self.n_bytes
+            stats['extra_bytes'] = sum(self.extra.values())
+        return stats
@@ -0,0 +1,325 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Flask
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from db.counts_writer import write_count_rows
+from db.db_base import Session
+from db.ingest_batch import IngestBatchRecord
+
+from configs.config import INGEST_SPOOL_DIR, INGEST_FLUSH_ROWS, INGEST_FLUSH_INTERVAL_S, INGEST_SPOOL_FSYNC, \
+    INGEST_SEGMENT_MAX_FAILURES
+
+SEGMENT_PREFIX = 'seg-'
+SEGMENT_SUFFIX = '.jsonl'
+QUARANTINE_DIR = 'quarantine'
+
+
+class SpoolFlushError(Exception):
+    """
+    Some spool segments could not be written to the DB
+    """
+    pass
+
+
+class SpoolSegment:
+    """
+    Append-only spool file, containing Counts records not yet written to the DB.
+    The file is kept locked (flock) by the owner process, until its records are committed and the file removed.
+    """
+    def __init__(self, path, fd=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        if fd is None:
+            fd = os.open(path, os.O_CREAT | os.O_APPEND | os.O_WRONLY, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        self.fd = fd
+        self.rows = []
+        # Failed writes, for causes other than DB unavailability
+        self.failures = 0
+
+    def append(self, rows):
+        """
+        Append a records batch as a single JSON line
+        :param rows: List of (timestamp, gate_id, p_in, p_out)
+        :return:
+        """
+        line = json.dumps(rows, separators=(',', ':')) + '\n'
+        os.write(self.fd, line.encode())
+        if INGEST_SPOOL_FSYNC:
+            os.fsync(self.fd)
+        self.rows.extend(rows)
+
+    def remove(self):
+        """
+        Delete the spool file, releasing its lock
+        :return:
+        """
+        try:
+            os.unlink(self.path)
+        finally:
+            os.close(self.fd)
+
+    def quarantine(self, dest_dir):
+        """
+        Move the spool file to `dest_dir` (never replayed), releasing its lock
+        :param dest_dir:
+        :return: New path
+        """
+        dest = os.path.join(dest_dir, self.name)
+        try:
+            os.rename(self.path, dest)
+        finally:
+            os.close(self.fd)
+        return dest
+
+    @staticmethod
+    def try_adopt(path):
+        """
+        Take ownership of a spool file left by a previous (dead) process, and load its records.
+        A truncated last line (crash during a write) is discarded.
+        :param path:
+        :return: SpoolSegment, or None if the file is still owned by a running process
+        """
+        fd = os.open(path, os.O_APPEND | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        seg = SpoolSegment(path, fd)
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    rows = json.loads(line)
+                except ValueError:
+                    continue
+                seg.rows.extend(tuple(r) for r in rows)
+        return seg
+
+
+class IngestSpool:
+    """
+    Write-behind stage for MUs Counts updates.
+    Each update is durably appended to a local spool file, then records are written to the DB in bulk,
+    by :class:`WriteBehindThreadBody`, when enough records are pending or the flush interval expires.
+    Segments that cannot be written (bad records, not a DB outage) don't block the others, and after
+    `max_failures` attempts are moved to the quarantine directory, for manual inspection.
+    """
+    def __init__(self, spool_dir=INGEST_SPOOL_DIR, max_failures=INGEST_SEGMENT_MAX_FAILURES):
+        """
+        :param spool_dir: Directory containing spool files. Spool files found at startup are replayed
+        :param max_failures: Failed writes of a segment before it is quarantined
+        """
+        self.spool_dir = spool_dir
+        self.quarantine_dir = os.path.join(spool_dir, QUARANTINE_DIR)
+        self.max_failures = max_failures
+        os.makedirs(self.quarantine_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # Held while a segment is committed and removed, so `pending_snapshot()` never overlaps with DB content
+        self.flush_lock = threading.Lock()
+        self.flush_evt = threading.Event()
+
+        self.active: SpoolSegment = None
+        self.sealed = []
+        self.n_pending = 0
+        # Write sequence number: incremented by each append and direct commit of Counts records
+        self.seq = 0
+        self.stats = {'appended_rows': 0, 'flushed_rows': 0, 'flushed_batches': 0, 'replayed_rows': 0,
+                      'flush_failures': 0, 'segment_failures': 0, 'quarantined_batches': 0, 'quarantined_rows': 0}
+        # function(session, rows), called inside each flush transaction
+        self.commit_hooks = []
+
+        self.__replay__()
+
+    def __replay__(self):
+        """
+        Adopt spool files left by previous runs. Files already committed to the DB (crash before their removal)
+        are simply deleted.
+        :return:
+        """
+        adopted = []
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, f'{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}'))):
+            seg = SpoolSegment.try_adopt(path)
+            if seg is not None:
+                adopted.append(seg)
+        if len(adopted) == 0:
+            return
+
+        session = Session()
+        try:
+            qry = session.query(IngestBatchRecord.segment)
+            qry = qry.filter(IngestBatchRecord.segment.in_([seg.name for seg in adopted]))
+            committed = {row[0] for row in qry.all()}
+        finally:
+            session.close()
+
+        for seg in adopted:
+            if seg.name in committed:
+                seg.remove()
+                continue
+            self.sealed.append(seg)
+            self.n_pending += len(seg.rows)
+            self.stats['replayed_rows'] += len(seg.rows)
+        if self.n_pending > 0:
+            self.flush_evt.set()
+
+    def append(self, rows):
+        """
+        Durably queue new Counts records
+        :param rows: List of (timestamp, gate_id, p_in, p_out)
+        :return: Write sequence number of the records
+        """
+        with self.lock:
+            self.seq += 1
+            if len(rows) == 0:
+                return self.seq
+            if self.active is None:
+                name = f'{SEGMENT_PREFIX}{time.time_ns()}-{os.getpid()}{SEGMENT_SUFFIX}'
+                self.active = SpoolSegment(os.path.join(self.spool_dir, name))
+            self.active.append(rows)
+            self.n_pending += len(rows)
+            self.stats['appended_rows'] += len(rows)
+            if self.n_pending >= INGEST_FLUSH_ROWS:
+                self.flush_evt.set()
+            return self.seq
+
+    def commit(self, session):
+        """
+        Commit a transaction that writes Counts records directly (bypassing the spool), ordered with spool flushes
+        and :meth:`pending_snapshot`
+        :param session: DB-session with the open transaction
+        :return: Write sequence number of the records
+        """
+        with self.flush_lock:
+            session.commit()
+            with self.lock:
+                self.seq += 1
+                return self.seq
+
+    def pending_snapshot(self):
+        """
+        Must be called holding `self.flush_lock`, together with the DB read the queued records are added to
+        :return: (List of all queued records not yet written to the DB, write sequence number of the last records
+            either queued or committed)
+        """
+        with self.lock:
+            rows = []
+            for seg in self.sealed:
+                rows.extend(seg.rows)
+            if self.active is not None:
+                rows.extend(self.active.rows)
+            return rows, self.seq
+
+    def __seal__(self):
+        """
+        Close current active segment: next appends go to a new spool file
+        :return: List of segments to be flushed
+        """
+        with self.lock:
+            if self.active is not None:
+                self.sealed.append(self.active)
+                self.active = None
+            return list(self.sealed)
+
+    def flush(self):
+        """
+        Write all queued records to the DB: one transaction (bulk INSERT) for each spool segment.
+        The segment name is stored in the same transaction, so a replayed segment is never written twice.
+        A DB outage (OperationalError) stops the flush, other failures are counted for the segment and the flush
+        goes on with the next ones.
+        :raise SpoolFlushError: if some segment failed (it is kept, or quarantined)
+        :return: Number of records written
+        """
+        n_flushed = 0
+        errors = []
+        for seg in self.__seal__():
+            with self.flush_lock:
+                session = Session()
+                try:
+                    session.add(IngestBatchRecord(seg.name, time.time(), len(seg.rows)))
+                    session.flush()
+                    write_count_rows(session, seg.rows)
+                    for hook in self.commit_hooks:
+                        hook(session, seg.rows)
+                    session.commit()
+                except OperationalError:
+                    raise
+                except Exception as e:
+                    session.rollback()
+                    if not (isinstance(e, IntegrityError) and self.__is_committed__(session, seg)):
+                        errors.append(self.__segment_failed__(seg, e))
+                        continue
+                    # Segment already committed before a crash
+                finally:
+                    session.close()
+
+                with self.lock:
+                    self.sealed.remove(seg)
+                    self.n_pending -= len(seg.rows)
+                    self.stats['flushed_rows'] += len(seg.rows)
+                    self.stats['flushed_batches'] += 1
+                seg.remove()
+                n_flushed += len(seg.rows)
+        if len(errors) > 0:
+            raise SpoolFlushError('; '.join(errors))
+        return n_flushed
+
+    @staticmethod
+    def __is_committed__(session, seg):
+        """
+        :return: True if the batch record of `seg` is in the DB
+        """
+        return session.query(IngestBatchRecord.segment).filter(IngestBatchRecord.segment == seg.name).first() \
+            is not None
+
+    def __segment_failed__(self, seg, e):
+        """
+        Count a failed write of `seg`, quarantining it after `max_failures` attempts
+        :return: Error description
+        """
+        seg.failures += 1
+        self.stats['segment_failures'] += 1
+        if seg.failures < self.max_failures:
+            return f'{seg.name} (attempt {seg.failures}/{self.max_failures}): {str(e)}'
+        with self.lock:
+            self.sealed.remove(seg)
+            self.n_pending -= len(seg.rows)
+            self.stats['quarantined_batches'] += 1
+            self.stats['quarantined_rows'] += len(seg.rows)
+        dest = seg.quarantine(self.quarantine_dir)
+        return f'{seg.name} QUARANTINED ({len(seg.rows)} records moved to {dest}): {str(e)}'
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending_rows'] = self.n_pending
+        return stats
+
+
+class WriteBehindThreadBody:
+    """
+    Thread body that periodically flushes :class:`IngestSpool` records to the DB
+    """
+    def __init__(self, flsk_app: Flask, spool: IngestSpool):
+        self.app = flsk_app
+        self.spool = spool
+        self.process = True
+
+    def __call__(self):
+        while self.process:
+            self.spool.flush_evt.wait(INGEST_FLUSH_INTERVAL_S)
+            self.spool.flush_evt.clear()
+            try:
+                self.spool.flush()
+            except Exception as e:
+                self.spool.stats['flush_failures'] += 1
+                with self.app.app_context():
+                    self.app.logger.error(f'WriteBehind flush FAIL (records kept in spool): {str(e)}')
+                time.sleep(INGEST_FLUSH_INTERVAL_S)
@@ -0,0 +1,141 @@
+import heapq
+import threading
+import time
+
+from configs.config import MU_IS_ALIVE_T
+
+
+class LivenessTracker:
+    """
+    Online/offline state of Monitoring Units, by deadlines: a unit is online until `timeout` seconds after it was
+    last seen.
+    Deadlines are kept in a min-heap with one entry per online unit: seeing a unit only moves its deadline forward
+    (the heap entry is rescheduled when it comes due), so :meth:`seen` is O(1) for online units and O(log n) for new
+    ones, and expiries are found in O(log n) each, as soon as they are due.
+    The online units snapshot and the set of missing units (among the expected ones) are updated only on changes.
+    """
+    def __init__(self, all_units, timeout=MU_IS_ALIVE_T):
+        """
+        :param all_units: IDs of expected units
+        :param timeout: Seconds after the last message before a unit is considered offline
+        """
+        self.all_units = frozenset(all_units)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # {unit: deadline} of online units
+        self.deadlines = {}
+        # Heap of (deadline, unit), one entry for each online unit
+        self.heap = []
+        self.missing = frozenset(self.all_units)
+        self.online = ()
+        # Set when a unit joins (its deadline can be the first one)
+        self.joined = threading.Event()
+        self.stats = {'joins': 0, 'expiries': 0, 'reschedules': 0}
+
+    def seen(self, unit, t_seen=None):
+        """
+        :param unit: Unit's ID
+        :param t_seen: Timestamp of the last message from `unit` (default: now)
+        :return: True if `unit` just became online
+        """
+        t_now = time.time()
+        deadline = (t_now if t_seen is None else t_seen) + self.timeout
+        with self.lock:
+            current = self.deadlines.get(unit)
+            if current is not None:
+                if deadline > current:
+                    self.deadlines[unit] = deadline
+                return False
+            if deadline < t_now:
+                return False
+            self.deadlines[unit] = deadline
+            heapq.heappush(self.heap, (deadline, unit))
+            self.__changed__()
+            self.stats['joins'] += 1
+        self.joined.set()
+        return True
+
+    def __changed__(self):
+        """
+        Update snapshots. Must be called holding `self.lock`
+        """
+        self.online = tuple(self.deadlines)
+        self.missing = self.all_units.difference(self.deadlines)
+
+    def __reschedule_due__(self, t_now):
+        """
+        Move forward the due heap entries of units seen in the meantime. Must be called holding `self.lock`
+        :return: True if the first heap entry is expired
+        """
+        while len(self.heap) > 0 and self.heap[0][0] < t_now:
+            deadline, unit = self.heap[0]
+            current = self.deadlines[unit]
+            if current == deadline:
+                return True
+            heapq.heapreplace(self.heap, (current, unit))
+            self.stats['reschedules'] += 1
+        return False
+
+    def pending_expiry(self, t_now=None):
+        """
+        :return: True if some unit missed its deadline (it is removed by :meth:`expire`)
+        """
+        with self.lock:
+            return self.__reschedule_due__(time.time() if t_now is None else t_now)
+
+    def expire(self, t_now=None):
+        """
+        Remove units that missed their deadline
+        :return: List of removed units
+        """
+        t_now = time.time() if t_now is None else t_now
+        expired = []
+        with self.lock:
+            while self.__reschedule_due__(t_now):
+                _, unit = heapq.heappop(self.heap)
+                del self.deadlines[unit]
+                expired.append(unit)
+            if len(expired) > 0:
+                self.__changed__()
+                self.stats['expiries'] += len(expired)
+        return expired
+
+    def next_deadline(self):
+        """
+        :return: Timestamp of the first heap entry (a unit could expire then), or None
+        """
+        with self.lock:
+            return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def wait_deadline(self, max_wait):
+        """
+        Sleep until the first deadline (at most `max_wait` seconds), waking up early if a unit joins
+        :param max_wait: seconds
+        :return:
+        """
+        self.joined.clear()
+        t_next = self.next_deadline()
+        t_wait = max_wait if t_next is None else min(max_wait, t_next - time.time())
+        self.joined.wait(max(0.01, t_wait))
+
+    def is_online(self, unit):
+        return unit in self.deadlines
+
+    def get_online(self):
+        """
+        :return: Tuple of online units (snapshot)
+        """
+        return self.online
+
+    def someone_miss(self):
+        """
+        :return: True if some of the expected units is not online
+        """
+        return len(self.missing) > 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['online'] = len(self.online)
+            stats['missing'] = sorted(self.missing)
+        return stats
@@ -1,5 +1,4 @@
-import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 
 from apscheduler.triggers.date import DateTrigger
 from flask import Flask
@@ -7,100 +6,34 @@ from flask_apscheduler import APScheduler
 from flask_apscheduler.auth import HTTPBasicAuth
 
 from db.db_mismatch import MismatchRecord
-from endpoints.queries_utils import estimate_people_num, estimate_people_now_custom, estimate_people_evts, gen_evt_strings, \
-    get_next_closedays_set, cleanup_all_db, get_accuracy_mismatch_based
+from endpoints.queries_utils import estimate_people_now_custom, estimate_people_evts, gen_evt_strings, \
+    cleanup_all_db, get_accuracy_mismatch_based
 from net_io.mail_management import MailManager
+from utils.counts_engine import CountsEngine
+from utils.shared_state import SharedState, CH_ACCURACY
+from utils.query_cache import QueryCache, KIND_COUNTS, KIND_CLOSEDAYS
+from utils.close_time_alert import CloseTimeAlert
+from utils.building_calendar import BuildingCalendar
 from db.db_base import Session
+from db.partitions import is_partitioned, ensure_partitions
 
 from configs.config import NOW_TIMERANGE, ALL_STR, H_DAILY_REPORT, H_NIGHT_REPORT, NIGHT_TIMERANGE, \
-    email_anomal_activities_recipients, WEEK_CLOSE_DAYS, INST_ALERT_REFRESH_RATE, INST_ALERT_TRIGGER_P_NUM, \
-    INST_ALERT_RENEW_RANGE_H, USERS, USERS_PASS, DB_CLEAN_DAYS_BEFORE, DB_NEXT_CLEAN_DAYS, \
-    ACCURACY_DAYS
+    email_anomal_activities_recipients, USERS, USERS_PASS, DB_CLEAN_DAYS_BEFORE, DB_NEXT_CLEAN_DAYS, \
+    ACCURACY_DAYS, COUNTS_CHECK_INTERVAL_MIN, PEOPLE_COUNTS_PARTITION_DAYS_AHEAD, PEOPLE_COUNTS_PARTITION_CHECK_H
 
 
-def is_close_night_weekend(dt_now):
+def setup_periodic_tasks(app: Flask, mail_man: MailManager, counts_engine: CountsEngine, shared_state: SharedState,
+                         query_cache: QueryCache, close_alert: CloseTimeAlert, calendar: BuildingCalendar):
     """
-    Utility function that establish if given datetime is inside a night or weekend time-range
-    :param dt_now:
-    :return: True if dt_now is inside night or weekend time-range; False otherwise.
-    """
-    dt_now = dt_now.replace(microsecond=0)
-    dt_1 = dt_now.replace(hour=NIGHT_TIMERANGE[0], minute=0, second=0)
-    if dt_now < dt_1:
-        dt_1 -= timedelta(days=1)
-    dt_2 = dt_1.replace(hour=NIGHT_TIMERANGE[1]) + timedelta(days=1)
-    if dt_1 <= dt_now <= dt_2:
-        return True
-    if dt_now.weekday() in WEEK_CLOSE_DAYS:
-        return True
-    return False
-
-
-def get_close_range(dt_from: datetime):
-    """
-    Perform a query to DB to retrieve all closing days from a given datetime to next 60 days, and establish
-    the closing time-range of building, from the same datetime.
-    :param dt_from:
-    :return: datetime Tuple: (start_close_day, end_close_day)
-    """
-    session = Session()
-    next_closedays = get_next_closedays_set(dt_from.date(), 60, session)
-    session.close()
-
-    if not is_close_night_weekend(dt_from) and dt_from.date() not in next_closedays:
-        dt_from = dt_from.replace(hour=NIGHT_TIMERANGE[0], minute=0, second=0, microsecond=0)
-    close = [dt_from, dt_from.replace(hour=NIGHT_TIMERANGE[1], minute=0, second=0, microsecond=0)]
-    if close[1] <= close[0]:
-        close[1] = close[1] + timedelta(days=1)
-    dt_next = close[1] + timedelta(minutes=1)
-
-    while is_close_night_weekend(dt_next) or dt_next.date() in next_closedays:
-        dt_next += timedelta(days=1)
-        close[1] = dt_next.replace(minute=0)
-
-    return close[0], close[1]
-
-
-def is_close_date(dt_now: datetime):
-    """
-    :param dt_now:
-    :return: True if `dt_now` is a close-day, False otherwise
-    """
-    if dt_now.weekday() in WEEK_CLOSE_DAYS:
-        return True
-    session = Session()
-    next_closedays = get_next_closedays_set(dt_now.date(), 60, session)
-    session.close()
-    if dt_now.date() in next_closedays:
-        return True
-
-
-def was_night_range(r_start: datetime, r_end: datetime):
-    """
-    Establish if given time-range is a Night-Range or not
-    :param r_start:
-    :param r_end:
-    :return: True if time-range is a Night-Range, False otherwise
-    """
-    assert r_start <= r_end
-    dt_now = datetime.now().replace(microsecond=0)
-    night_start = dt_now.replace(hour=NIGHT_TIMERANGE[0], minute=0, second=0)
-    if dt_now < night_start:
-        night_start -= timedelta(days=1)
-    night_end = night_start.replace(hour=NIGHT_TIMERANGE[1]) + timedelta(days=1)
-
-    night_range_delta = night_end - night_start
-    range_delta = r_end - r_start
-
-    is_night_range = range_delta <= night_range_delta
-    return is_night_range
-
-
-def setup_periodic_tasks(app: Flask, mail_man: MailManager):
-    """
-    Setup function that attach APScheduler to the given FlaskApp
+    Setup function that attach APScheduler to the given FlaskApp.
+    The scheduler is not started: only the scheduler leader among Collector processes starts it
     :param app: FlaskApp
     :param mail_man: MailManager object
+    :param counts_engine: In-memory running totals of current daily Counts
+    :param shared_state: Shared state of Collector processes, used to publish the updated accuracy
+    :param query_cache: Cache of Counts and close-days queries (invalidated by DB cleanup)
+    :param close_alert: Anomalous activity detector, armed during closing time-ranges
+    :param calendar: Opening hours of the building
     :return: APScheduler instance
     """
     class Config:
@@ -111,8 +44,6 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
     scheduler = APScheduler()
     app.config.from_object(Config())
 
-    mail_man.scheduler = scheduler
-
     @scheduler.task(id='daily_mismatch', name='MismatchReport', max_instances=1, misfire_grace_time=None,
                     trigger='cron', hour=H_DAILY_REPORT)
     def daily_report_mismatch():
@@ -141,7 +72,7 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
                 mismatches[str(dt_reset.replace(microsecond=0))] = res
         session.commit()
 
-        app.config['ACCURACY'] = get_accuracy_mismatch_based(ACCURACY_DAYS, session)
+        shared_state.publish(CH_ACCURACY, get_accuracy_mismatch_based(ACCURACY_DAYS, session))
 
         session.close()
 
@@ -164,7 +95,7 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
         :return:
         """
         try:
-            if is_close_date(datetime.now()) or is_close_date(datetime.now()-timedelta(days=1)):
+            if calendar.is_close_date(date.today()) or calendar.is_close_date(date.today() - timedelta(days=1)):
                 with app.app_context():
                     app.logger.info('Night Activity Report Skip for close-day')
                 return
@@ -193,7 +124,7 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
             with app.app_context():
                 app.logger.error(f'Daily Night Report Failure:\n{str(e)}')
 
-    dt_start, _ = get_close_range(datetime.now())
+    dt_start, _ = calendar.get_close_range(datetime.now())
     with app.app_context():
         app.logger.info(f'Instant Alert task will turned on @ {dt_start.replace(microsecond=0)}')
 
@@ -201,50 +132,29 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
                     trigger='date', run_date=dt_start)
     def instant_alert():
         """
-        Task activated during closing time-ranges, and send an email if catch some Entrances/Exits Events.
-        At the end of his execution, send an email that report all entrances/exit events in closing time-range,
-        and re-schedule itself.
+        Task activated at the start of closing time-ranges: arm the anomalous activity detector (that send an email
+        if catch some Entrances/Exits Events), and schedule the end of the closing time-range.
         :return:
         """
-        dt_start0, dt_end0 = get_close_range(datetime.now())
-
-        dt_start, dt_end = dt_start0.replace(), dt_end0.replace()
-
-        while dt_start <= datetime.now() < dt_end:
-            try:
-                time.sleep(INST_ALERT_REFRESH_RATE)
-                session = Session()
-                cnts = estimate_people_num(ALL_STR, dt_start, dt_end, False, session)
-                session.close()
-                assert len(cnts) == 1
-                _, p_in, p_out = cnts[0]
-
-                if (p_in - p_out) >= INST_ALERT_TRIGGER_P_NUM:
-                    msg = f'Someone in the building:\n'
-                    msg += f'\tDetected {p_in - p_out} Persons in the building in time-rage '
-                    msg += f'{dt_start.replace(microsecond=0)} --- {datetime.now().replace(microsecond=0)}\n\n'
-                    session = Session()
-                    cnt_now = estimate_people_now_custom(ALL_STR, datetime.now(), session)
-                    session.close()
-                    msg += f'Total people estimated today: {cnt_now["tot"]}\n\n'
-                    msg += f'For further information, please inspect the Event List\n'
-                    mail_man.broadcast_user_email(email_anomal_activities_recipients,
-                                                  'Anomalous Activity in Close Time', msg)
-                    with app.app_context():
-                        app.logger.info('Instant Alert mail sent')
-                    dt_start = datetime.now()
-
-                if p_in < p_out:
-                    dt_start = datetime.now()
-                elif datetime.now() - dt_start > timedelta(hours=INST_ALERT_RENEW_RANGE_H):
-                    dt_start = datetime.now() - timedelta(hours=INST_ALERT_RENEW_RANGE_H)
+        dt_start0, dt_end0 = calendar.get_close_range(datetime.now())
+        close_alert.arm(dt_start0, dt_end0)
+        scheduler.add_job(id='inst_alert_end', name='InstantAlertEnd', func=instant_alert_end,
+                          args=[dt_start0, dt_end0], max_instances=1, misfire_grace_time=None, trigger=DateTrigger(run_date=dt_end0))
+        with app.app_context():
+            app.logger.info(f'Instant Alert armed until {dt_end0.replace(microsecond=0)}')
 
-            except Exception as e:
-                with app.app_context():
-                    app.logger.error(f'Something wrong during Instant Alert task: \n{str(e)}')
+    def instant_alert_end(dt_start0: datetime, dt_end0: datetime):
+        """
+        At the end of closing time-range, disarm the anomalous activity detector, send an email that report all
+        entrances/exit events in closing time-range, and re-schedule the Instant Alert.
+        :param dt_start0:
+        :param dt_end0:
+        :return:
+        """
+        close_alert.disarm()
 
         try:
-            if not was_night_range(dt_start0, dt_end0):
+            if not calendar.is_night_range(dt_start0, dt_end0):
                 session = Session()
                 evts_ls = estimate_people_evts(ALL_STR, dt_start0, dt_end0, False, session)
                 session.close()
@@ -267,7 +177,7 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
             with app.app_context():
                 app.logger.error(f'Something wrong during Instant Alert task (Recap Email): \n{str(e)}')
 
-        dt_next_close, _ = get_close_range(datetime.now())
+        dt_next_close, _ = calendar.get_close_range(max(datetime.now(), dt_end0))
         j = scheduler.add_job(id='inst_alert', name='InstantAlert', func=instant_alert,
                               max_instances=1, misfire_grace_time=None,
                               trigger=DateTrigger(run_date=dt_next_close))
@@ -279,7 +189,8 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
     @scheduler.task(id='clean_db', name='CleanupDB', max_instances=1, misfire_grace_time=None, trigger='date', run_date=dt_clean)
     def cleanup_db():
         """
-        Cleanup Record DB function. Remove all records older than a given date
+        Cleanup Record DB function. Remove all records older than a given date.
+        If Counts table is partitioned, also create next days partitions.
         :return:
         """
         last_valid_dt = datetime.now() - timedelta(days=DB_CLEAN_DAYS_BEFORE)
@@ -287,6 +198,12 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
         try:
             session = Session()
             results = cleanup_all_db(last_valid_dt, session)
+            query_cache.invalidate(KIND_COUNTS, everywhere=True)
+            query_cache.invalidate(KIND_CLOSEDAYS, everywhere=True)
+            if is_partitioned(session):
+                results['partitions_created'] = ensure_partitions(session, datetime.now().date(),
+                                                                  PEOPLE_COUNTS_PARTITION_DAYS_AHEAD)
+                session.commit()
             msg = f'Cleanup DB DONE!\nDelete all records older than {str(last_valid_dt.replace(microsecond=0))}\n'
             msg += '\tResults:\n'
             for k in results:
@@ -315,11 +232,53 @@ def setup_periodic_tasks(app: Flask, mail_man: MailManager):
                           max_instances=1, misfire_grace_time=None,
                           trigger=DateTrigger(run_date=dt_next_clean))
 
+    @scheduler.task(id='counts_check', name='CountsConsistencyCheck', max_instances=1, misfire_grace_time=None,
+                    trigger='interval', minutes=COUNTS_CHECK_INTERVAL_MIN)
+    def counts_consistency_check():
+        """
+        Verify in-memory daily Counts totals against the DB aggregation (totals are reloaded on mismatch)
+        :return:
+        """
+        try:
+            diffs = counts_engine.check_consistency()
+            if len(diffs) > 0:
+                msg = f'Daily Counts totals mismatch @ {datetime.now().replace(microsecond=0)}\n\n'
+                for gate_id in diffs:
+                    msg += f'\t- {gate_id}: {diffs[gate_id]}\n'
+                mail_man.broadcast_alert_email('[ALERT] Counts Consistency Check', msg)
+        except Exception as e:
+            with app.app_context():
+                app.logger.error(f'Counts Consistency Check Failure:\n{str(e)}')
+
+    @scheduler.task(id='counts_partitions', name='CountsPartitions', max_instances=1, misfire_grace_time=None,
+                    trigger='interval', hours=PEOPLE_COUNTS_PARTITION_CHECK_H)
+    def counts_partitions():
+        """
+        Keep the daily partitions of the Counts table created `PEOPLE_COUNTS_PARTITION_DAYS_AHEAD` days ahead, so that
+        records never land in the default partition
+        :return:
+        """
+        session = Session()
+        try:
+            if is_partitioned(session):
+                n_created = ensure_partitions(session, datetime.now().date(), PEOPLE_COUNTS_PARTITION_DAYS_AHEAD)
+                session.commit()
+                if n_created > 0:
+                    with app.app_context():
+                        app.logger.info(f'Counts partitions created: {n_created}')
+        except Exception as e:
+            session.rollback()
+            with app.app_context():
+                app.logger.error(f'Counts Partitions Failure:\n{str(e)}')
+        finally:
+            session.close()
+
     @scheduler.authenticate
     def authenticate(auth):
         """Check auth."""
         return auth["username"] == USERS[0] and auth["password"] == USERS_PASS[0]
 
+    shared_state.subscribe(CH_ACCURACY, lambda accuracy: app.config.update(ACCURACY=accuracy))
+
     scheduler.init_app(app)
-    scheduler.start()
     return scheduler
\ No newline at end of file
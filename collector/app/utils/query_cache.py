@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+from flask import Flask
+
+from db.db_base import Session
+from endpoints.queries_utils import estimate_people_num, get_next_closedays_set, DEVICE_DEFAULT
+from utils.shared_state import SharedState, CH_QUERY_CACHE
+
+from configs.config import ALL_STR, QUERY_CACHE_TTL_S, QUERY_CACHE_MAX_ENTRIES
+
+ALL = ALL_STR
+
+# Query kinds. Windows of KIND_COUNTS entries always start with (ts_from, ts_to)
+KIND_COUNTS = 'counts'
+KIND_CLOSEDAYS = 'closedays'
+
+
+class QueryCache:
+    """
+    Results of DB queries served by the web tier, keyed on (query kind, device, window), with TTL and explicit
+    invalidation: Counts results are dropped when committed records fall inside their time-range (by this or other
+    Collector processes), Closing-Days results when the close days are changed.
+    """
+    def __init__(self, flsk_app: Flask, shared_state: SharedState, ttl=QUERY_CACHE_TTL_S,
+                 max_entries=QUERY_CACHE_MAX_ENTRIES):
+        """
+        :param flsk_app:
+        :param shared_state: Shared state of Collector processes, used to invalidate their caches
+        :param ttl: Max age (seconds) of a cached result
+        :param max_entries:
+        """
+        self.app = flsk_app
+        self.shared = shared_state
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # {(kind, device, window): (t_expire, value)}
+        self.entries = OrderedDict()
+        # Incremented at each invalidation of a kind: results loaded across an invalidation are not stored
+        self.generations = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'dropped_entries': 0, 'stale_loads': 0}
+        shared_state.subscribe(CH_QUERY_CACHE, self.__on_invalidate__)
+
+    def get(self, kind, device, window, loader):
+        """
+        :param kind: Query kind
+        :param device: Device's ID (or None)
+        :param window: Hashable query parameters (time-range, etc.)
+        :param loader: function(session), that perform the query on a miss
+        :return: Query result (shared among callers: must not be modified)
+        """
+        key = (kind, device, window)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            generation = self.generations.get(kind, 0)
+
+        session = Session()
+        try:
+            value = loader(session)
+        finally:
+            session.close()
+
+        with self.lock:
+            if self.generations.get(kind, 0) != generation:
+                self.stats['stale_loads'] += 1
+                return value
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.__purge__()
+        return value
+
+    def __purge__(self):
+        """
+        Drop expired entries, then the least recently used ones. Must be called holding `self.lock`
+        """
+        t_now = time.time()
+        for key in [k for k, (t_expire, _) in self.entries.items() if t_expire <= t_now]:
+            del self.entries[key]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, kind, everywhere=False):
+        """
+        Drop all cached results of a kind
+        :param kind:
+        :param everywhere: Invalidate also the caches of the other Collector processes
+        :return:
+        """
+        if everywhere:
+            self.shared.publish(CH_QUERY_CACHE, {'kind': kind})
+        else:
+            self.__drop__(kind, lambda key: key[0] == kind)
+
+    def invalidate_counts(self, t_from=None, t_to=None, gate_ids=None):
+        """
+        Drop cached Counts whose time-range overlaps committed records
+        :param t_from: Timestamp of the oldest committed record (None: drop all Counts)
+        :param t_to: Timestamp of the newest committed record
+        :param gate_ids: Gates of committed records (aggregated Counts are always dropped)
+        :return:
+        """
+        if t_from is None:
+            self.invalidate(KIND_COUNTS)
+            return
+
+        def overlaps(key):
+            kind, device, window = key
+            if kind != KIND_COUNTS or window[0] > t_to or window[1] < t_from:
+                return False
+            return device in (DEVICE_DEFAULT, ALL) or gate_ids is None or device in gate_ids
+        self.__drop__(KIND_COUNTS, overlaps)
+
+    def __drop__(self, kind, match):
+        with self.lock:
+            self.generations[kind] = self.generations.get(kind, 0) + 1
+            self.stats['invalidations'] += 1
+            keys = [k for k in self.entries if match(k)]
+            for key in keys:
+                del self.entries[key]
+            self.stats['dropped_entries'] += len(keys)
+
+    def __on_invalidate__(self, data):
+        self.invalidate(data['kind'])
+
+    def people_num(self, device: str, time1: datetime, time2: datetime, per_gate: bool):
+        """
+        Cached `estimate_people_num()`
+        """
+        window = (int(time1.timestamp()), int(time2.timestamp()), per_gate)
+        return self.get(KIND_COUNTS, device, window,
+                        lambda session: estimate_people_num(device, time1, time2, per_gate, session))
+
+    def closedays(self, from_day: date, next_range_days: int):
+        """
+        Cached `get_next_closedays_set()`
+        :return: frozenset of Date objects
+        """
+        return self.get(KIND_CLOSEDAYS, None, (from_day, next_range_days),
+                        lambda session: frozenset(get_next_closedays_set(from_day, next_range_days, session)))
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups > 0 else None
+        return stats
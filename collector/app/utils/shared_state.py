@@ -0,0 +1,473 @@
+import abc
+import heapq
+import json
+import os
+import select
+import socket
+import threading
+import time
+import zlib
+
+from flask import Flask
+from sqlalchemy import text, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from db.db_base import Session, engine
+from db.shared_state import SharedUnitRecord, SharedFrameSlot, SharedSetMember, SharedClaim
+from net_io.frame_protocol import EncodedFrame
+
+from configs.config import SHARED_STATE_BACKEND, SHARED_STATE_SYNC_S, MU_IS_ALIVE_T
+
+PROCESS_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+# Leaderships: periodic tasks and alerts are run by a single process, the WebSocket servers by one process per host
+LEAD_SCHEDULER = 'scheduler'
+LEAD_NET = f'net@{socket.gethostname()}'
+
+# Fan-out channels
+CH_COUNTS_FEED = 'counts_feed'
+CH_MESSAGES = 'messages'
+CH_ACCURACY = 'accuracy'
+CH_QUERY_CACHE = 'query_cache'
+CH_CALENDAR = 'calendar'
+CH_AUTH_CACHE = 'auth_cache'
+CH_USER_DIRECTORY = 'user_directory'
+
+SET_NO_DISTURB = 'no_disturb_users'
+SET_SIGNATURES = 'mu_signatures'
+
+
+class ExpiringSet:
+    """
+    Set whose members are dropped at their expiry time. Expiries are kept in a min-heap, purged on each insertion
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {member: t_expire}
+        self.members = {}
+        # Heap of (t_expire, member)
+        self.heap = []
+
+    def add(self, member, t_expire):
+        """
+        :return: False if `member` is already in the set
+        """
+        t_now = time.time()
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] < t_now:
+                self.members.pop(heapq.heappop(self.heap)[1], None)
+            if member in self.members:
+                return False
+            self.members[member] = t_expire
+            heapq.heappush(self.heap, (t_expire, member))
+            return True
+
+    def __len__(self):
+        return len(self.members)
+
+
+class SharedState(abc.ABC):
+    """
+    State shared among Collector processes (gunicorn workers, swarm replicas): MUs liveness, debug-frame slots,
+    named sets, subscribers fan-out and leaderships.
+    Leadership callbacks, subscribers and frame followers must be registered before :meth:`start`.
+    """
+    def __init__(self, flsk_app: Flask):
+        self.app = flsk_app
+        self.process_id = PROCESS_ID
+        self.lock = threading.Lock()
+        self.leaderships = {}
+        self.lost_callbacks = {}
+        self.held = set()
+        self.subscribers = {}
+        # {channel: data}, dispatched when messages of other processes may have been lost
+        self.resync = {}
+        self.frame_followers = []
+
+    def on_leadership(self, name, callback, on_lost=None):
+        """
+        :param name: Leadership name
+        :param callback: function(), run each time this process become the leader for `name`
+        :param on_lost: function(), run when this process loses the leadership `name`: it must stop what `callback`
+        started, as another process can become the leader
+        :return:
+        """
+        self.leaderships.setdefault(name, []).append(callback)
+        if on_lost is not None:
+            self.lost_callbacks.setdefault(name, []).append(on_lost)
+
+    def is_leader(self, name):
+        return name in self.held
+
+    def __became_leader__(self, name):
+        self.held.add(name)
+        with self.app.app_context():
+            self.app.logger.info(f'[{self.process_id}] Leadership acquired: {name}')
+        self.__run_callbacks__(name, self.leaderships)
+
+    def __lost_leaderships__(self):
+        """
+        Stop the services of all held leaderships
+        """
+        lost, self.held = self.held, set()
+        if len(lost) == 0:
+            return
+        with self.app.app_context():
+            self.app.logger.error(f'[{self.process_id}] Leaderships lost: {sorted(lost)}')
+        for name in lost:
+            self.__run_callbacks__(name, self.lost_callbacks)
+
+    def __run_callbacks__(self, name, callbacks):
+        for callback in callbacks.get(name, []):
+            try:
+                callback()
+            except Exception as e:
+                with self.app.app_context():
+                    self.app.logger.error(f'Leadership {name} callback FAIL: {str(e)}')
+
+    def subscribe(self, channel, callback):
+        """
+        :param channel:
+        :param callback: function(data), called for each message published on `channel` by any process
+        :return:
+        """
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def resync_on_reconnect(self, channel, data):
+        """
+        :param channel:
+        :param data: Message dispatched to this process subscribers of `channel` each time the listener of other
+            processes messages (re)connects, as messages published while it was down are lost
+        :return:
+        """
+        self.resync[channel] = data
+
+    def publish(self, channel, data):
+        """
+        Deliver a message to the subscribers of all processes (this process ones are called immediately)
+        :param channel:
+        :param data: JSON-serializable object
+        :return:
+        """
+        self.__dispatch__(channel, data)
+        self.__publish_remote__(channel, data)
+
+    def __dispatch__(self, channel, data):
+        for callback in self.subscribers.get(channel, []):
+            try:
+                callback(data)
+            except Exception as e:
+                with self.app.app_context():
+                    self.app.logger.error(f'Subscriber of "{channel}" FAIL: {str(e)}')
+
+    def __publish_remote__(self, channel, data):
+        pass
+
+    def notify_on_commit(self, session, channel, data):
+        """
+        Deliver a message to the subscribers of the other processes, when (and only if) `session` transaction commits.
+        The ID of the transaction (txid_current()) is added to `data` as 'xid'
+        :param session: DB-session with an open transaction
+        :param channel:
+        :param data: JSON-serializable dict
+        :return:
+        """
+        pass
+
+    def follow_frames(self, callback):
+        """
+        :param callback: function(EncodedFrame), called for debug-frames received by other processes
+        :return:
+        """
+        self.frame_followers.append(callback)
+
+    @abc.abstractmethod
+    def start(self):
+        """
+        Start sharing: acquire leaderships and deliver messages of other processes
+        """
+
+    @abc.abstractmethod
+    def mu_seen(self, device_id):
+        """
+        Record that a message of MU `device_id` was received now
+        """
+
+    @abc.abstractmethod
+    def get_units_last_seen(self):
+        """
+        :return: Dict {device_id: last seen timestamp}
+        """
+
+    @abc.abstractmethod
+    def put_frame(self, frame: EncodedFrame):
+        """
+        Make a debug-frame received by this process available to the others
+        """
+
+    @abc.abstractmethod
+    def set_add(self, name, member):
+        pass
+
+    @abc.abstractmethod
+    def set_remove(self, name, member):
+        pass
+
+    @abc.abstractmethod
+    def set_members(self, name):
+        """
+        :return: Set of members of the named set `name`
+        """
+
+    @abc.abstractmethod
+    def claim(self, name, member, t_expire):
+        """
+        Add `member` to the expiring named set `name`, until `t_expire`
+        :return: False if `member` is already in the set (claimed by any process)
+        """
+
+
+class InProcessState(SharedState):
+    """
+    Shared state of a single Collector process: it is always the leader, and messages are delivered only to its own
+    subscribers
+    """
+    def __init__(self, flsk_app: Flask):
+        super().__init__(flsk_app)
+        self.units = {}
+        self.sets = {}
+        self.claims = {}
+
+    def start(self):
+        for name in self.leaderships:
+            self.__became_leader__(name)
+
+    def mu_seen(self, device_id):
+        with self.lock:
+            self.units[device_id] = time.time()
+
+    def get_units_last_seen(self):
+        with self.lock:
+            return dict(self.units)
+
+    def put_frame(self, frame: EncodedFrame):
+        # Frames are already in this process FramesDict
+        pass
+
+    def set_add(self, name, member):
+        with self.lock:
+            self.sets.setdefault(name, set()).add(member)
+
+    def set_remove(self, name, member):
+        with self.lock:
+            self.sets.get(name, set()).discard(member)
+
+    def set_members(self, name):
+        with self.lock:
+            return set(self.sets.get(name, set()))
+
+    def claim(self, name, member, t_expire):
+        with self.lock:
+            claims = self.claims.setdefault(name, ExpiringSet())
+        return claims.add(member, t_expire)
+
+
+def leadership_key(name):
+    """
+    :param name:
+    :return: Key of the Postgres advisory lock that represent the leadership `name`
+    """
+    return zlib.crc32(f'gpc-leadership:{name}'.encode())
+
+
+def pg_channel(channel):
+    return f'gpc_{channel}'
+
+
+class PostgresState(SharedState):
+    """
+    Shared state kept in the Collector DB.
+    A dedicated connection holds the leaderships (session advisory locks, released by Postgres if the process dies)
+    and LISTEN for messages published by other processes (NOTIFY). If it fails, the leader services are stopped
+    before the connection (and so the locks) is closed, then leaderships are tried again on the new connection. Liveness and frames updates are buffered and
+    written every `sync_s` seconds by the same thread, that also loads the frames written by other processes.
+    """
+    def __init__(self, flsk_app: Flask, sync_s=SHARED_STATE_SYNC_S):
+        super().__init__(flsk_app)
+        self.sync_s = sync_s
+        self.process = True
+        self.pending_units = {}
+        self.pending_frames = {}
+        self.frames_seen = {}
+
+    def start(self):
+        th = threading.Thread(target=self, daemon=True)
+        th.start()
+
+    def __publish_remote__(self, channel, data):
+        payload = json.dumps({'src': self.process_id, 'data': data})
+        with engine.begin() as conn:
+            conn.execute(text('SELECT pg_notify(:channel, :payload)'),
+                         {'channel': pg_channel(channel), 'payload': payload})
+
+    def notify_on_commit(self, session, channel, data):
+        payload = json.dumps({'src': self.process_id, 'data': data})
+        session.execute(text("SELECT pg_notify(:channel, jsonb_set(CAST(:payload AS jsonb), '{data,xid}', "
+                             "to_jsonb(txid_current()))::text)"),
+                        {'channel': pg_channel(channel), 'payload': payload})
+
+    def mu_seen(self, device_id):
+        with self.lock:
+            self.pending_units[device_id] = time.time()
+
+    def get_units_last_seen(self):
+        session = Session()
+        try:
+            units = {r.device_id: r.t_seen for r in session.query(SharedUnitRecord).all()}
+        finally:
+            session.close()
+        with self.lock:
+            for device_id, t_seen in self.pending_units.items():
+                units[device_id] = max(t_seen, units.get(device_id, 0))
+        return units
+
+    def put_frame(self, frame: EncodedFrame):
+        with self.lock:
+            self.pending_frames[frame.device_id] = frame
+
+    def set_add(self, name, member):
+        with engine.begin() as conn:
+            conn.execute(pg_insert(SharedSetMember.__table__).values(name=name, member=member).on_conflict_do_nothing())
+
+    def set_remove(self, name, member):
+        with engine.begin() as conn:
+            conn.execute(SharedSetMember.__table__.delete().where(
+                (SharedSetMember.name == name) & (SharedSetMember.member == member)))
+
+    def set_members(self, name):
+        with engine.connect() as conn:
+            res = conn.execute(SharedSetMember.__table__.select().where(SharedSetMember.name == name)).all()
+        return {r.member for r in res}
+
+    def claim(self, name, member, t_expire):
+        claims_t = SharedClaim.__table__
+        stmt = pg_insert(claims_t).values(name=name, member=member, t_expire=t_expire)
+        # An expired claim (not purged yet) is taken over
+        stmt = stmt.on_conflict_do_update(index_elements=['name', 'member'], set_={'t_expire': stmt.excluded.t_expire},
+                                          where=claims_t.c.t_expire < time.time()).returning(claims_t.c.name)
+        with engine.begin() as conn:
+            return conn.execute(stmt).first() is not None
+
+    def __flush_pending__(self, conn):
+        """
+        Write buffered liveness and frames updates, purge expired claims
+        """
+        with self.lock:
+            units, self.pending_units = self.pending_units, {}
+            frames, self.pending_frames = self.pending_frames, {}
+        if len(units) > 0:
+            units_t = SharedUnitRecord.__table__
+            stmt = pg_insert(units_t).values([{'device_id': d, 't_seen': t} for d, t in units.items()])
+            stmt = stmt.on_conflict_do_update(index_elements=['device_id'],
+                                              set_={'t_seen': func.greatest(units_t.c.t_seen, stmt.excluded.t_seen)})
+            conn.execute(stmt)
+        if len(frames) > 0:
+            stmt = pg_insert(SharedFrameSlot.__table__).values([
+                {'device_id': f.device_id, 'owner': self.process_id, 'seq': f.seq, 'codec': f.codec,
+                 't_update': time.time(), 'data': f.data} for f in frames.values()])
+            stmt = stmt.on_conflict_do_update(index_elements=['device_id'],
+                                              set_={c: stmt.excluded[c] for c in ('owner', 'seq', 'codec',
+                                                                                   't_update', 'data')})
+            conn.execute(stmt)
+        conn.execute(SharedClaim.__table__.delete().where(SharedClaim.t_expire < time.time()))
+
+    def __load_frames__(self, conn):
+        """
+        Pass to the frame followers new frames of streams received by other processes
+        """
+        slots_t = SharedFrameSlot.__table__
+        res = conn.execute(slots_t.select().with_only_columns([slots_t.c.device_id, slots_t.c.owner, slots_t.c.seq])
+                           .where((slots_t.c.owner != self.process_id) &
+                                  (slots_t.c.t_update > time.time() - MU_IS_ALIVE_T))).all()
+        changed = [r.device_id for r in res if self.frames_seen.get(r.device_id) != (r.owner, r.seq)]
+        if len(changed) == 0:
+            return
+        for r in conn.execute(slots_t.select().where(slots_t.c.device_id.in_(changed))).all():
+            self.frames_seen[r.device_id] = (r.owner, r.seq)
+            frame = EncodedFrame(r.device_id, r.seq, r.t_update, r.codec, bytes(r.data))
+            for callback in self.frame_followers:
+                callback(frame)
+
+    def __connect__(self):
+        """
+        :return: DBAPI connection (autocommit) detached from the pool, listening all subscribed channels
+        """
+        fairy = engine.raw_connection()
+        fairy.detach()
+        conn = fairy.connection
+        conn.autocommit = True
+        cur = conn.cursor()
+        for channel in self.subscribers:
+            cur.execute(f'LISTEN {pg_channel(channel)}')
+        return conn
+
+    def __try_leaderships__(self, cur):
+        for name in self.leaderships:
+            if name in self.held:
+                continue
+            cur.execute('SELECT pg_try_advisory_lock(%s)', (leadership_key(name),))
+            if cur.fetchone()[0]:
+                self.__became_leader__(name)
+
+    def __on_notify__(self, notify):
+        msg = json.loads(notify.payload)
+        if msg['src'] == self.process_id:
+            return
+        self.__dispatch__(notify.channel[len(pg_channel('')):], msg['data'])
+
+    def __call__(self):
+        while self.process:
+            conn = None
+            try:
+                conn = self.__connect__()
+                cur = conn.cursor()
+                for channel, data in self.resync.items():
+                    self.__dispatch__(channel, data)
+                t_sync = 0
+                while self.process:
+                    if time.time() - t_sync >= self.sync_s:
+                        self.__try_leaderships__(cur)
+                        with engine.begin() as db_conn:
+                            self.__flush_pending__(db_conn)
+                        if len(self.frame_followers) > 0:
+                            with engine.connect() as db_conn:
+                                self.__load_frames__(db_conn)
+                        t_sync = time.time()
+                    if select.select([conn], [], [], self.sync_s) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self.__on_notify__(conn.notifies.pop(0))
+            except Exception as e:
+                with self.app.app_context():
+                    self.app.logger.error(f'SharedState FAIL: {str(e)}')
+                self.__lost_leaderships__()
+                time.sleep(self.sync_s)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+def make_shared_state(flsk_app: Flask, backend=SHARED_STATE_BACKEND):
+    """
+    :param flsk_app:
+    :param backend: 'inprocess' (single Collector process) | 'postgres' (N workers/replicas)
+    :return: SharedState instance
+    """
+    if backend == 'inprocess':
+        return InProcessState(flsk_app)
+    if backend == 'postgres':
+        return PostgresState(flsk_app)
+    raise ValueError(f'Unknown shared-state backend "{backend}"')
@@ -1,12 +1,19 @@
+import time
 from datetime import datetime
 
+from sqlalchemy.dialects.postgresql import insert
+
+from utils.counts_engine import CountsEngine
+from utils.ingest_spool import IngestSpool
+from utils.change_feed import CountsChangeFeed
+from utils.close_time_alert import CloseTimeAlert
 from utils.status_manager import StatusManagerThreadBody
 from endpoints.reset_form_utils import ResetForm
-from endpoints.queries_utils import estimate_people_now
 from net_io.updates_websoc import UpdateManagerThreadBody
 from db.db_base import Session
-from net_io.mucounts import MUCounts
-from db.people_count import PeopleCounts
+from net_io.mucounts_decoder import MUCountsRecords
+from db.counts_writer import write_count_rows
+from db.mu_sequence import MUSequenceRecord
 
 from configs.config import RESET_RECORD_NAME, ALL_STR
 
@@ -19,56 +26,105 @@ class GlobalStatus:
     Status of Collector services.
     Interact with DB to update Counts Estimation and send Updates to the GUI clients
     """
-    def __init__(self, update_manager: UpdateManagerThreadBody, status_manager: StatusManagerThreadBody):
+    def __init__(self, update_manager: UpdateManagerThreadBody, status_manager: StatusManagerThreadBody,
+                 counts_engine: CountsEngine, spool: IngestSpool, change_feed: CountsChangeFeed,
+                 close_alert: CloseTimeAlert):
         self.upd_mngr = update_manager
         self.stat_mngr = status_manager
+        self.counts = counts_engine
+        self.spool = spool
+        self.feed = change_feed
+        self.close_alert = close_alert
+        self.upd_mngr.set_source(self.get_counts_update)
 
-    def update_count(self, update: MUCounts):
+    def update_count(self, update: MUCountsRecords):
         """
-        Add new records into Cunts Estimation Table, and send updated counts to the clients
+        Queue new records for the Counts Estimation Table (write-behind spool), and send updated counts to the clients
         :param update:
         :return:
         """
         device = update.device_id
         self.stat_mngr.mu_seen(device)
-        evts = {}
-        for e in update.entrances:
-            time_s = e[1]
-            if not time_s in evts:
-                evts[time_s] = []
-            evts[time_s].append(('in', e[0]))
-        for e in update.exits:
-            time_s = e[1]
-            if not time_s in evts:
-                evts[time_s] = []
-            evts[time_s].append(('out', e[0]))
+        records = update.get_records()
 
-        session = Session()
-        for t, ls in zip(evts.keys(), evts.values()):
-            entered, exits, = 0, 0
-            for e in ls:
-                if e[0] == 'in':
-                    entered = entered + e[1]
-                else:
-                    exits = exits + e[1]
-
-            count = PeopleCounts(int(t), device, entered, exits)
-            session.add(count)
-
-        session.commit()
-        session.close()
+        seq = self.spool.append([(t, device, entered, exits) for t, entered, exits in records])
+        self.counts.add_records(device, records, seq)
+        self.close_alert.observe(device, records, seq)
         self.broadcast_counts()
 
+    def update_count_batch(self, updates):
+        """
+        Write a batch of sequenced updates (from one or more MUs) in a single transaction.
+        Updates whose sequence number is not above the MU high-water mark are already stored, and dropped.
+        :param updates: List of MUCountsRecords, each with its `seq`
+        :return: {'accepted': n, 'duplicates': m, 'high_water': {device_id: last_seq}}
+        """
+        by_device = {}
+        for update in updates:
+            by_device.setdefault(update.device_id, {})[update.seq] = update
+        devices = sorted(by_device.keys())
+
+        accepted = {}
+        high_water = {}
+        n_duplicates = len(updates) - sum(len(seqs) for seqs in by_device.values())
+        session = Session()
+        try:
+            stmt = insert(MUSequenceRecord.__table__).values(
+                [{'device_id': d, 'last_seq': -1, 'timestamp': time.time()} for d in devices])
+            session.execute(stmt.on_conflict_do_nothing(index_elements=['device_id']))
+            qry = session.query(MUSequenceRecord).filter(MUSequenceRecord.device_id.in_(devices))
+            qry = qry.order_by(MUSequenceRecord.device_id).with_for_update()
+
+            rows = []
+            for seq_rec in qry.all():
+                seq_rec: MUSequenceRecord
+                seqs = by_device[seq_rec.device_id]
+                new_seqs = sorted(s for s in seqs if s > seq_rec.last_seq)
+                n_duplicates += len(seqs) - len(new_seqs)
+                if len(new_seqs) > 0:
+                    records = []
+                    for s in new_seqs:
+                        records.extend(seqs[s].get_records())
+                    accepted[seq_rec.device_id] = records
+                    rows.extend((t, seq_rec.device_id, p_in, p_out) for t, p_in, p_out in records)
+                    seq_rec.last_seq = new_seqs[-1]
+                    seq_rec.timestamp = time.time()
+                high_water[seq_rec.device_id] = seq_rec.last_seq
+
+            write_count_rows(session, rows)
+            self.feed.emit(session, rows)
+            seq = self.spool.commit(session)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        for device in devices:
+            self.stat_mngr.mu_seen(device)
+        for device, records in accepted.items():
+            self.counts.add_records(device, records, seq)
+            self.close_alert.observe(device, records, seq)
+        if len(accepted) > 0:
+            self.broadcast_counts()
+        return {'accepted': len(updates) - n_duplicates, 'duplicates': n_duplicates, 'high_water': high_water}
+
+    def get_counts_update(self):
+        """
+        :return: Current Estimation People Counts, and if some MU is missing: {tot, in, out, error}
+        """
+        self.upd_mngr.some_error = self.stat_mngr.someone_miss()
+        counts = self.counts.get_counts(ALL)
+        counts['error'] = self.upd_mngr.some_error
+        return counts
+
     def broadcast_counts(self):
         """
-        Send current Estimation People Counts to GUI client
+        Send current Estimation People Counts to GUI client (coalesced by the UpdateManager).
+        Clients of other Collector processes are updated by the change feed, when records are committed
         :return:
         """
-        self.upd_mngr.some_error = self.stat_mngr.someone_miss()
-        session = Session()
-        counts = estimate_people_now(ALL, session)
-        self.upd_mngr.broadcast_update(counts)
-        session.close()
+        self.upd_mngr.schedule_broadcast()
 
     def reset_counters(self, form: ResetForm):
         """
@@ -81,7 +137,7 @@ class GlobalStatus:
         try:
             _full = form.full.data
             if _full:
-                current_counts = estimate_people_now(ALL, session)  # {'tot': p_cnt, 'in': p_in, 'out': p_out}
+                current_counts = self.counts.get_counts(ALL)  # {'tot': p_cnt, 'in': p_in, 'out': p_out}
                 entered = (current_counts['in']) * (-1)
                 exited = (current_counts['out']) * (-1)
                 rec_time = datetime.now()
@@ -106,7 +162,10 @@ class GlobalStatus:
         :param exited:
         :return:
         """
-        fix_record = PeopleCounts(int(rec_time.timestamp()), _RESET_RECORD_NAME, entered, exited)
-        session.add(fix_record)
-        session.commit()
+        rec_ts = int(rec_time.timestamp())
+        rows = [(rec_ts, _RESET_RECORD_NAME, entered, exited)]
+        write_count_rows(session, rows)
+        self.feed.emit(session, rows)
+        seq = self.spool.commit(session)
+        self.counts.add_records(_RESET_RECORD_NAME, [(rec_ts, entered, exited)], seq)
         self.broadcast_counts()
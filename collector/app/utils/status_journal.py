@@ -0,0 +1,186 @@
+import os
+import queue
+import threading
+import time
+
+from flask import Flask
+from sqlalchemy.exc import OperationalError
+
+from db.db_base import Session
+from db.monitorunitstatus import MonitorUnitStatusRecord
+
+from configs.config import STATUS_JOURNAL_QUEUE_SIZE, STATUS_JOURNAL_BATCH_ROWS, STATUS_JOURNAL_FLUSH_S, \
+    MU_FLAP_WINDOW_S, STATUS_JOURNAL_MAX_FAILURES
+
+DEBUG = bool(os.getenv('DEBUG'))
+
+# MU status codes (mu_status.code)
+CODE_CONNECTED = 9
+CODE_DISCONNECTED = -9
+CODE_VIDEO_LOST = -4
+
+
+class UnitUptime:
+    """
+    Connections history summary of a single MU
+    """
+    def __init__(self):
+        self.t_up = None
+        self.t_down = None
+        self.uptime_s = 0.
+        self.connects = 0
+        self.disconnects = 0
+        self.flaps = 0
+        self.video_losses = 0
+
+    def to_dict(self, t_now):
+        uptime_s = self.uptime_s + (t_now - self.t_up if self.t_up is not None else 0.)
+        return {'online': self.t_up is not None, 'uptime_s': round(uptime_s, 1), 'connects': self.connects,
+                'disconnects': self.disconnects, 'flaps': self.flaps, 'video_losses': self.video_losses}
+
+
+class StatusJournal:
+    """
+    Non-blocking journal of MUs status events (mu_status records).
+    Events are queued in memory (bounded: dropped and counted when full) and written in batches by the thread
+    running the journal, so MU requests and the Status Manager never wait for a DB commit; failed batches are kept
+    and retried while the DB is unreachable. A batch failing `max_failures` times for other causes is written one
+    record at a time, and the records still failing are dropped (counted as `poisoned`).
+    Per-MU uptime and flaps (reconnections within `MU_FLAP_WINDOW_S` seconds) are summarised on the way.
+    """
+    def __init__(self, flsk_app: Flask, queue_size=STATUS_JOURNAL_QUEUE_SIZE, batch_rows=STATUS_JOURNAL_BATCH_ROWS,
+                 flush_s=STATUS_JOURNAL_FLUSH_S, flap_window_s=MU_FLAP_WINDOW_S,
+                 max_failures=STATUS_JOURNAL_MAX_FAILURES):
+        """
+        :param flsk_app:
+        :param queue_size: Max number of events waiting to be written
+        :param batch_rows: Max number of records inserted by a single commit
+        :param flush_s: Max seconds before queued events are written
+        :param flap_window_s: Max seconds between a disconnection and the next connection, to count a flap
+        :param max_failures: Failed writes of a batch (DB reachable) before its records are written one by one
+        """
+        self.app = flsk_app
+        self.queue_size = queue_size
+        self.batch_rows = batch_rows
+        self.flush_s = flush_s
+        self.flap_window_s = flap_window_s
+        self.max_failures = max_failures
+        self.process = True
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Batch being written (kept on failures), and its failed writes
+        self.pending = []
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.units = {}
+        self.stats = {'queued': 0, 'dropped': 0, 'written': 0, 'flushes': 0, 'flush_failures': 0, 'poisoned': 0}
+
+    def log(self, dev_id: str, code: int, msg: str):
+        """
+        Record a MU status event (non-blocking)
+        :param dev_id: MU's ID
+        :param code: Status code
+        :param msg: Event description
+        :return: False if the record is dropped (queue full)
+        """
+        t_now = time.time()
+        self.__update_uptime__(dev_id, code, t_now)
+        if DEBUG:
+            return True
+        try:
+            self.queue.put_nowait((t_now, dev_id, code, msg))
+            stat = 'queued'
+        except queue.Full:
+            stat = 'dropped'
+        with self.lock:
+            self.stats[stat] += 1
+        return stat == 'queued'
+
+    def __update_uptime__(self, dev_id, code, t_now):
+        with self.lock:
+            unit = self.units.get(dev_id)
+            if unit is None:
+                unit = self.units[dev_id] = UnitUptime()
+            if code == CODE_CONNECTED:
+                unit.connects += 1
+                if unit.t_down is not None and t_now - unit.t_down <= self.flap_window_s:
+                    unit.flaps += 1
+                if unit.t_up is None:
+                    unit.t_up = t_now
+            elif code == CODE_DISCONNECTED:
+                unit.disconnects += 1
+                if unit.t_up is not None:
+                    unit.uptime_s += t_now - unit.t_up
+                unit.t_up = None
+                unit.t_down = t_now
+            elif code == CODE_VIDEO_LOST:
+                unit.video_losses += 1
+
+    def __call__(self):
+        while self.process:
+            try:
+                if len(self.pending) == 0:
+                    self.pending.append(self.queue.get(timeout=self.flush_s))
+                while len(self.pending) < self.batch_rows:
+                    self.pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if len(self.pending) == 0:
+                continue
+            try:
+                if self.failures >= self.max_failures:
+                    self.__flush_singly__()
+                else:
+                    self.flush(self.pending)
+                self.pending = []
+                self.failures = 0
+            except Exception as e:
+                if not isinstance(e, OperationalError):
+                    self.failures += 1
+                with self.lock:
+                    self.stats['flush_failures'] += 1
+                with self.app.app_context():
+                    self.app.logger.error(f'StatusJournal flush FAIL (records kept): {str(e)}')
+                time.sleep(self.flush_s)
+
+    def __flush_singly__(self):
+        """
+        Write pending records one at a time, dropping the ones that cannot be written (DB unreachable: stop, keeping
+        the rest)
+        """
+        while len(self.pending) > 0:
+            row = self.pending[0]
+            try:
+                self.flush([row])
+            except OperationalError:
+                raise
+            except Exception as e:
+                with self.lock:
+                    self.stats['poisoned'] += 1
+                with self.app.app_context():
+                    self.app.logger.error(f'StatusJournal record DROPPED {row[:3]}: {str(e)}')
+            self.pending.pop(0)
+
+    def flush(self, rows):
+        """
+        Insert records with a single commit
+        :param rows: List of (timestamp, gate_id, code, msg)
+        :return:
+        """
+        session = Session()
+        try:
+            session.bulk_insert_mappings(MonitorUnitStatusRecord, [
+                {'timestamp': t, 'gate_id': dev_id, 'status_code': code, 'msg': msg} for t, dev_id, code, msg in rows])
+            session.commit()
+        finally:
+            session.close()
+        with self.lock:
+            self.stats['written'] += len(rows)
+            self.stats['flushes'] += 1
+
+    def get_stats(self):
+        t_now = time.time()
+        with self.lock:
+            stats = dict(self.stats)
+            stats['queue'] = self.queue.qsize() + len(self.pending)
+            stats['units'] = {dev_id: unit.to_dict(t_now) for dev_id, unit in self.units.items()}
+        return stats
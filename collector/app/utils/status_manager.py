@@ -1,67 +1,41 @@
-import os
 import time
 
 from flask import Flask
 
-from db.db_base import Session
-from db.monitorunitstatus import MonitorUnitStatusRecord
 from net_io.mail_management import MailManager
 from net_io.messages_websoc import MSGManagerThreadBody, TAG_SYSADMIN
 from utils.frames_dict import FramesDict
+from utils.liveness import LivenessTracker
+from utils.shared_state import SharedState, LEAD_SCHEDULER
+from utils.status_journal import StatusJournal, CODE_CONNECTED, CODE_DISCONNECTED, CODE_VIDEO_LOST
 
 from configs.config import MU_IS_ALIVE_T
 
-DEBUG = bool(os.getenv('DEBUG'))
 IS_ALIVE_T = MU_IS_ALIVE_T
 IS_STREAM_ON_T = IS_ALIVE_T
 
 
-class MonitorUnitStatus:
-    """
-    Class that represent the Monitor unit, and offer methods to know his current status
-    """
-    def __init__(self, unit_name):
-        self.name = unit_name
-        self.t_update = time.time()
-        self.seen()
-
-    def is_alive(self):
-        """
-        :return: Ture if the last message received from it is no older then 20sec
-        """
-        # print(f'{self.name}.is_alive(self)')
-        t_now = time.time()
-        diff = t_now - self.t_update
-        if diff > IS_ALIVE_T:
-            # print(f'LAST UPDATE for: {diff} (was {self.t_update}) => NOT ALIVE')
-            return False
-        return True
-
-    def seen(self):
-        """
-        Update the timestamp of last message received from it
-        :return:
-        """
-        self.t_update = time.time()
-        # print(f'{self.name}.seen @{self.t_update}')
-
-
 class StatusManagerThreadBody:
     """
     Keep track of Monitor Units status and their outputs (count-updates and video streams).
     Exploit also the functionalities of Mail and Message Managers to communicate critical events (as monitor unit
-    connection/disconnection)
+    connection/disconnection). MUs liveness is tracked by deadlines (LivenessTracker) and merged with the one seen by
+    other Collector processes, and critical events are communicated only by the scheduler leader.
     """
     def __init__(self, flsk_app: Flask,
-                 frames_dict: FramesDict, mail_manager: MailManager, msg_manager: MSGManagerThreadBody):
-        self.connected_units = dict()
+                 frames_dict: FramesDict, mail_manager: MailManager, msg_manager: MSGManagerThreadBody,
+                 shared_state: SharedState, journal: StatusJournal):
         self.all_mu_names: set = flsk_app.config['ALL_UNITS']
+        self.liveness = LivenessTracker(self.all_mu_names, IS_ALIVE_T)
+        self.t_synced = 0
 
         self.frames_d = frames_dict
         self.process = True
         self.app = flsk_app
         self.mail_man = mail_manager
         self.msg_man = msg_manager
+        self.shared = shared_state
+        self.journal = journal
 
         # Base.metadata.create_all(engine)
 
@@ -72,7 +46,7 @@ class StatusManagerThreadBody:
         """
         while self.process:
             try:
-                time.sleep(IS_ALIVE_T)
+                self.liveness.wait_deadline(IS_ALIVE_T)
                 self.cleanup_mu_scan()
                 self.cleanup_streamers()
             except Exception as e:
@@ -80,80 +54,83 @@ class StatusManagerThreadBody:
                     self.app.logger.error(f'StatusManager FAIL: {str(e)}')
 
     def someone_miss(self):
-        connected_names = self.get_online_devices()
-        for mu_name in self.all_mu_names:
-            if mu_name not in connected_names:
-                return True
-        return False
+        return self.liveness.someone_miss()
 
     def get_online_devices(self):
-        r_ls =[]
-        for mu in self.connected_units.values():
-            mu: MonitorUnitStatus
-            r_ls.append(mu.name)
-        return r_ls
+        """
+        :return: Tuple of online MUs IDs (snapshot, not to be modified)
+        """
+        return self.liveness.get_online()
 
     def mu_seen(self, device_id):
-        if device_id not in self.connected_units:
-            mu = MonitorUnitStatus(device_id)
-            self.connected_units[device_id] = mu
+        self.shared.mu_seen(device_id)
+        if self.liveness.seen(device_id):
             self.notify_new_mu(device_id)
-            assert device_id in self.connected_units
-        else:
-            mu: MonitorUnitStatus = self.connected_units[device_id]
-            mu.seen()
+
+    def is_notifier(self):
+        """
+        :return: True if this process is in charge to communicate critical events
+        """
+        return self.shared.is_leader(LEAD_SCHEDULER)
 
     def log_db_record(self, dev_id: str, code: int, msg: str):
-        if not DEBUG:
-            session = Session()
-            log_record = MonitorUnitStatusRecord(time.time(), dev_id, code, msg)
-            session.add(log_record)
-            session.commit()
-            session.close()
+        """
+        Queue a mu_status record (written in background by the StatusJournal)
+        """
+        self.journal.log(dev_id, code, msg)
 
     def notify_new_mu(self, dev_id):
-        self.log_db_record(dev_id, 9, 'Connected')
+        if self.is_notifier():
+            self.log_db_record(dev_id, CODE_CONNECTED, 'Connected')
         msg = f'Monitoring Unit {dev_id} JOIN'
         with self.app.app_context():
             self.app.logger.info(msg)
+        if not self.is_notifier():
+            return
         self.msg_man.send_message_to(TAG_SYSADMIN, 'MU JOIN', msg, 'info', 15)
         self.mail_man.broadcast_alert_email('Monitor Unit: CONNECT', msg)
 
     def notify_rm_mu(self, dev_id):
         # print(f'notify_rm(self, {dev_id})')
-        self.log_db_record(dev_id, -9, 'Device Connection Lost')
+        if self.is_notifier():
+            self.log_db_record(dev_id, CODE_DISCONNECTED, 'Device Connection Lost')
         msg = f'Monitoring Unit {dev_id} LOST'
         with self.app.app_context():
             self.app.logger.error(msg)
+        if not self.is_notifier():
+            return
         self.msg_man.send_message_to(TAG_SYSADMIN, 'MU DISCONNECT', msg, 'danger', 20)
         self.mail_man.broadcast_alert_email('Monitor Unit: LOST', msg)
 
-    def remove_mu(self, device_id):
-        # print(f'remove_mu(self, {device_id})')
-        assert device_id in self.connected_units
-        if device_id not in self.connected_units:
-            return
-        rm_mu = self.connected_units.pop(device_id)
-        assert not(device_id in self.connected_units)
-        # del rm_mu
-        self.notify_rm_mu(device_id)
+    def sync_shared_liveness(self):
+        """
+        Merge MUs seen by other Collector processes
+        :return:
+        """
+        self.t_synced = time.time()
+        for mu_name, t_seen in self.shared.get_units_last_seen().items():
+            if self.liveness.seen(mu_name, t_seen):
+                self.notify_new_mu(mu_name)
 
     def cleanup_mu_scan(self):
-        rm_ls = []
-        mu_names = list(self.connected_units.keys())
-        for mu_name in mu_names:
-            mu: MonitorUnitStatus = self.connected_units[mu_name]
-            if not mu.is_alive():
-                assert mu_name in self.connected_units
-                self.remove_mu(mu_name)
+        """
+        Remove MUs that missed their deadline (after checking they were not seen by other processes), and merge MUs
+        seen by other processes at least every `IS_ALIVE_T` seconds
+        :return:
+        """
+        t_now = time.time()
+        if self.liveness.pending_expiry(t_now) or t_now - self.t_synced >= IS_ALIVE_T:
+            self.sync_shared_liveness()
+        for mu_name in self.liveness.expire(t_now):
+            self.notify_rm_mu(mu_name)
 
     def cleanup_streamers(self):
         t_now = time.time()
-        for dev_id in self.frames_d.get_streamers():
-            if t_now - self.frames_d.last_update(dev_id) > IS_STREAM_ON_T:
-                msg = f'[{dev_id}] Video LOST since {int(t_now - self.frames_d.last_update(dev_id))}s'
-                self.frames_d.remove_streamer(dev_id)
-                with self.app.app_context():
-                    self.app.logger.error(msg)
-                self.msg_man.send_message_to(TAG_SYSADMIN, 'Video LOST', msg, 'danger', 30)
-                self.log_db_record(dev_id, -4, 'Video-Stream Lost')
+        for dev_id, t_update in self.frames_d.pop_stale(IS_STREAM_ON_T):
+            msg = f'[{dev_id}] Video LOST since {int(t_now - t_update)}s'
+            with self.app.app_context():
+                self.app.logger.error(msg)
+            if not self.is_notifier():
+                continue
+            self.msg_man.send_message_to(TAG_SYSADMIN, 'Video LOST', msg, 'danger', 30)
+            self.log_db_record(dev_id, CODE_VIDEO_LOST, 'Video-Stream Lost')
@@ -0,0 +1,111 @@
+import threading
+from types import MappingProxyType
+
+from flask import Flask, has_app_context
+
+from utils.shared_state import CH_USER_DIRECTORY
+
+
+class DirectoryUser:
+    """
+    Read-only copy of a User (Flask-Login user interface), detached from the Users DB
+    """
+    __slots__ = ('id', 'username', 'email', 'password', 'is_active', 'is_admin')
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user):
+        """
+        :param user: ORM User object
+        """
+        for attr in self.__slots__:
+            object.__setattr__(self, attr, getattr(user, attr))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('DirectoryUser is read-only')
+
+    def get_id(self):
+        return str(self.id)
+
+
+class UserDirectory:
+    """
+    In-memory snapshot of the Users DB, keyed by ID and username, serving authentication and email recipients
+    without DB I/O.
+    Snapshots are immutable and replaced as a whole, so readers never see a partial reload; the Users DB must be
+    changed through :meth:`changed`, that reloads the directory of all Collector processes.
+    """
+    def __init__(self, flsk_app: Flask, user_class, shared_state=None):
+        """
+        :param flsk_app:
+        :param user_class: ORM User Class
+        :param shared_state: Shared state of Collector processes (optional), used to reload their directories
+        """
+        self.app = flsk_app
+        self.User = user_class
+        self.shared = shared_state
+        self.lock = threading.Lock()
+        self.by_id = None
+        self.by_username = None
+        self.stats = {'reloads': 0}
+        if shared_state is not None:
+            shared_state.subscribe(CH_USER_DIRECTORY, lambda data: self.reload())
+
+    def reload(self):
+        """
+        Load all Users into a new snapshot
+        :return:
+        """
+        with self.lock:
+            if has_app_context():
+                users = [DirectoryUser(u) for u in self.User.query.all()]
+            else:
+                with self.app.app_context():
+                    users = [DirectoryUser(u) for u in self.User.query.all()]
+            self.by_id, self.by_username = MappingProxyType({u.id: u for u in users}), \
+                MappingProxyType({u.username: u for u in users})
+            self.stats['reloads'] += 1
+
+    def __snapshot__(self):
+        by_id, by_username = self.by_id, self.by_username
+        if by_id is None:
+            self.reload()
+            by_id, by_username = self.by_id, self.by_username
+        return by_id, by_username
+
+    def changed(self):
+        """
+        Reload the directories of all Collector processes, after a change committed to the Users DB
+        :return:
+        """
+        if self.shared is not None:
+            self.shared.publish(CH_USER_DIRECTORY, {})
+        else:
+            self.reload()
+
+    def get(self, user_id):
+        """
+        :return: DirectoryUser, or None
+        """
+        return self.__snapshot__()[0].get(user_id)
+
+    def get_by_username(self, username):
+        """
+        :return: DirectoryUser, or None
+        """
+        return self.__snapshot__()[1].get(username)
+
+    def emails(self, usernames, exclude=()):
+        """
+        :param usernames: Iterable of usernames (unknown ones are ignored)
+        :param exclude: Usernames to skip
+        :return: Set of email addresses
+        """
+        by_username = self.__snapshot__()[1]
+        return {by_username[u].email for u in usernames if u in by_username and u not in exclude}
+
+    def get_stats(self):
+        by_id = self.by_id
+        stats = dict(self.stats)
+        stats['users'] = 0 if by_id is None else len(by_id)
+        return stats